@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Generator of synthetic FB2 books for benchmarks. Books are reproducible: the same parameters
+# always give the same book.
+#
+# Usage: bench/fb2gen.py book.fb2 [--size 2] [--depth 2] [--paragraph 60] [--notes 0.05] [--images 10] [--lang ru]
+
+import io
+import base64
+import random
+import argparse
+
+from PIL import Image
+
+WORDS = {
+    'ru': ['ветер', 'над', 'рекой', 'тихо', 'шумит', 'и', 'в', 'ночи', 'звезда', 'горит', 'дорога', 'вдаль', 'уходит', 'снова',
+           'сердце', 'помнит', 'всё', 'что', 'было', 'с', 'нами', 'человек', 'посмотрел', 'окно', 'сказал', 'никогда', 'обязательно',
+           'удивительное', 'приключение', 'государственный', 'неожиданно', 'замечательный', 'по-настоящему', 'восемнадцать'],
+    'en': ['the', 'wind', 'over', 'river', 'quietly', 'whispers', 'and', 'in', 'night', 'star', 'shines', 'road', 'goes', 'away',
+           'again', 'heart', 'remembers', 'everything', 'that', 'happened', 'with', 'us', 'somebody', 'looked', 'window', 'said',
+           'never', 'certainly', 'wonderful', 'adventure', 'government', 'unexpectedly', 'remarkable', 'eighteen'],
+}
+
+TITLES = {'ru': ('Тестовая книга', 'Иван', 'Петров', 'Глава', 'Примечания'),
+          'en': ('Test book', 'John', 'Smith', 'Chapter', 'Notes')}
+
+
+class BookParams:
+    def __init__(self, size=2, depth=2, paragraph=60, notes=0.05, images=10, image_width=800, image_height=600, lang='ru', seed=0):
+        self.size = size  # Approximate size of text in megabytes (images are not counted)
+        self.depth = depth  # Depth of nested sections
+        self.paragraph = paragraph  # Number of words in paragraph
+        self.notes = notes  # Share of paragraphs with notes
+        self.images = images
+        self.image_width = image_width
+        self.image_height = image_height
+        self.lang = lang
+        self.seed = seed
+
+
+def generate_image(rnd, width, height):
+    # Gradient with noise: compresses like a real illustration, not like an empty picture
+    im = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    noise = Image.frombytes('L', (width // 4, height // 4), bytes(rnd.getrandbits(8) for _ in range((width // 4) * (height // 4))))
+    im = Image.blend(im, noise.resize((width, height)).convert('RGB'), 0.3)
+    result = io.BytesIO()
+    im.save(result, format='JPEG', quality=90)
+    return base64.b64encode(result.getvalue()).decode('ascii')
+
+
+def generate_book(filename, params):
+    rnd = random.Random(params.seed)
+    words = WORDS[params.lang]
+    book_title, first_name, last_name, chapter, notes_title = TITLES[params.lang]
+
+    # Text of a section without nested sections, size is approximate
+    paragraphs_per_section = 30
+    word_size = len(' '.join(words).encode('utf-8')) / len(words)
+    section_size = int(paragraphs_per_section * params.paragraph * word_size)
+    leaf_sections = max(1, params.size * 1024 * 1024 // section_size)
+    branching = max(2, int(round(leaf_sections ** (1.0 / params.depth)))) if params.depth > 1 else leaf_sections
+
+    state = {'sections': 0, 'notes': 0, 'images': 0}
+
+    def paragraph():
+        text = ' '.join(rnd.choice(words) for _ in range(params.paragraph))
+        text = text[0].upper() + text[1:] + '.'
+        if rnd.random() < 0.2:
+            text = '<emphasis>{0}</emphasis> {1}'.format(text, rnd.choice(words))
+        if rnd.random() < params.notes:
+            state['notes'] += 1
+            text += ' <a l:href="#n{0}" type="note">[{0}]</a>'.format(state['notes'])
+        return '<p>{0}</p>'.format(text)
+
+    def section(f, level):
+        state['sections'] += 1
+        f.write('<section id="s{0}"><title><p>{1} {0}</p></title>'.format(state['sections'], chapter))
+        if level < params.depth:
+            for i in range(branching):
+                if state['sections'] >= leaf_sections * 2:
+                    break
+                section(f, level + 1)
+        else:
+            if state['sections'] == 2:
+                f.write('<epigraph><p>{0}</p><text-author>{1} {2}</text-author></epigraph>'.format(' '.join(words[:8]), first_name, last_name))
+            for i in range(paragraphs_per_section):
+                f.write(paragraph())
+                if i == paragraphs_per_section // 2 and state['images'] < params.images:
+                    state['images'] += 1
+                    f.write('<image l:href="#image{0}.jpg"/>'.format(state['images']))
+            f.write('<poem><stanza><v>{0}</v><v>{1}</v></stanza></poem><empty-line/>'.format(' '.join(words[:5]), ' '.join(words[5:10])))
+        f.write('</section>')
+
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>'
+                '<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0" xmlns:l="http://www.w3.org/1999/xlink">'
+                '<description><title-info><genre>prose</genre>'
+                '<author><first-name>{0}</first-name><last-name>{1}</last-name></author>'
+                '<book-title>{2}</book-title><annotation><p>{3}</p></annotation>'
+                '<coverpage><image l:href="#cover.jpg"/></coverpage><lang>{4}</lang>'
+                '<sequence name="{2}" number="1"/></title-info>'
+                '<document-info><id>00000000-0000-0000-0000-{5:012d}</id></document-info></description>'
+                '<body><title><p>{2}</p></title>'.format(first_name, last_name, book_title, ' '.join(words[:20]), params.lang, params.seed))
+
+        while state['sections'] < leaf_sections:
+            section(f, 1)
+
+        f.write('</body><body name="notes"><title><p>{0}</p></title>'.format(notes_title))
+        for i in range(1, state['notes'] + 1):
+            f.write('<section id="n{0}"><title><p>{0}</p></title><p>{1}</p></section>'.format(i, ' '.join(rnd.choice(words) for _ in range(15))))
+        f.write('</body>')
+
+        images = [generate_image(rnd, params.image_width, params.image_height) for _ in range(min(params.images, 4))]
+        f.write('<binary id="cover.jpg" content-type="image/jpeg">{0}</binary>'.format(generate_image(rnd, 600, 800)))
+        for i in range(1, state['images'] + 1):
+            f.write('<binary id="image{0}.jpg" content-type="image/jpeg">{1}</binary>'.format(i, images[(i - 1) % len(images)]))
+        f.write('</FictionBook>')
+
+    return state
+
+
+def add_arguments(argparser):
+    argparser.add_argument('--size', type=int, default=2, help='Approximate size of text in megabytes')
+    argparser.add_argument('--depth', type=int, default=2, help='Depth of nested sections')
+    argparser.add_argument('--paragraph', type=int, default=60, help='Number of words in paragraph')
+    argparser.add_argument('--notes', type=float, default=0.05, help='Share of paragraphs with notes (0-1)')
+    argparser.add_argument('--images', type=int, default=10, help='Number of images')
+    argparser.add_argument('--image-width', dest='image_width', type=int, default=800)
+    argparser.add_argument('--image-height', dest='image_height', type=int, default=600)
+    argparser.add_argument('--lang', choices=sorted(WORDS), default='ru', help='Language of book')
+    argparser.add_argument('--seed', type=int, default=0)
+
+
+def get_params(args):
+    return BookParams(args.size, args.depth, args.paragraph, args.notes, args.images, args.image_width, args.image_height, args.lang, args.seed)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Synthetic FB2 book generator')
+    argparser.add_argument('outfile', help='Name of generated book')
+    add_arguments(argparser)
+    args = argparser.parse_args()
+
+    state = generate_book(args.outfile, get_params(args))
+    print('{0}: {1} sections, {2} notes, {3} images'.format(args.outfile, state['sections'], state['notes'], state['images']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Micro-benchmark of MyHyphen.hyphenate_text over all text nodes of a book.
+# Checks that the result is the same as of the old recursive splitting on WORD_SEPARATORS.
+#
+# Usage: bench/hyphen.py novel.fb2 [--lang ru] [--repeat 3]
+
+import os
+import sys
+import time
+import argparse
+
+from lxml import etree
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from modules.myhyphen import MyHyphen, WORD_SEPARATORS, NON_BREAKING_SPACE, SOFT_HYPHEN
+
+
+def recursive_hyphenate(hyphenator, text, replace_nbsp, separators=WORD_SEPARATORS):
+    if not separators:
+        if len(text) >= 100:
+            return text
+        syl = hyphenator.syllables(text)
+        return text if not syl else SOFT_HYPHEN.join(syl)
+    else:
+        res = []
+        head, *tail = separators
+        for part in str.split(text, head):
+            res.append(recursive_hyphenate(hyphenator, part, replace_nbsp, tail))
+        head = head if not replace_nbsp or not head == NON_BREAKING_SPACE else ' '
+        return head.join(res)
+
+
+def book_text(filename):
+    texts = []
+    for event, elem in etree.iterparse(filename, events=('end',), huge_tree=True):
+        if elem.text and elem.text.strip():
+            texts.append(elem.text)
+        if elem.tail and elem.tail.strip():
+            texts.append(elem.tail)
+        elem.clear()
+    return texts
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Hyphenation benchmark')
+    argparser.add_argument('infile', help='FB2 book')
+    argparser.add_argument('--lang', default='ru', help='Hyphenation dictionary language')
+    argparser.add_argument('--repeat', type=int, default=3)
+    argparser.add_argument('--no-replace-nbsp', dest='replace_nbsp', action='store_false', default=True)
+    args = argparser.parse_args()
+
+    texts = book_text(args.infile)
+    print('{0} text nodes, {1} characters'.format(len(texts), sum(len(t) for t in texts)))
+
+    # Without cache every word goes to the hyphenator, as before
+    hyphenator = MyHyphen(args.lang, 0)
+
+    times = []
+    for i in range(args.repeat):
+        start = time.perf_counter()
+        expected = [recursive_hyphenate(hyphenator.cache.hyphenator, t, args.replace_nbsp) for t in texts]
+        times.append(time.perf_counter() - start)
+    print('recursive split:    best {0:.3f} sec'.format(min(times)))
+
+    for cache_size in (0, 50000):
+        hyphenator = MyHyphen(args.lang, cache_size)
+        times = []
+        for i in range(args.repeat):
+            start = time.perf_counter()
+            result = [hyphenator.hyphenate_text(t, args.replace_nbsp) for t in texts]
+            times.append(time.perf_counter() - start)
+        print('tokenizer, cache {0:5d}: best {1:.3f} sec'.format(cache_size, min(times)))
+
+        if result != expected:
+            mismatch = next(i for i, (r, e) in enumerate(zip(result, expected)) if r != e)
+            print('MISMATCH in text node {0}: {1!r} != {2!r}'.format(mismatch, result[mismatch], expected[mismatch]))
+            sys.exit(1)
+
+    print('Results are identical')
+
+
+if __name__ == '__main__':
+    main()
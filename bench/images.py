@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark of image processing on illustrated books (comics): every page is a big PNG with transparency,
+# book is converted with different number of image threads.
+#
+# Images are processed while text of the book is converted, "images_wait" is time spent waiting for images
+# after the text is done. With --text pages get paragraphs of text, so there is work to overlap with.
+
+import os
+import io
+import sys
+import time
+import base64
+import random
+import logging
+import argparse
+import tempfile
+import shutil
+
+from PIL import Image
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from modules.config import ConverterConfig
+from modules.fb2html import Fb2XHTML
+
+WORDS = ['ветер', 'над', 'рекой', 'тихо', 'шумит', 'и', 'в', 'ночи', 'звезда', 'горит', 'дорога', 'вдаль', 'уходит']
+
+
+def generate_image(rnd, width, height):
+    # Noise compresses badly, so decoding and encoding take as long as for real scans
+    im = Image.frombytes('RGBA', (width, height), bytes(rnd.getrandbits(8) for _ in range(width * height * 4)))
+    result = io.BytesIO()
+    im.save(result, format='PNG')
+    return base64.b64encode(result.getvalue()).decode('ascii')
+
+
+def generate_book(filename, images, width, height, text=0):
+    rnd = random.Random(0)
+    # Small number of distinct images is enough, generation of random bytes is slow
+    samples = [generate_image(rnd, width, height) for _ in range(min(images, 4))]
+    cover = io.BytesIO()
+    Image.new('RGB', (width // 2, height // 2), (200, 10, 10)).save(cover, format='JPEG')
+
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>'
+                '<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0" xmlns:l="http://www.w3.org/1999/xlink">'
+                '<description><title-info><book-title>Comics</book-title><lang>ru</lang>'
+                '<coverpage><image l:href="#cover.jpg"/></coverpage></title-info></description><body>')
+        for i in range(images):
+            f.write('<section><title><p>Page {0}</p></title><image l:href="#page{0}.png"/>'.format(i))
+            for j in range(text):
+                f.write('<p>{0}</p>'.format(' '.join(rnd.choice(WORDS) for _ in range(60))))
+            f.write('</section>')
+        f.write('</body>')
+        f.write('<binary id="cover.jpg" content-type="image/jpeg">{0}</binary>'.format(base64.b64encode(cover.getvalue()).decode('ascii')))
+        for i in range(images):
+            f.write('<binary id="page{0}.png" content-type="image/png">{1}</binary>'.format(i, samples[i % len(samples)]))
+        f.write('</FictionBook>')
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Image processing benchmark')
+    argparser.add_argument('--images', type=int, default=40, help='Number of images in book')
+    argparser.add_argument('--width', type=int, default=600)
+    argparser.add_argument('--height', type=int, default=800)
+    argparser.add_argument('--text', type=int, default=0, help='Number of paragraphs of text on every page')
+    argparser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4], help='Number of image threads to test')
+    argparser.add_argument('--stream-parsing', dest='stream_parsing', action='store_true', default=False)
+    argparser.add_argument('--repeat', type=int, default=3)
+    args = argparser.parse_args()
+
+    log = logging.getLogger('bench')
+    log.addHandler(logging.NullHandler())
+
+    config = ConverterConfig(os.path.join(os.path.dirname(__file__), '..', 'fb2mobi.config'))
+    config.log = log
+    config.setCurrentProfile(config.default_profile)
+    config.current_profile.pop('xslt', None)
+    config.current_profile['hyphens'] = False
+    config.current_profile['removePngTransparency'] = True
+    config.stream_parsing = args.stream_parsing
+    # Cover is enlarged to screen height
+    config.screen_height = args.height * 2
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        book = os.path.join(work_dir, 'comics.fb2')
+        generate_book(book, args.images, args.width, args.height, args.text)
+        print('{0} images {1}x{2}, book size {3:.1f} MB'.format(args.images, args.width, args.height, os.path.getsize(book) / 1024 / 1024))
+
+        for threads in args.threads:
+            config.image_threads = threads
+            times = []
+            for i in range(args.repeat):
+                temp_dir = tempfile.mkdtemp(dir=work_dir)
+                start = time.perf_counter()
+                fb2parser = Fb2XHTML(book, None, temp_dir, config)
+                fb2parser.generate()
+                times.append((time.perf_counter() - start, fb2parser.stages.times['parse'], fb2parser.stages.times['images_wait']))
+                shutil.rmtree(temp_dir)
+
+            best = min(times)
+            print('{0} threads: best {1:.3f} sec (parse {2:.3f}, images_wait {3:.3f}), mean {4:.3f} sec'.format(
+                threads, best[0], best[1], best[2], sum(t[0] for t in times) / len(times)))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
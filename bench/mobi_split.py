@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark of mobi_split on a combined MOBI7/KF8 file as produced by kindlegen.
+# Without arguments synthetic image heavy file is generated, real kindlegen output could be given instead.
+#
+# With --check results are compared byte by byte with the previous writer (bench/mobi_split_ref.py).
+#
+# Usage: bench/mobi_split.py [book.mobi] [--size 50] [--repeat 3] [--save dir] [--check]
+
+import os
+import sys
+import time
+import uuid
+import random
+import struct
+import argparse
+import tempfile
+
+from io import BytesIO
+from PIL import Image
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from modules.mobi_split import mobi_split
+from bench.mobi_split_ref import mobi_split as mobi_split_ref
+
+IMAGE_SIZE = 256 * 1024
+TEXT_SIZE = 4096
+
+
+def exth(records):
+    data = b''.join(struct.pack(b'>2L', n, len(v) + 8) + v for n, v in records)
+    return b'EXTH' + struct.pack(b'>2L', len(data) + 12, len(records)) + data
+
+
+def rec0(version, exth_records, fields, title=b'Benchmark'):
+    header = bytearray(280)
+    struct.pack_into(b'>H', header, 0, 2)
+    header[16:20] = b'MOBI'
+    struct.pack_into(b'>L', header, 20, 264)
+    struct.pack_into(b'>L', header, 24, 2)
+    struct.pack_into(b'>L', header, 28, 65001)
+    struct.pack_into(b'>L', header, 36, version)
+    struct.pack_into(b'>L', header, 0x80, 0x1850 if version == 6 else 0x1050)
+    for ofs in (80, 112, 120, 200, 208, 224, 244, 256):
+        struct.pack_into(b'>L', header, ofs, 0xffffffff)
+    struct.pack_into(b'>L', header, 228, 0)
+    for ofs, (value, sz) in fields.items():
+        struct.pack_into(b'>' + sz, header, ofs, value)
+    data = bytes(header) + exth(exth_records)
+    struct.pack_into(b'>L', header, 84, len(data))
+    struct.pack_into(b'>L', header, 88, len(title))
+    return bytes(header) + exth(exth_records) + title + b'\0' * 4
+
+
+def jpeg(width, height):
+    image = Image.new('RGB', (width, height), (200, 180, 160))
+    data = BytesIO()
+    image.save(data, format='JPEG')
+    return data.getvalue()
+
+
+def generate_book(size):
+    rnd = random.Random(0)
+    num_images = max(size * 1024 * 1024 // IMAGE_SIZE, 4)
+    num_text = 200
+
+    images = [jpeg(600, 800), jpeg(330, 470), b'RESC' + bytes(1000), b'FONT' + bytes(50000)]
+    images += [bytes(rnd.getrandbits(8) for _ in range(1024)) * (IMAGE_SIZE // 1024) for _ in range(num_images - len(images))]
+
+    text7 = [bytes(TEXT_SIZE) for _ in range(num_text)]
+    text8 = [bytes(TEXT_SIZE) for _ in range(num_text)]
+
+    firstimage = 1 + num_text
+    lastimage = firstimage + len(images) - 1
+    srcs = lastimage + 1
+    boundary = srcs + 3
+    kf8 = boundary + 1
+    fdst = 1 + num_text
+
+    cover = [(201, struct.pack(b'>L', 0)), (202, struct.pack(b'>L', 1))]
+    sections = [rec0(6, [(121, struct.pack(b'>L', kf8)), (116, struct.pack(b'>L', 0))] + cover,
+                     {80: (firstimage, b'L'), 108: (firstimage, b'L'), 192: (1, b'H'), 194: (lastimage, b'H'),
+                      224: (srcs, b'L'), 228: (1, b'L'), 200: (srcs + 2, b'L'), 208: (srcs + 1, b'L')})]
+    sections += text7 + images
+    sections += [b'SRCS' + bytes(5 * 1024 * 1024), b'FLIS' + bytes(32), b'FCIS' + bytes(40), b'BOUNDARY']
+    sections += [rec0(8, [(116, struct.pack(b'>L', 0)), (116, struct.pack(b'>L', 10)), (125, struct.pack(b'>L', len(images)))] + cover,
+                      {108: (fdst + 1, b'L'), 192: (fdst, b'L'), 200: (fdst + 2, b'L'), 208: (fdst + 3, b'L')})]
+    sections += text8 + [b'FDST' + bytes(16), b'FLIS' + bytes(32), b'FCIS' + bytes(40), b'\xe9\x8e\r\n']
+
+    nsec = len(sections)
+    header = bytearray(78)
+    header[:9] = b'Benchmark'
+    header[60:68] = b'BOOKMOBI'
+    struct.pack_into(b'>L', header, 68, 2 * nsec + 1)
+    struct.pack_into(b'>H', header, 76, nsec)
+
+    data = [bytes(header)]
+    ofs = 78 + 8 * nsec + 2
+    for i, sec in enumerate(sections):
+        data.append(struct.pack(b'>2L', ofs, 2 * i))
+        ofs += len(sec)
+    data.append(b'\0\0')
+    data.extend(sections)
+    return b''.join(data)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='mobi_split benchmark')
+    argparser.add_argument('infile', nargs='?', default=None, help='Combined MOBI7/KF8 file made by kindlegen')
+    argparser.add_argument('--size', type=int, default=50, help='Size of generated file in megabytes')
+    argparser.add_argument('--repeat', type=int, default=3)
+    argparser.add_argument('--save', type=str, default=None, help='Directory to save results (to compare them)')
+    argparser.add_argument('--check', action='store_true', default=False, help='Compare results with previous writer')
+    args = argparser.parse_args()
+
+    infile = args.infile
+    if not infile:
+        infile = os.path.join(tempfile.mkdtemp(), 'bench.mobi')
+        with open(infile, 'wb') as f:
+            f.write(generate_book(args.size))
+    print('{0}: {1:.1f} MB'.format(infile, os.path.getsize(infile) / 1024 / 1024))
+
+    document_id = uuid.UUID(int=0)
+    mismatch = False
+    for fmt in ('mobi', 'azw3'):
+        times = []
+        for i in range(args.repeat):
+            start = time.perf_counter()
+            splitter = mobi_split(infile, document_id, True, fmt)
+            result = splitter.getResult() if fmt == 'mobi' else splitter.getResult8()
+            times.append(time.perf_counter() - start)
+        print('{0}: best {1:.3f} sec, mean {2:.3f} sec'.format(fmt, min(times), sum(times) / len(times)))
+
+        if args.save:
+            with open(os.path.join(args.save, 'result.' + fmt), 'wb') as f:
+                f.write(result)
+            if fmt == 'azw3':
+                with open(os.path.join(args.save, 'result7.mobi'), 'wb') as f:
+                    f.write(splitter.getResult7())
+
+        if args.check:
+            ref = mobi_split_ref(infile, document_id, True, fmt)
+            results = [(fmt, result, ref.getResult() if fmt == 'mobi' else ref.getResult8())]
+            if fmt == 'azw3':
+                results.append(('mobi7', splitter.getResult7(), ref.getResult7()))
+            for name, data, data_ref in results:
+                if bytes(data) == bytes(data_ref):
+                    print('{0}: identical to previous writer ({1} bytes)'.format(name, len(data)))
+                else:
+                    print('{0}: DIFFERS from previous writer ({1} vs {2} bytes)'.format(name, len(data), len(data_ref)))
+                    mismatch = True
+
+    if not args.infile:
+        os.remove(infile)
+        os.rmdir(os.path.dirname(infile))
+
+    if mismatch:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark of page markers generation on books with very long paragraphs
+# (for example poetry without <v> tags, where the whole poem is a single <p>).
+
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import tempfile
+import shutil
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from modules.config import ConverterConfig
+from modules.fb2html import Fb2XHTML
+
+WORDS = ['ветер', 'над', 'рекой', 'тихо', 'шумит', 'и', 'в', 'ночи', 'звезда', 'горит', 'дорога', 'вдаль', 'уходит',
+         'снова', 'сердце', 'помнит', 'всё', 'что', 'было', 'с', 'нами']
+
+
+def generate_book(filename, paragraphs, words):
+    rnd = random.Random(0)
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>'
+                '<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0" xmlns:l="http://www.w3.org/1999/xlink">'
+                '<description><title-info><book-title>Poems</book-title><lang>ru</lang></title-info></description>'
+                '<body><section><title><p>Poems</p></title>')
+        for i in range(paragraphs):
+            f.write('<p>{0}</p>'.format(' '.join(rnd.choice(WORDS) for _ in range(words))))
+        f.write('</section></body></FictionBook>')
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Page markers benchmark')
+    argparser.add_argument('--paragraphs', type=int, default=20, help='Number of paragraphs')
+    argparser.add_argument('--words', type=int, default=50000, help='Number of words in every paragraph')
+    argparser.add_argument('--characters-per-page', dest='characters_per_page', type=int, default=2300)
+    argparser.add_argument('--hyphenate', action='store_true', default=False, help='Turn on hyphenation')
+    argparser.add_argument('--repeat', type=int, default=3)
+    args = argparser.parse_args()
+
+    log = logging.getLogger('bench')
+    log.addHandler(logging.NullHandler())
+
+    config = ConverterConfig(os.path.join(os.path.dirname(__file__), '..', 'fb2mobi.config'))
+    config.log = log
+    config.setCurrentProfile(config.default_profile)
+    config.current_profile.pop('xslt', None)
+    config.current_profile['hyphens'] = args.hyphenate
+    config.characters_per_page = args.characters_per_page
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        book = os.path.join(work_dir, 'poems.fb2')
+        generate_book(book, args.paragraphs, args.words)
+
+        times = []
+        for i in range(args.repeat):
+            temp_dir = tempfile.mkdtemp(dir=work_dir)
+            start = time.perf_counter()
+            fb2parser = Fb2XHTML(book, None, temp_dir, config)
+            fb2parser.generate()
+            times.append(time.perf_counter() - start)
+
+        pages = sum(fb2parser.pages_list.values())
+        print('{0} paragraphs x {1} words, {2} pages: best {3:.3f} sec, mean {4:.3f} sec'.format(
+            args.paragraphs, args.words, pages, min(times), sum(times) / len(times)))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark of fb2 elements walk: time of "parse" stage of Fb2XHTML on a large synthetic book
+# without hyphenation and images, so most of the time is spent on dispatching and formatting elements.
+
+import os
+import sys
+import logging
+import argparse
+import tempfile
+import shutil
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import fb2gen
+
+from modules.config import ConverterConfig
+from modules.fb2html import Fb2XHTML
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Benchmark of fb2 elements walk')
+    argparser.add_argument('--repeat', type=int, default=5)
+    argparser.add_argument('--stream-parsing', dest='stream_parsing', action='store_true', default=False)
+    fb2gen.add_arguments(argparser)
+    argparser.set_defaults(size=20, images=0, paragraph=20)
+    args = argparser.parse_args()
+
+    log = logging.getLogger('bench')
+    log.addHandler(logging.NullHandler())
+
+    config = ConverterConfig(os.path.join(os.path.dirname(__file__), '..', 'fb2mobi.config'))
+    config.log = log
+    config.setCurrentProfile(config.default_profile)
+    config.current_profile.pop('xslt', None)
+    config.current_profile['hyphens'] = False
+    config.current_profile['normalizeDashes'] = False
+    config.stream_parsing = args.stream_parsing
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        book = os.path.join(work_dir, 'book.fb2')
+        fb2gen.generate_book(book, fb2gen.get_params(args))
+        print('Book size {0:.1f} MB'.format(os.path.getsize(book) / 1024 / 1024))
+
+        times = []
+        for i in range(args.repeat):
+            temp_dir = tempfile.mkdtemp(dir=work_dir)
+            fb2parser = Fb2XHTML(book, None, temp_dir, config)
+            fb2parser.generate()
+            times.append(fb2parser.stages.times['parse'])
+            shutil.rmtree(temp_dir)
+
+        print('parse: best {0:.3f} sec, mean {1:.3f} sec'.format(min(times), sum(times) / len(times)))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark suite of conversion pipeline components on synthetic books.
+#
+# Every component is run in its own process, so peak memory of one component does not hide another.
+# Results could be saved and compared with results of another commit:
+#
+#   bench/suite.py --save before.json
+#   (apply changes)
+#   bench/suite.py --compare before.json
+#
+# Components: fb2html (Fb2XHTML.generate), hyphen (MyHyphen.hyphenate_text), mobi_split (on synthetic
+# combined MOBI7/KF8 file), apnx (PageMapProcessor.generateAPNX), epub (EpubProc.process) and
+# pipeline (process_file from fb2 and epub to azw3 with kindlegen replaced by a stub).
+
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import struct
+import logging
+import zipfile
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import multiprocessing
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import fb2gen
+import mobi_split as mobi_fixture
+
+from modules.config import ConverterConfig
+from modules.fb2html import Fb2XHTML
+from modules.epub import EpubProc
+from modules.myhyphen import MyHyphen
+from modules.mobi_split import mobi_split
+from modules.mobi_pagemap import PageMapProcessor
+
+COMPONENTS = ['fb2html', 'hyphen', 'mobi_split', 'apnx', 'epub', 'pipeline']
+
+KINDLEGEN_STUB = '''#!{0}
+# kindlegen stub for benchmarks: "converts" opf by copying prepared mobi file
+import os, sys, shutil
+print('Info(prcgen):I1047: Added metadata dc:Title')
+shutil.copyfile(os.environ['FB2MOBI_BENCH_MOBI'], os.path.splitext(sys.argv[1])[0] + '.mobi')
+print('Info(prcgen):I1036: Mobi file built successfully')
+'''
+
+
+def get_log():
+    log = logging.getLogger('bench')
+    if not log.handlers:
+        log.addHandler(logging.NullHandler())
+    return log
+
+
+def get_config(output_format='epub'):
+    config = ConverterConfig(os.path.join(os.path.dirname(__file__), '..', 'fb2mobi.config'))
+    config.log = get_log()
+    config.setCurrentProfile(config.default_profile)
+    config.current_profile.pop('xslt', None)
+    config.current_profile['hyphens'] = True
+    config.output_format = output_format
+    config.cache_dir = None
+    config.debug = False
+    config.apnx = None
+    config.send_to_kindle['send'] = False
+    return config
+
+
+def generate_page_data(pages):
+    # PAGE section of mobi file: header, revision string, page map string and page offsets
+    pmstr = '(1,a,1)'.encode('ascii')
+    data = b'PAGE' + bytes(12) + struct.pack(b'>L', 0)
+    data += struct.pack(b'>4H', 1, len(pmstr), pages, 32) + pmstr
+    data += b''.join(struct.pack(b'>L', i * 2048) for i in range(pages))
+    return data
+
+
+def book_text(filename):
+    from lxml import etree
+    return [t for t in etree.parse(filename).getroot().itertext() if t.strip()]
+
+
+class Context:
+    '''Files shared by all components, made once per suite run'''
+
+    def __init__(self, work_dir, args):
+        self.work_dir = work_dir
+        self.args = args
+        self.book = os.path.join(work_dir, 'book.fb2')
+        self.mobi = os.path.join(work_dir, 'book.mobi')
+        self.epub_dir = os.path.join(work_dir, 'epub')
+        self.epub = os.path.join(work_dir, 'book.epub')
+        self.bin_dir = os.path.join(work_dir, 'bin')
+
+    def prepare(self):
+        fb2gen.generate_book(self.book, fb2gen.get_params(self.args))
+
+        with open(self.mobi, 'wb') as f:
+            f.write(mobi_fixture.generate_book(self.args.mobi_size))
+
+        # Unpacked epub made from the same book for EpubProc
+        config = get_config('epub')
+        config.current_profile['hyphens'] = False
+        Fb2XHTML(self.book, None, self.epub_dir, config).generate()
+        with zipfile.ZipFile(self.epub, 'w') as epub:
+            for root, dirs, files in os.walk(self.epub_dir):
+                for filename in files:
+                    path = os.path.join(root, filename)
+                    epub.write(path, os.path.relpath(path, self.epub_dir))
+
+        if os.name != 'nt':
+            os.makedirs(self.bin_dir)
+            stub = os.path.join(self.bin_dir, 'kindlegen')
+            with open(stub, 'w') as f:
+                f.write(KINDLEGEN_STUB.format(sys.executable))
+            os.chmod(stub, 0o755)
+
+
+def bench_fb2html(ctx):
+    config = get_config('epub')
+
+    def run():
+        temp_dir = tempfile.mkdtemp(dir=ctx.work_dir)
+        Fb2XHTML(ctx.book, None, temp_dir, config).generate()
+        shutil.rmtree(temp_dir)
+
+    return run, os.path.getsize(ctx.book), 'MB'
+
+
+def bench_hyphen(ctx):
+    text = book_text(ctx.book)
+    hyphenator = MyHyphen(ctx.args.lang)
+
+    def run():
+        # Cache of hyphenated words is shared, every run starts with empty one
+        hyphenator.cache.words.clear()
+        for t in text:
+            hyphenator.hyphenate_text(t, True)
+
+    return run, sum(len(t.split()) for t in text), 'words'
+
+
+def bench_mobi_split(ctx):
+    document_id = uuid.UUID(int=0)
+
+    def run():
+        mobi_split(ctx.mobi, document_id, True, 'mobi').getResult()
+        mobi_split(ctx.mobi, document_id, True, 'azw3').getResult8()
+
+    return run, 2 * os.path.getsize(ctx.mobi), 'MB'
+
+
+def bench_apnx(ctx):
+    data = generate_page_data(ctx.args.pages)
+    log = get_log()
+    meta = {'contentGuid': '00000000', 'asin': 'B000000000', 'cdeType': 'EBOK', 'format': 'MOBI_8', 'acr': 'CR!BENCH'}
+
+    def run():
+        pages = PageMapProcessor(data, log)
+        meta['pageMap'] = pages.getPageMap()
+        pages.generateAPNX(meta)
+
+    return run, ctx.args.pages, 'pages'
+
+
+def bench_epub(ctx):
+    config = get_config('mobi')
+    opf = os.path.join('OEBPS', 'content.opf')
+
+    # EpubProc changes files in place, every run works on a fresh copy (copying is not timed)
+    copies = []
+
+    def setup():
+        temp_dir = os.path.join(tempfile.mkdtemp(dir=ctx.work_dir), 'epub')
+        shutil.copytree(ctx.epub_dir, temp_dir)
+        copies.append(temp_dir)
+
+    def run():
+        EpubProc(os.path.join(copies.pop(), opf), config).process()
+
+    run.setup = setup
+    return run, sum(os.path.getsize(os.path.join(r, f)) for r, d, fs in os.walk(ctx.epub_dir) for f in fs if f.endswith('.xhtml')), 'MB'
+
+
+def bench_pipeline(ctx):
+    import fb2mobi
+
+    if os.name == 'nt':
+        return None, 0, ''
+
+    os.environ['PATH'] = ctx.bin_dir + os.pathsep + os.environ.get('PATH', '')
+    os.environ['FB2MOBI_BENCH_MOBI'] = ctx.mobi
+    config = get_config('azw3')
+    config.current_profile['hyphens'] = True
+
+    def run():
+        out_dir = tempfile.mkdtemp(dir=ctx.work_dir)
+        for infile in (ctx.book, ctx.epub):
+            if not fb2mobi.process_file(config, infile, os.path.join(out_dir, os.path.basename(infile) + '.azw3')):
+                raise RuntimeError('Conversion of "{0}" failed'.format(infile))
+        shutil.rmtree(out_dir)
+
+    return run, os.path.getsize(ctx.book) + os.path.getsize(ctx.epub), 'MB'
+
+
+def get_peak_rss():
+    if not resource:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS - bytes
+    return rss * 1024 if sys.platform != 'darwin' else rss
+
+
+def run_component(name, ctx, repeat):
+    run, amount, unit = globals()['bench_' + name](ctx)
+    if run is None:
+        return None
+
+    times = []
+    for i in range(repeat):
+        if hasattr(run, 'setup'):
+            run.setup()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    peak_rss = get_peak_rss()
+
+    # Separate run for Python allocations: tracing slows everything down.
+    # Memory allocated by C libraries (libxml2, Pillow) is only seen in peak RSS.
+    if hasattr(run, 'setup'):
+        run.setup()
+    tracemalloc.start()
+    run()
+    peak_python = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    best = min(times)
+    if unit == 'MB':
+        throughput = amount / 1024 / 1024 / best
+    else:
+        throughput = amount / best
+
+    return {'best': best, 'mean': sum(times) / len(times), 'throughput': throughput, 'unit': unit + '/sec',
+            'peak_rss': peak_rss, 'peak_python': peak_python}
+
+
+def run_isolated(name, ctx, repeat):
+    # New process for every component, so peak RSS belongs to this component only.
+    # Spawned process does not inherit memory of suite, as forked one does.
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(run_component, (name, ctx, repeat))
+
+
+def format_mb(value):
+    return '{0:.1f}'.format(value / 1024 / 1024) if value is not None else '-'
+
+
+def print_results(results, baseline):
+    print('{0:<12} {1:>9} {2:>9} {3:>22} {4:>9} {5:>9} {6:>8}'.format('Component', 'Best, s', 'Mean, s', 'Throughput',
+                                                                       'RSS, MB', 'Py, MB', 'Change'))
+    for name, r in results.items():
+        if r is None:
+            print('{0:<12} skipped'.format(name))
+            continue
+
+        change = ''
+        if baseline and baseline.get(name):
+            change = '{0:+.1f}%'.format(100 * (r['best'] - baseline[name]['best']) / baseline[name]['best'])
+
+        print('{0:<12} {1:>9.3f} {2:>9.3f} {3:>22} {4:>9} {5:>9} {6:>8}'.format(
+            name, r['best'], r['mean'], '{0:.1f} {1}'.format(r['throughput'], r['unit']),
+            format_mb(r['peak_rss']), format_mb(r['peak_python']), change))
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Benchmark suite of conversion pipeline components')
+    argparser.add_argument('components', nargs='*', metavar='component', help='Components to run: {0} (all by default)'.format(', '.join(COMPONENTS)))
+    argparser.add_argument('--repeat', type=int, default=3)
+    argparser.add_argument('--mobi-size', dest='mobi_size', type=int, default=20, help='Size of synthetic mobi file in megabytes')
+    argparser.add_argument('--pages', type=int, default=20000, help='Number of pages in page map for apnx')
+    argparser.add_argument('--save', type=str, default=None, help='Save results to JSON file')
+    argparser.add_argument('--compare', type=str, default=None, help='Compare results with saved JSON file')
+    fb2gen.add_arguments(argparser)
+    args = argparser.parse_args()
+
+    for name in args.components:
+        if name not in COMPONENTS:
+            argparser.error('unknown component "{0}"'.format(name))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        ctx = Context(work_dir, args)
+        ctx.prepare()
+        print('Book: {0:.1f} MB, mobi: {1:.1f} MB, Python {2}'.format(os.path.getsize(ctx.book) / 1024 / 1024,
+                                                                     os.path.getsize(ctx.mobi) / 1024 / 1024, platform.python_version()))
+
+        results = {}
+        for name in args.components or COMPONENTS:
+            results[name] = run_isolated(name, ctx, args.repeat)
+
+        print_results(results, baseline)
+
+        if args.save:
+            with open(args.save, 'w', encoding='utf-8') as f:
+                json.dump({'params': vars(args), 'python': platform.python_version(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                           'results': results}, f, indent=1, sort_keys=True)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
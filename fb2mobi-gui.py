@@ -11,6 +11,8 @@ import webbrowser
 import logging
 import shutil
 
+from concurrent.futures import ThreadPoolExecutor
+
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QFileDialog, QTreeWidgetItem, QMessageBox, QDialog, QWidget, 
                             QLabel, QAbstractItemView, QSizePolicy)
 from PyQt5.QtGui import QIcon, QPixmap 
@@ -24,6 +26,7 @@ from ui.gui_config import GuiConfig
 import ui.images_rc
 import ui.ui_version
 from ui.fb2meta import Fb2Meta
+from ui.metacache import MetaCache
 from ui.fontdb import FontDb
 
 from modules.config import ConverterConfig
@@ -40,6 +43,21 @@ SUPPORT_URL = u'http://www.the-ebook.org/forum/viewtopic.php?t=30380'
 
 _translate = QCoreApplication.translate
 
+# Метаданные книг читаются в фоне несколькими потоками и передаются в список пачками
+META_WORKERS = 4
+META_CHUNK = 64
+META_EMIT_INTERVAL = 0.2
+
+
+def read_meta(file):
+    try:
+        st = os.stat(file)
+        meta = Fb2Meta(file, description_only=True)
+        meta.get()
+        return file, st.st_mtime, st.st_size, meta.book_title, meta.get_autors()
+    except:
+        return file, None, None, None, None
+
 
 class CopyThread(QThread):
     copyBegin = pyqtSignal(object)
@@ -80,7 +98,8 @@ class CopyThread(QThread):
                     if self.thumbnail_path and self.synccovers:
                         dest_file = os.path.join(self.dest_path, os.path.split(file)[1])
                         if os.path.exists(dest_file):
-                            synccovers.process_file(dest_file, self.thumbnail_path, 330, 470, False, False)
+                            # copy2 сохраняет старое время изменения книги, миниатюра Kindle всегда окажется новее
+                            synccovers.process_file(dest_file, self.thumbnail_path, 330, 470, False, False, force=True)
             except:
                 pass
             self.copyDone.emit()
@@ -88,6 +107,39 @@ class CopyThread(QThread):
         self.copyAllDone.emit()
 
 
+class MetaThread(QThread):
+    metaReady = pyqtSignal(object)
+
+    def __init__(self, files):
+        super(MetaThread, self).__init__()
+        self.files = files
+        self.cancel = False
+
+
+    def run(self):
+        batch = []
+        last_emit = time.time()
+
+        with ThreadPoolExecutor(max_workers=META_WORKERS) as executor:
+            # Файлы отдаются пулу частями, чтобы при закрытии программы не дочитывать весь список
+            for i in range(0, len(self.files), META_CHUNK):
+                if self.cancel:
+                    break
+                for result in executor.map(read_meta, self.files[i:i + META_CHUNK]):
+                    batch.append(result)
+                    if time.time() - last_emit > META_EMIT_INTERVAL:
+                        self.metaReady.emit(batch)
+                        batch = []
+                        last_emit = time.time()
+
+        if batch and not self.cancel:
+            self.metaReady.emit(batch)
+
+
+    def stop(self):
+        self.cancel = True
+
+
 class ConvertThread(QThread):
     convertBegin = pyqtSignal(object)
     convertDone = pyqtSignal(object, bool, object)
@@ -130,9 +182,9 @@ class ConvertThread(QThread):
                 if os.path.exists(dest_file):
                     os.remove(dest_file)
 
-                fb2mobi.process_file(self.config, file, None)
-
-                if not os.path.exists(dest_file):
+                # Готовая книга могла быть уже отправлена и удалена очередью отправки на Kindle,
+                # поэтому успех определяется по результату конвертации, а не по наличию файла
+                if not isinstance(fb2mobi.process_file(self.config, file, None), str):
                     dest_file = None
                     result = False
                 else:
@@ -142,6 +194,9 @@ class ConvertThread(QThread):
             else:
                 break
 
+        fb2mobi.evict_cache(self.config)
+        # Ждем отправки всех книг из очереди, иначе при выходе из программы они будут потеряны
+        fb2mobi.finish_sending(self.config)
         self.convertAllDone.emit()
 
 
@@ -313,6 +368,10 @@ class MainAppWindow(QMainWindow, Ui_MainWindow):
 
         self.convert_worker = None
         self.copy_worker = None
+        self.meta_workers = []
+        self.pendingMeta = []
+        # Элементы списка по имени файла
+        self.fileItems = {}
         self.is_convert_cancel = False
 
         # Список стилей для встраивания шрифтов
@@ -368,6 +427,7 @@ class MainAppWindow(QMainWindow, Ui_MainWindow):
             log.addHandler(log_file_handler)
 
         self.gui_config.converterConfig.log = log
+        self.meta_cache = MetaCache(os.path.normpath(os.path.join(config_path, 'fb2mobi-gui.cache')))
         # Строим базу доступных шрифтов
         self.font_path = os.path.normpath(os.path.join(config_path, 'profiles/fonts'))
         if os.path.exists(self.font_path):
@@ -486,6 +546,7 @@ class MainAppWindow(QMainWindow, Ui_MainWindow):
 
     def deleteRecAction(self):
         for item in self.treeFileList.selectedItems():
+            self.fileItems.pop(item.text(2), None)
             self.rootFileList.removeChild(item)
      
 
@@ -707,40 +768,72 @@ class MainAppWindow(QMainWindow, Ui_MainWindow):
         if not file.lower().endswith((".fb2", ".fb2.zip", ".zip")):
             return
 
-        found = False
-
         file = os.path.normpath(file)
-        
-        for i in range(self.rootFileList.childCount()):
-            if file == self.rootFileList.child(i).text(2):
-                found = True
-                break
-
-        if not found:
-            meta = Fb2Meta(file)
-            meta.get()
 
+        if file not in self.fileItems:
             item = QTreeWidgetItem(0)
             item.setIcon(0, self.iconWhite)
-            item.setText(0, meta.book_title)
-            item.setText(1, meta.get_autors())
             item.setText(2, file)
-            # Установим подсказки
-            item.setToolTip(0, meta.book_title)
-            item.setToolTip(1, meta.get_autors())
             item.setToolTip(2, file)
-            
+
+            # Если книга есть в кэше - сразу покажем название и авторов,
+            # иначе до чтения метаданных в фоне показываем имя файла
+            meta = self.meta_cache.get(file)
+            if meta:
+                self.setItemMeta(item, *meta)
+            else:
+                item.setText(0, os.path.basename(file))
+                self.pendingMeta.append(file)
+
+            self.fileItems[file] = item
             self.treeFileList.addTopLevelItem(item)
 
 
+    def setItemMeta(self, item, title, authors):
+        item.setText(0, title or '')
+        item.setText(1, authors or '')
+        # Установим подсказки
+        item.setToolTip(0, title or '')
+        item.setToolTip(1, authors or '')
+
+
     def addFiles(self, file_list):
-        for item in file_list:
-            if os.path.isdir(item):
-                for root, dirs, files in os.walk(item):
-                    for f in files:
-                        self.addFile(os.path.join(root, f))
-            else:
-                self.addFile(item)
+        self.treeFileList.setUpdatesEnabled(False)
+        try:
+            for item in file_list:
+                if os.path.isdir(item):
+                    for root, dirs, files in os.walk(item):
+                        for f in files:
+                            self.addFile(os.path.join(root, f))
+                else:
+                    self.addFile(item)
+        finally:
+            self.treeFileList.setUpdatesEnabled(True)
+
+        if self.pendingMeta:
+            worker = MetaThread(self.pendingMeta)
+            worker.metaReady.connect(self.metaReady)
+            worker.finished.connect(self.metaDone)
+            self.meta_workers.append(worker)
+            self.pendingMeta = []
+            worker.start()
+
+
+    def metaReady(self, results):
+        for file, mtime, size, title, authors in results:
+            if mtime is None:
+                # Файл не удалось разобрать, остается имя файла
+                continue
+            self.meta_cache.put(file, mtime, size, title, authors)
+            item = self.fileItems.get(file)
+            if item is not None:
+                self.setItemMeta(item, title, authors)
+
+        self.meta_cache.commit()
+
+
+    def metaDone(self):
+        self.meta_workers = [w for w in self.meta_workers if not w.isFinished()]
 
 
     def addFilesAction(self):
@@ -775,6 +868,13 @@ class MainAppWindow(QMainWindow, Ui_MainWindow):
 
         self.gui_config.write()
 
+        for worker in self.meta_workers:
+            worker.stop()
+        for worker in self.meta_workers:
+            worker.wait()
+        self.meta_workers = []
+        self.meta_cache.close()
+
         self.close()
 
 
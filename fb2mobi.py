@@ -3,15 +3,16 @@
 
 import os
 import sys
+import errno
 import logging
 
 import tempfile
-import subprocess
 import argparse
 import zipfile
 import time
 import shutil
 import uuid
+import multiprocessing
 
 import version
 
@@ -19,9 +20,14 @@ from modules.utils import transliterate
 from modules.fb2html import Fb2XHTML
 from modules.epub import EpubProc
 from modules.config import ConverterConfig
-from modules.sendtokindle import SendToKindle
+from modules.sendtokindle import SendToKindle, DeliveryQueue
 from modules.mobi_split import mobi_split, mobi_read
 from modules.mobi_pagemap import PageMapProcessor
+from modules.convcache import ConversionCache, get_settings_hash
+from modules.manifest import ConversionManifest, MANIFEST_NAME
+from modules.output import ZipOutput, get_compress_type, open_zip
+from modules.kindlegen import run_kindlegen, get_kindlegen_cmd
+from modules.stages import Stages
 
 
 def get_executable_path():
@@ -42,8 +48,8 @@ def get_executable_name():
     return name
 
 
-def create_epub(rootdir, epubname):
-    epub = zipfile.ZipFile(epubname, "w")
+def create_epub(rootdir, epubname, stored_media, compression_level):
+    epub = open_zip(epubname, compression_level)
     epub.write(os.path.join(rootdir, 'mimetype'), 'mimetype', zipfile.ZIP_STORED)
 
     for root, dirs, files in os.walk(rootdir):
@@ -53,7 +59,7 @@ def create_epub(rootdir, epubname):
 
         for filename in files:
             if filename != 'mimetype' and filename != '_unzipped.fb2':
-                epub.write(os.path.join(root, filename), os.path.join(relpath, filename), zipfile.ZIP_DEFLATED)
+                epub.write(os.path.join(root, filename), os.path.join(relpath, filename), get_compress_type(filename, stored_media, compression_level))
 
     epub.close()
 
@@ -70,6 +76,14 @@ def get_mobi_filename(filename, translit=False):
     return '{0}.mobi'.format(out_file)
 
 
+def get_apnx_filename(config, outfile):
+    base = os.path.splitext(outfile)[0]
+    if config.apnx == 'eink':
+        return os.path.join(base + '.sdr', os.path.basename(base) + '.apnx')
+    else:
+        return base + '.apnx'
+
+
 def unzip(filename, tempdir):
     unzipped_file = None
 
@@ -111,10 +125,62 @@ def rm_tmp_files(dir, deleteroot=True):
         os.rmdir(dir)
 
 
-def process_file(config, infile, outfile=None):
+# Books are sent in background while conversion goes on
+delivery_queue = None
+
+
+def send_book(config, outfile, log=None):
+    global delivery_queue
+
+    # Logger of config is not available in the main process during parallel conversion
+    if log is None:
+        log = config.log
+
+    if config.send_to_kindle['send']:
+        if config.output_format.lower() != 'mobi':
+            log.warning('Kindle Personal Documents Service only accepts personal mobi files')
+        else:
+            if delivery_queue is None:
+                kindle = SendToKindle()
+                kindle.smtp_server = config.send_to_kindle['smtpServer']
+                kindle.smtp_port = config.send_to_kindle['smtpPort']
+                kindle.smtp_login = config.send_to_kindle['smtpLogin']
+                kindle.smtp_password = config.send_to_kindle['smtpPassword']
+                kindle.user_email = config.send_to_kindle['fromUserEmail']
+                kindle.kindle_email = config.send_to_kindle['toKindleEmail']
+                kindle.convert = False
+                delivery_queue = DeliveryQueue(kindle, log, int(config.send_to_kindle['maxAttachmentsSize'] * 1024 * 1024),
+                                               config.send_to_kindle['retries'], config.send_to_kindle['retryDelay'],
+                                               config.send_to_kindle['deleteSendedBook'])
+
+            log.info('Book is queued for sending to "{0}"'.format(config.send_to_kindle['toKindleEmail']))
+            delivery_queue.put(outfile)
+
+
+def finish_sending(config):
+    global delivery_queue
+
+    if delivery_queue is not None:
+        config.log.info('Waiting for books to be sent...')
+        failed = delivery_queue.finish()
+        config.log.info('{0} books sent, {1} failed.'.format(delivery_queue.sent, failed))
+        delivery_queue = None
+
+
+def evict_cache(config):
+    # Размер кэша проверяется один раз после всех книг: обход кэша после каждой книги дорог
+    if config.cache_dir and not config.debug:
+        ConversionCache(config.cache_dir, config.cache_max_size, config.log).evict()
+
+
+def process_file(config, infile, outfile=None, stages=None):
     critical_error = False
 
-    start_time = time.clock()
+    # Время и счетчики этапов конвертации для --profile-stages
+    if stages is None:
+        stages = Stages()
+
+    start_time = time.perf_counter()
     temp_dir = tempfile.mkdtemp()
 
     if not os.path.exists(infile):
@@ -173,17 +239,44 @@ def process_file(config, infile, outfile=None):
         # Для epub всегда разбиваем по главам
         config.current_profile['chapterOnNewPage'] = True
 
+    result_file = '{0}.{1}'.format(os.path.splitext(outfile)[0], config.output_format.lower())
+    apnx_file = get_apnx_filename(config, outfile) if config.apnx and config.output_format.lower() in ('mobi', 'azw3') else None
+
+    # В режиме отладки нужны промежуточные файлы, кэш не используется
+    cache = None
+    if config.cache_dir and not config.debug:
+        cache = ConversionCache(config.cache_dir, config.cache_max_size, config.log)
+        with stages.timer('cache'):
+            cache_key = cache.get_key(config, infile)
+            restored = cache.restore(cache_key, result_file, apnx_file)
+        if restored:
+            stages.add_time('total', time.perf_counter() - start_time)
+            stages.count('cache_hits')
+            config.log.info('Book found in conversion cache.')
+            config.log.info('Book conversion completed in {0} sec.\n'.format(round(time.perf_counter() - start_time, 2)))
+            rm_tmp_files(temp_dir)
+            with stages.timer('send'):
+                send_book(config, outfile)
+            return result_file
+
+        # Results could be hardlinks to cache entries, they must not be overwritten in place
+        for f in (result_file, apnx_file):
+            if f and os.path.isfile(f):
+                os.remove(f)
+
     debug_dir = os.path.abspath(os.path.splitext(infile)[0])
     if os.path.splitext(debug_dir)[1].lower() == '.fb2':
         debug_dir = os.path.splitext(debug_dir)[0]
 
     input_epub = False
+    zip_file = None
 
     if os.path.splitext(infile)[1].lower() == '.zip':
         config.log.info('Unpacking...')
         tmp_infile = infile
         try:
-            infile = unzip(infile, temp_dir)
+            with stages.timer('unpack'):
+                infile = unzip(infile, temp_dir)
         except:
             config.log.critical('Error unpacking file "{0}".'.format(tmp_infile))
             return
@@ -196,7 +289,8 @@ def process_file(config, infile, outfile=None):
         config.log.info('Unpacking epub...')
         tmp_infile = infile
         try:
-            infile = unzip_epub(infile, temp_dir)
+            with stages.timer('unpack'):
+                infile = unzip_epub(infile, temp_dir)
         except:
             config.log.critical('Error unpacking file "{0}".'.format(tmp_infile))
             return
@@ -210,57 +304,61 @@ def process_file(config, infile, outfile=None):
     if input_epub:
         # Let's see what we could do
         config.log.info('Processing epub...')
-        epubparser = EpubProc(infile, config)
-        epubparser.process()
+        with stages.timer('epub'):
+            epubparser = EpubProc(infile, config)
+            epubparser.process()
+        stages.merge(epubparser.stages, 'epub.')
         document_id = epubparser.book_uuid
     else:
         # Конвертируем в html
         config.log.info('Converting fb2 to html...')
+        # epub is written straight into archive, kindlegen and debug mode need files on disk
+        output = None
+        if config.output_format.lower() == 'epub' and not config.debug:
+            zip_file = result_file + '.tmp'
+            output = ZipOutput(zip_file, config.epub_stored_media, config.epub_compression_level)
         try:
-            fb2parser = Fb2XHTML(infile, outfile, temp_dir, config)
-            fb2parser.generate()
+            with stages.timer('fb2html'):
+                fb2parser = Fb2XHTML(infile, outfile, temp_dir, config, output)
+                fb2parser.generate()
+            stages.merge(fb2parser.stages, 'fb2html.')
             document_id = fb2parser.book_uuid
             infile = os.path.join(temp_dir, 'OEBPS', 'content.opf')
+            if output:
+                output.close()
         except:
             config.log.critical('Error while converting file "{0}"'.format(infile))
             config.log.debug('Getting details', exc_info=True)
+            if output:
+                output.close()
+                os.remove(zip_file)
             return
 
-    config.log.info('Processing took {0} sec.'.format(round(time.clock() - start_time, 2)))
+    config.log.info('Processing took {0} sec.'.format(round(time.perf_counter() - start_time, 2)))
 
     if config.output_format.lower() in ('mobi', 'azw3'):
         # Запускаем kindlegen
-        application_path = get_executable_path()
-        if sys.platform == 'win32':
-            if os.path.exists(os.path.join(application_path, 'kindlegen.exe')):
-                kindlegen_cmd = os.path.join(application_path, 'kindlegen.exe')
-            else:
-                kindlegen_cmd = 'kindlegen.exe'
-        else:
-            if os.path.exists(os.path.join(application_path, 'kindlegen')):
-                kindlegen_cmd = os.path.join(application_path, 'kindlegen')
-            else:
-                kindlegen_cmd = 'kindlegen'
+        kindlegen_cmd = get_kindlegen_cmd(get_executable_path())
 
         try:
             config.log.info('Running kindlegen...')
             kindlegen_cmd_pars = '-c{0}'.format(config.kindle_compression_level)
 
-            startupinfo = None
-            if os.name == 'nt':
-                startupinfo = subprocess.STARTUPINFO()
-                startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-
-            with subprocess.Popen([kindlegen_cmd, infile, kindlegen_cmd_pars, '-locale', 'en'], stdout=subprocess.PIPE,
-                                  stderr=subprocess.STDOUT, startupinfo=startupinfo) as result:
-                config.log.debug(str(result.stdout.read(), 'utf-8', errors='replace'))
+            with stages.timer('kindlegen'):
+                kindlegen_run = run_kindlegen(kindlegen_cmd, [infile, kindlegen_cmd_pars, '-locale', 'en'], config.log,
+                                              config.kindlegen_timeout, config.kindlegen_jobs if config.kindlegen_jobs > 0 else multiprocessing.cpu_count())
+            stages.add_time('kindlegen.wait', kindlegen_run.wait_time)
+            if kindlegen_run.cpu_time is not None:
+                stages.count('kindlegen_cpu_time', round(kindlegen_run.cpu_time, 3))
+            if kindlegen_run.timed_out:
+                config.log.critical('kindlegen timeout, conversion interrupted.')
+                critical_error = True
 
         except OSError as e:
-            if e.errno == os.errno.ENOENT:
+            if e.errno == errno.ENOENT:
                 config.log.critical('{0} not found'.format(kindlegen_cmd))
                 critical_error = True
             else:
-                config.log.critical(e.winerror)
                 config.log.critical(e.strerror)
                 config.log.debug('Getting details', exc_info=True, stack_info=True)
                 raise e
@@ -268,8 +366,12 @@ def process_file(config, infile, outfile=None):
     elif config.output_format.lower() == 'epub':
         # Собираем epub
         outfile = os.path.splitext(outfile)[0] + '.epub'
-        config.log.info('Creating epub...')
-        create_epub(temp_dir, outfile)
+        with stages.timer('pack'):
+            if zip_file:
+                os.replace(zip_file, outfile)
+            else:
+                config.log.info('Creating epub...')
+                create_epub(temp_dir, outfile, config.epub_stored_media, config.epub_compression_level)
 
     if config.debug:
         # В режиме отладки копируем получившиеся файлы в выходной каталог
@@ -289,90 +391,249 @@ def process_file(config, infile, outfile=None):
             else:
                 try:
                     remove_personal = config.current_profile['kindleRemovePersonalLabel']
-                    if ext in 'mobi' and config.noMOBIoptimization:
-                        config.log.info('Copying resulting file...')
-                        shutil.copyfile(result_book, outfile)
-                    else:
-                        config.log.info('Optimizing resulting file...')
-                        splitter = mobi_split(result_book, document_id, remove_personal, ext)
-                        open(os.path.splitext(outfile)[0] + '.' + ext, 'wb').write(splitter.getResult() if ext == 'mobi' else splitter.getResult8())
+                    with stages.timer('mobi_split'):
+                        if ext in 'mobi' and config.noMOBIoptimization:
+                            config.log.info('Copying resulting file...')
+                            shutil.copyfile(result_book, outfile)
+                        else:
+                            config.log.info('Optimizing resulting file...')
+                            splitter = mobi_split(result_book, document_id, remove_personal, ext)
+                            open(os.path.splitext(outfile)[0] + '.' + ext, 'wb').write(splitter.getResult() if ext == 'mobi' else splitter.getResult8())
                 except:
                     config.log.critical('Error optimizing file, conversion interrupted.')
                     config.log.debug('Getting details', exc_info=True, stack_info=True)
                     critical_error = True
 
                 if config.apnx:
-                    try:
-                        base = os.path.splitext(outfile)[0]
-                        reader = mobi_read(base + '.' + ext)
-                        pagedata = reader.getPageData()
-                        if len(pagedata) > 0:
-                            config.log.info('Generating page index (APNX)...')
-                            pages = PageMapProcessor(pagedata, config.log)
-                            asin = reader.getCdeContentKey()
-                            if len(asin) == 0:
-                                asin = reader.getASIN()
-                            apnx = pages.generateAPNX(
-                                {'contentGuid': str(uuid.uuid4()).replace('-', '')[:8],
-                                 'asin': asin,
-                                 'cdeType': reader.getCdeType(),
-                                 'format': 'MOBI_8' if ext in 'azw3' else 'MOBI_7',
-                                 'pageMap': pages.getPageMap(),
-                                 'acr': reader.getACR()})
-                            if config.apnx == 'eink':
-                                basename = os.path.basename(base)
-                                sdr = base + '.sdr'
-                                if not os.path.exists(sdr):
-                                    os.makedirs(sdr)
-                                apnxfile = os.path.join(sdr, basename + '.apnx')
+                    with stages.timer('apnx'):
+                        try:
+                            base = os.path.splitext(outfile)[0]
+                            with mobi_read(base + '.' + ext) as reader:
+                                pagedata = reader.getPageData()
+                            if len(pagedata) > 0:
+                                config.log.info('Generating page index (APNX)...')
+                                pages = PageMapProcessor(pagedata, config.log)
+                                asin = reader.getCdeContentKey()
+                                if len(asin) == 0:
+                                    asin = reader.getASIN()
+                                apnx = pages.generateAPNX(
+                                    {'contentGuid': str(uuid.uuid4()).replace('-', '')[:8],
+                                     'asin': asin,
+                                     'cdeType': reader.getCdeType(),
+                                     'format': 'MOBI_8' if ext in 'azw3' else 'MOBI_7',
+                                     'pageMap': pages.getPageMap(),
+                                     'acr': reader.getACR()})
+                                apnx_dir = os.path.dirname(apnx_file)
+                                if config.apnx == 'eink' and not os.path.exists(apnx_dir):
+                                    os.makedirs(apnx_dir)
+                                open(apnx_file, 'wb').write(apnx)
                             else:
-                                apnxfile = base + '.apnx'
-                            open(apnxfile, 'wb').write(apnx)
-                        else:
-                            config.log.warning('No information to generate page index')
-                    except:
-                        config.log.warning('Unable to generate page index (APNX)')
-                        config.log.debug('Getting details', exc_info=True, stack_info=True)
+                                config.log.warning('No information to generate page index')
+                        except:
+                            config.log.warning('Unable to generate page index (APNX)')
+                            config.log.debug('Getting details', exc_info=True, stack_info=True)
 
     if not critical_error:
-        config.log.info('Book conversion completed in {0} sec.\n'.format(round(time.clock() - start_time, 2)))
+        if cache:
+            with stages.timer('cache'):
+                cache.store(cache_key, result_file, apnx_file)
 
-        if config.send_to_kindle['send']:
-            if config.output_format.lower() != 'mobi':
-                config.log.warning('Kindle Personal Documents Service only accepts personal mobi files')
-            else:
-                config.log.info('Sending book...')
-                try:
-                    kindle = SendToKindle()
-                    kindle.smtp_server = config.send_to_kindle['smtpServer']
-                    kindle.smtp_port = config.send_to_kindle['smtpPort']
-                    kindle.smtp_login = config.send_to_kindle['smtpLogin']
-                    kindle.smtp_password = config.send_to_kindle['smtpPassword']
-                    kindle.user_email = config.send_to_kindle['fromUserEmail']
-                    kindle.kindle_email = config.send_to_kindle['toKindleEmail']
-                    kindle.convert = False
-                    kindle.send_mail([outfile])
-
-                    config.log.info('Book has been sent to "{0}"'.format(config.send_to_kindle['toKindleEmail']))
-
-                    if config.send_to_kindle['deleteSendedBook']:
-                        try:
-                            os.remove(outfile)
-                        except:
-                            config.log.error('Unable to remove file "{0}".'.format(outfile))
-                            return -1
-
-                except KeyboardInterrupt:
-                    print('User interrupt. Exiting...')
-                    sys.exit(-1)
+        stages.add_time('total', time.perf_counter() - start_time)
+        config.log.info('Book conversion completed in {0} sec.\n'.format(round(time.perf_counter() - start_time, 2)))
 
-                except:
-                    config.log.error('Error sending file')
-                    config.log.debug('Getting details', exc_info=True, stack_info=True)
+        with stages.timer('send'):
+            send_book(config, outfile)
 
     # Чистим временные файлы
     rm_tmp_files(temp_dir)
 
+    if not critical_error:
+        return result_file
+
+
+class BookLogHandler(logging.Handler):
+    '''Collects log records of a single book conversion in a worker process,
+    so they could be passed to the main process and shown there in order.
+    '''
+
+    def __init__(self):
+        super(BookLogHandler, self).__init__(logging.DEBUG)
+        self.formatter = logging.Formatter()
+        self.records = []
+
+    def emit(self, record):
+        # Make record picklable - tracebacks could not be passed between processes
+        if record.exc_info:
+            record.exc_text = self.formatter.formatException(record.exc_info)
+            record.exc_info = None
+        record.msg = record.getMessage()
+        record.args = None
+        self.records.append(record)
+
+
+worker_config = None
+worker_log_handler = None
+
+
+def init_worker(config, temp_root):
+    global worker_config, worker_log_handler
+
+    # Каждый процесс работает со своей копией настроек и своим временным каталогом
+    tempfile.tempdir = tempfile.mkdtemp(dir=temp_root)
+
+    worker_log_handler = BookLogHandler()
+    log = logging.getLogger('fb2mobi')
+    log.setLevel("DEBUG")
+    log.propagate = False
+    log.handlers = []
+    log.addHandler(worker_log_handler)
+
+    config.log = log
+    # Books are sent by the main process, so one SMTP session is used for the whole batch
+    config.send_to_kindle = dict(config.send_to_kindle, send=False)
+    worker_config = config
+
+
+def process_file_in_worker(infile):
+    worker_log_handler.records = []
+    success = False
+    result = None
+    stages = Stages()
+
+    try:
+        result = process_file(worker_config, infile, None, stages)
+        success = True
+    except KeyboardInterrupt:
+        worker_config.log.error('User interrupt.')
+    except IOError as e:
+        worker_config.log.error('(I/O error {0}) {1} - {2}'.format(e.errno, e.strerror, e.filename))
+    except:
+        worker_config.log.error('Error processing file "{0}"'.format(infile))
+        worker_config.log.debug('Getting details', exc_info=True, stack_info=True)
+
+    return success, result, worker_log_handler.records, stages
+
+
+def get_folder_files(config, inputdir):
+    for root, dirs, files in os.walk(inputdir):
+        # Обработка каталога. Смотрим признак рекурсии по подкаталогам
+        if not config.recursive:
+            dirs[:] = []
+
+        for file in files:
+            if file.lower().endswith(('.fb2', '.fb2.zip', '.zip', '.epub')):
+                yield os.path.join(root, file)
+
+
+def delete_source_file(config, inputfile):
+    try:
+        os.remove(inputfile)
+    except:
+        config.log.error('Unable to remove file "{0}"'.format(inputfile))
+
+
+def report_stages(config, log, stages, book=None):
+    if config.profile_stages == 'json':
+        # JSON lines go to stdout, so they are not mixed with log messages
+        print(stages.to_json(book), flush=True)
+    else:
+        if book:
+            log.info('Conversion stages of "{0}":'.format(os.path.split(book)[1]))
+        else:
+            log.info('Conversion stages of {0} books:'.format(stages.books))
+        for line in stages.format_table():
+            log.info(line)
+
+
+def book_stages(config, log, inputfile, stages, total_stages):
+    if config.profile_stages:
+        report_stages(config, log, stages, inputfile)
+        if total_stages is not None:
+            total_stages.add_book(stages)
+
+
+def file_processed(config, inputfile, result, manifest):
+    # Source of failed conversion is kept: there is no output and no manifest record for it
+    if not isinstance(result, str):
+        return
+
+    if manifest:
+        outputs = [result]
+        if config.apnx:
+            outputs.append(get_apnx_filename(config, result))
+        manifest.add(inputfile, outputs, bool(config.delete_source_file))
+
+    if config.delete_source_file:
+        delete_source_file(config, inputfile)
+
+
+def process_files_serial(config, input_files, manifest=None, total_stages=None):
+    count = 0
+
+    for inputfile in input_files:
+        try:
+            stages = Stages()
+            result = process_file(config, inputfile, None, stages)
+            if isinstance(result, str):
+                count += 1
+            book_stages(config, config.log, inputfile, stages, total_stages)
+            file_processed(config, inputfile, result, manifest)
+
+        except KeyboardInterrupt as e:
+            print('User interrupt. Exiting...')
+            sys.exit(-1)
+
+        except IOError as e:
+            config.log.error('(I/O error {0}) {1} - {2}'.format(e.errno, e.strerror, e.filename))
+        except:
+            config.log.error('Error processing folder')
+            config.log.debug('Getting details', exc_info=True, stack_info=True)
+
+    return count
+
+
+def process_files_parallel(config, input_files, manifest=None, total_stages=None):
+    count = 0
+
+    # Logger is replaced in every worker process
+    log = config.log
+    config.log = None
+    temp_root = tempfile.mkdtemp()
+
+    try:
+        pool = multiprocessing.Pool(processes=config.jobs, initializer=init_worker, initargs=(config, temp_root))
+        try:
+            # imap returns results in the order of input files, so log output is never mixed up
+            for inputfile, (success, result, records, stages) in zip(input_files, pool.imap(process_file_in_worker, input_files)):
+                for record in records:
+                    log.handle(record)
+                if success:
+                    if isinstance(result, str):
+                        count += 1
+                        send_book(config, result, log)
+                    book_stages(config, log, inputfile, stages, total_stages)
+                    file_processed(config, inputfile, result, manifest)
+
+            pool.close()
+
+        except KeyboardInterrupt:
+            pool.terminate()
+            print('User interrupt. Exiting...')
+            sys.exit(-1)
+
+        except:
+            pool.terminate()
+            log.error('Error processing folder')
+            log.debug('Getting details', exc_info=True, stack_info=True)
+
+        pool.join()
+
+    finally:
+        config.log = log
+        shutil.rmtree(temp_root, ignore_errors=True)
+
+    return count
+
 
 def process_folder(config, inputdir, outputdir=None):
     if outputdir:
@@ -380,30 +641,35 @@ def process_folder(config, inputdir, outputdir=None):
             os.makedirs(outputdir)
 
     if os.path.isdir(inputdir):
-        for root, dirs, files in os.walk(inputdir):
-            for file in files:
-                try:
-                    if file.lower().endswith(('.fb2', '.fb2.zip', '.zip', '.epub')):
-                        inputfile = os.path.join(root, file)
-                        # Обработка каталога. Смотрим признак рекурсии по подкаталогам
-                        if (not config.recursive and inputdir == root) or config.recursive:
-                            process_file(config, inputfile, None)
-                            if config.delete_source_file:
-                                try:
-                                    os.remove(inputfile)
-                                except:
-                                    config.log.error('Unable to remove file "{0}"'.format(inputfile))
-
-                            continue
-                except KeyboardInterrupt as e:
-                    print('User interrupt. Exiting...')
-                    sys.exit(-1)
-
-                except IOError as e:
-                    config.log.error('(I/O error {0}) {1} - {2}'.format(e.errno, e.strerror, e.filename))
-                except:
-                    config.log.error('Error processing folder')
-                    config.log.debug('Getting details', exc_info=True, stack_info=True)
+        start_time = time.perf_counter()
+
+        input_files = list(get_folder_files(config, inputdir))
+
+        manifest = None
+        if config.incremental:
+            manifest = ConversionManifest(os.path.join(config.output_dir if config.output_dir else inputdir, MANIFEST_NAME),
+                                          get_settings_hash(config), config.log)
+            removed = manifest.remove_vanished(inputdir)
+            changed_files = [f for f in input_files if manifest.is_changed(f)]
+            config.log.info('{0} of {1} files are new or changed, {2} removed.'.format(len(changed_files), len(input_files), removed))
+            input_files = changed_files
+
+        total_stages = Stages(books=0)
+        try:
+            if config.jobs > 1 and len(input_files) > 1:
+                config.log.info('Converting {0} files using {1} processes...'.format(len(input_files), config.jobs))
+                count = process_files_parallel(config, input_files, manifest, total_stages)
+            else:
+                count = process_files_serial(config, input_files, manifest, total_stages)
+        finally:
+            if manifest:
+                manifest.save()
+
+        elapsed = time.perf_counter() - start_time
+        config.log.info('Processed {0} of {1} files in {2} sec ({3} books/sec).'.format(count, len(input_files), round(elapsed, 2),
+                                                                                     round(count / elapsed, 2) if elapsed > 0 else 0))
+        if config.profile_stages and total_stages.books:
+            report_stages(config, config.log, total_stages)
 
     else:
         config.log.critical('Unable to find directory "{0}"'.format(inputdir))
@@ -460,6 +726,14 @@ def process(args):
             config.recursive = True
         if args.nc:
             config.mhl = True
+        if args.jobs is not None:
+            config.jobs = args.jobs if args.jobs > 0 else multiprocessing.cpu_count()
+        if args.incremental:
+            config.incremental = True
+        if args.cachedir:
+            config.cache_dir = os.path.abspath(args.cachedir)
+        if args.profilestages:
+            config.profile_stages = args.profilestages
 
     log = logging.getLogger('fb2mobi')
     log.setLevel("DEBUG")
@@ -498,6 +772,10 @@ def process(args):
             config.screen_height = args.screen_height
         if args.kindlecompressionlevel:
             config.kindle_compression_level = args.kindlecompressionlevel
+        if args.kindlegentimeout is not None:
+            config.kindlegen_timeout = args.kindlegentimeout
+        if args.kindlegenjobs is not None:
+            config.kindlegen_jobs = args.kindlegenjobs
         if args.css:
             config.current_profile['css'] = args.css
         if args.xslt:
@@ -528,8 +806,18 @@ def process(args):
             config.current_profile['seriesPositions'] = args.seriespositions
         if args.removepngtransparency is not None:
             config.current_profile['removePngTransparency'] = args.removepngtransparency
+        if args.optimizeimages is not None:
+            config.current_profile['optimizeImages'] = args.optimizeimages
+        if args.jpegquality is not None:
+            config.current_profile['jpegQuality'] = args.jpegquality
+        if args.grayscaleimages is not None:
+            config.current_profile['grayscaleImages'] = args.grayscaleimages
+        if args.normalizedashes is not None:
+            config.current_profile['normalizeDashes'] = args.normalizedashes
         if args.noMOBIoptimization:
             config.noMOBIoptimization = args.noMOBIoptimization
+        if args.streamparsing is not None:
+            config.stream_parsing = args.streamparsing
         if args.sendtokindle is not None:
             config.send_to_kindle['send'] = args.sendtokindle
         if args.inputdir:
@@ -548,6 +836,8 @@ def process(args):
 
     if args.inputdir:
         process_folder(config, args.inputdir, args.outputdir)
+        evict_cache(config)
+        finish_sending(config)
         if args.deleteinputdir:
             try:
                 rm_tmp_files(args.inputdir, False)
@@ -555,8 +845,14 @@ def process(args):
                 log.error('Unable to remove directory "{0}"'.format(args.inputdir))
 
     elif infile:
-        process_file(config, infile, outfile)
-        if args.deletesourcefile:
+        stages = Stages()
+        result = process_file(config, infile, outfile, stages)
+        evict_cache(config)
+        finish_sending(config)
+        if config.profile_stages:
+            report_stages(config, log, stages, infile)
+        # Source of failed conversion is kept
+        if args.deletesourcefile and isinstance(result, str):
             try:
                 os.remove(infile)
             except:
@@ -568,6 +864,9 @@ def process(args):
 
 if __name__ == '__main__':
 
+    # Required for process pool in frozen executables
+    multiprocessing.freeze_support()
+
     # Настройка парсера аргументов
     argparser = argparse.ArgumentParser(
         description='Converter of fb2 and epub ebooks to mobi, azw3 and epub formats. Version {0}'.format(
@@ -587,6 +886,17 @@ if __name__ == '__main__':
                            help='Keep directory structure during batch processing')
     argparser.add_argument('--delete-source-file', dest='deletesourcefile', action='store_true', default=False, help='In case of success remove source file')
     argparser.add_argument('--delete-input-dir', dest='deleteinputdir', action='store_true', default=False, help='Remove source directory')
+    profilestages_group = argparser.add_mutually_exclusive_group()
+    profilestages_group.add_argument('--profile-stages', dest='profilestages', action='store_const', const='table', default=None,
+                                     help='Log table with time of conversion stages for every book and for the whole batch')
+    profilestages_group.add_argument('--profile-stages-json', dest='profilestages', action='store_const', const='json', default=None,
+                                     help='Print time of conversion stages for every book and for the whole batch as JSON lines')
+    argparser.add_argument('-j', '--jobs', dest='jobs', type=int, default=None,
+                           help='Number of books to convert in parallel during batch processing (0 - number of processors)')
+    argparser.add_argument('--incremental', dest='incremental', action='store_true', default=None,
+                           help='Convert only new and changed books, remove books which sources were removed (batch processing only)')
+    argparser.add_argument('--cache-dir', dest='cachedir', type=str, default=None,
+                           help='Directory for conversion cache, unchanged books are not converted again')
 
     argparser.add_argument('-d', '--debug', action='store_true', default=None, help='Keep imtermediate files in desctination directory')
     argparser.add_argument('--log', type=str, default=None, help='Log file name')
@@ -615,9 +925,17 @@ if __name__ == '__main__':
     screen_group.add_argument('--screen-height', dest='screen_height', type=int, default=None, help='Target screen height')
 
     argparser.add_argument('--kindle-compression-level', dest='kindlecompressionlevel', type=int, default=None, help='Kindlegen compression level - 0, 1, 2')
+    argparser.add_argument('--kindlegen-timeout', dest='kindlegentimeout', type=int, default=None, help='Stop kindlegen after this number of seconds (0 - no limit)')
+    argparser.add_argument('--kindlegen-jobs', dest='kindlegenjobs', type=int, default=None,
+                           help='Maximum number of kindlegen processes running at once (0 - number of CPUs)')
     argparser.add_argument('-p', '--profile', type=str, default=None, help='Profile name from configuration')
     argparser.add_argument('--no-MOBI-optimization', dest='noMOBIoptimization', action='store_true', default=False,
                            help='Do not do anything with resulting mobi file (Old behavior)')
+    streamparsing_group = argparser.add_mutually_exclusive_group()
+    streamparsing_group.add_argument('--stream-parsing', dest='streamparsing', action='store_true', default=None,
+                                     help='Parse source fb2 incrementally keeping only current chapter in memory (ignored when xslt is used)')
+    streamparsing_group.add_argument('--no-stream-parsing', dest='streamparsing', action='store_false', default=None,
+                                     help='Load complete source fb2 in memory before conversion')
     argparser.add_argument('--css', type=str, default=None, help='css file name')
     argparser.add_argument('--xslt', type=str, default=None, help='xslt file name')
     argparser.add_argument('--dropcaps', dest='dropcaps', type=str, default=None, choices=['Simple', 'Smart', 'None'],
@@ -659,6 +977,24 @@ if __name__ == '__main__':
     pngtransparency_group.add_argument('--no-remove-png-transparency', dest='removepngtransparency', action='store_false', default=None,
                                        help='Do not remove transparency in PNG images')
 
+    optimizeimages_group = argparser.add_mutually_exclusive_group()
+    optimizeimages_group.add_argument('--optimize-images', dest='optimizeimages', action='store_true', default=None,
+                                      help='Downscale images bigger than screen and convert opaque PNG images to JPEG')
+    optimizeimages_group.add_argument('--no-optimize-images', dest='optimizeimages', action='store_false', default=None,
+                                      help='Do not optimize images')
+    argparser.add_argument('--jpeg-quality', dest='jpegquality', type=int, default=None, help='Quality of JPEG images produced by optimization (1-95)')
+
+    grayscale_group = argparser.add_mutually_exclusive_group()
+    grayscale_group.add_argument('--grayscale-images', dest='grayscaleimages', action='store_true', default=None,
+                                 help='Convert images to grayscale when optimizing (for eInk devices)')
+    grayscale_group.add_argument('--no-grayscale-images', dest='grayscaleimages', action='store_false', default=None,
+                                 help='Keep colors of images')
+
+    dashes_group = argparser.add_mutually_exclusive_group()
+    dashes_group.add_argument('--normalize-dashes', dest='normalizedashes', action='store_true', default=None,
+                              help='Start paragraphs of direct speech with en dash and six-per-em space (same as spaces.xsl)')
+    dashes_group.add_argument('--no-normalize-dashes', dest='normalizedashes', action='store_false', default=None,
+                              help='Do not change dashes at the beginning of paragraphs')
 
     # Для совместимости с MyHomeLib добавляем аргументы, которые передает MHL в fb2mobi.exe
     argparser.add_argument('-nc', action='store_true', default=False, help='For MyHomeLib compatibility')
@@ -7,6 +7,24 @@ from importlib import import_module
 import os, codecs
 
 
+def parse_extensions(text):
+    # List of file extensions separated by spaces or commas: ".jpg .png" or "jpg, png"
+    result = []
+    for ext in (text or '').replace(',', ' ').split():
+        ext = ext.lower()
+        result.append(ext if ext.startswith('.') else '.' + ext)
+    return result
+
+
+def parse_compression_level(text):
+    # zlib accepts levels 0-9 only, other values would fail in the middle of writing epub
+    level = int(text)
+    if not 0 <= level <= 9:
+        level = min(max(level, 0), 9)
+        print('***WARNING: Parameter epubCompressionLevel should be between 0 and 9, using {0}.'.format(level))
+    return level
+
+
 class ConverterConfig:
     def __init__(self, config_file):
         self.config_file = config_file
@@ -18,10 +36,20 @@ class ConverterConfig:
         self.console_level = 'Info'
         self.output_format = 'epub'
         self.kindle_compression_level = 1
+        self.kindlegen_timeout = 0
+        self.kindlegen_jobs = 0
+        self.epub_compression_level = 6
+        self.epub_stored_media = ['.jpg', '.jpeg', '.png', '.gif', '.ttf', '.otf']
         self.no_dropcaps_symbols = '\'"-.…0123456789‒–—«»'
         self.transliterate = False
         self.transliterate_author_and_title = False
         self.noMOBIoptimization = False
+        self.stream_parsing = False
+        self.hyphen_cache_size = 50000
+        self.image_threads = 4
+        self.cache_dir = None
+        self.original_cache_dir = None
+        self.cache_max_size = 1024
         self.screen_height = 800
         self.screen_width = 573
         self.default_profile = 'default'
@@ -70,6 +98,10 @@ class ConverterConfig:
         self.profiles['default']['generateOPFGuide'] = True
         self.profiles['default']['kindleRemovePersonalLabel'] = True
         self.profiles['default']['removePngTransparency'] = False
+        self.profiles['default']['optimizeImages'] = False
+        self.profiles['default']['jpegQuality'] = 85
+        self.profiles['default']['grayscaleImages'] = False
+        self.profiles['default']['normalizeDashes'] = False
         self.profiles['default']['generateAPNX'] = None
         self.profiles['default']['charactersPerPage'] = 2300
         self.profiles['default']['seriesPositions'] = 2
@@ -78,6 +110,9 @@ class ConverterConfig:
         self.current_profile = {}
         self.mhl = False
         self.recursive = False
+        self.jobs = 1
+        self.incremental = False
+        self.profile_stages = None
 
         self.send_to_kindle = {}
         self.send_to_kindle['send'] = False
@@ -88,6 +123,9 @@ class ConverterConfig:
         self.send_to_kindle['smtpPassword'] = None
         self.send_to_kindle['fromUserEmail'] = '[Your Google Email]'
         self.send_to_kindle['toKindleEmail'] = '[Your Kindle Email]'
+        self.send_to_kindle['maxAttachmentsSize'] = 15  # Мегабайт, после кодирования в base64 сообщение вырастет на треть
+        self.send_to_kindle['retries'] = 3
+        self.send_to_kindle['retryDelay'] = 10
 
         if not os.path.exists(self.config_file):
             # Если файл настроек отсутствует, созданим файл по-умолчанию
@@ -123,6 +161,18 @@ class ConverterConfig:
             elif e.tag == 'kindleCompressionLevel':
                 self.kindle_compression_level = int(e.text)
 
+            elif e.tag == 'kindlegenTimeout':
+                self.kindlegen_timeout = int(e.text)
+
+            elif e.tag == 'kindlegenJobs':
+                self.kindlegen_jobs = int(e.text)
+
+            elif e.tag == 'epubCompressionLevel':
+                self.epub_compression_level = parse_compression_level(e.text)
+
+            elif e.tag == 'epubStoredMedia':
+                self.epub_stored_media = parse_extensions(e.text)
+
             elif e.tag == 'noDropcapsSymbols':
                 self.no_dropcaps_symbols = e.text
 
@@ -141,6 +191,23 @@ class ConverterConfig:
             elif e.tag == 'noMOBIoptimization':
                 self.noMOBIoptimization = e.text.lower() == 'true'
 
+            elif e.tag == 'streamParsing':
+                self.stream_parsing = e.text.lower() == 'true'
+
+            elif e.tag == 'hyphenCacheSize':
+                self.hyphen_cache_size = int(e.text)
+
+            elif e.tag == 'imageThreads':
+                self.image_threads = int(e.text)
+
+            elif e.tag == 'cacheDir':
+                if e.text:
+                    self.original_cache_dir = e.text
+                    self.cache_dir = os.path.abspath(os.path.join(os.path.abspath(os.path.dirname(self.config_file)), e.text))
+
+            elif e.tag == 'cacheMaxSize':
+                self.cache_max_size = int(e.text)
+
             elif e.tag == 'sendToKindle':
                 for s in e:
                     if s.tag == 'send':
@@ -167,6 +234,15 @@ class ConverterConfig:
                     elif s.tag == 'toKindleEmail':
                         self.send_to_kindle['toKindleEmail'] = s.text
 
+                    elif s.tag == 'maxAttachmentsSize':
+                        self.send_to_kindle['maxAttachmentsSize'] = float(s.text)
+
+                    elif s.tag == 'retries':
+                        self.send_to_kindle['retries'] = int(s.text)
+
+                    elif s.tag == 'retryDelay':
+                        self.send_to_kindle['retryDelay'] = float(s.text)
+
             elif e.tag == 'profiles':
                 self.profiles = {}
                 for prof in e:
@@ -181,6 +257,10 @@ class ConverterConfig:
                     self.profiles[prof_name]['tocType'] = 'Normal'
                     self.profiles[prof_name]['kindleRemovePersonalLabel'] = True
                     self.profiles[prof_name]['removePngTransparency'] = False
+                    self.profiles[prof_name]['optimizeImages'] = False
+                    self.profiles[prof_name]['jpegQuality'] = 85
+                    self.profiles[prof_name]['grayscaleImages'] = False
+                    self.profiles[prof_name]['normalizeDashes'] = False
                     self.profiles[prof_name]['generateAPNX'] = None
                     self.profiles[prof_name]['charactersPerPage'] = 2300
                     self.profiles[prof_name]['tocMaxLevel'] = 1000
@@ -211,6 +291,12 @@ class ConverterConfig:
                         elif p.tag == 'screenHeight':
                             self.profiles[prof_name]['screenHeight'] = int(p.text)
 
+                        elif p.tag == 'epubCompressionLevel':
+                            self.profiles[prof_name]['epubCompressionLevel'] = parse_compression_level(p.text)
+
+                        elif p.tag == 'epubStoredMedia':
+                            self.profiles[prof_name]['epubStoredMedia'] = parse_extensions(p.text)
+
                         elif p.tag == 'transliterateAuthorAndTitle':
                             self.profiles[prof_name]['transliterateAuthorAndTitle'] = p.text.lower() == 'true'
 
@@ -236,6 +322,18 @@ class ConverterConfig:
                         elif p.tag == 'removePngTransparency':
                             self.profiles[prof_name]['removePngTransparency'] = p.text.lower() == 'true'
 
+                        elif p.tag == 'optimizeImages':
+                            self.profiles[prof_name]['optimizeImages'] = p.text.lower() == 'true'
+
+                        elif p.tag == 'jpegQuality':
+                            self.profiles[prof_name]['jpegQuality'] = int(p.text)
+
+                        elif p.tag == 'grayscaleImages':
+                            self.profiles[prof_name]['grayscaleImages'] = p.text.lower() == 'true'
+
+                        elif p.tag == 'normalizeDashes':
+                            self.profiles[prof_name]['normalizeDashes'] = p.text.lower() == 'true'
+
                         elif p.tag == 'generateAPNX':
                             if p.text.lower() in ['eink', 'pc']:
                                 self.profiles[prof_name]['generateAPNX'] = p.text.lower()
@@ -355,6 +453,10 @@ class ConverterConfig:
                             E('generateOPFGuide', str(self.profiles[p]['generateOPFGuide'])),
                             E('kindleRemovePersonalLabel', str(self.profiles[p]['kindleRemovePersonalLabel'])),
                             E('removePngTransparency', str(self.profiles[p]['removePngTransparency'])),
+                            E('optimizeImages', str(self.profiles[p]['optimizeImages'])),
+                            E('jpegQuality', str(self.profiles[p]['jpegQuality'])),
+                            E('grayscaleImages', str(self.profiles[p]['grayscaleImages'])),
+                            E('normalizeDashes', str(self.profiles[p]['normalizeDashes'])),
                             E('charactersPerPage', str(self.profiles[p]['charactersPerPage'])),
                             E('seriesPositions', str(self.profiles[p]['seriesPositions'])),
                             E('openBookFromCover', str(self.profiles[p]['openBookFromCover'])),
@@ -390,6 +492,12 @@ class ConverterConfig:
         if 'charactersPerPage' in self.current_profile:
             self.characters_per_page = self.current_profile['charactersPerPage']
 
+        if 'epubCompressionLevel' in self.current_profile:
+            self.epub_compression_level = self.current_profile['epubCompressionLevel']
+
+        if 'epubStoredMedia' in self.current_profile:
+            self.epub_stored_media = self.current_profile['epubStoredMedia']
+
     def write(self):
         config = E('settings',
                    E('debug', str(self.debug)),
@@ -398,12 +506,21 @@ class ConverterConfig:
                    E('consoleLevel', self.console_level),
                    E('outputFormat', self.output_format),
                    E('kindleCompressionLevel', str(self.kindle_compression_level)),
+                   E('kindlegenTimeout', str(self.kindlegen_timeout)),
+                   E('kindlegenJobs', str(self.kindlegen_jobs)),
+                   E('epubCompressionLevel', str(self.epub_compression_level)),
+                   E('epubStoredMedia', ' '.join(self.epub_stored_media)),
                    E('noDropcapsSymbols', self.no_dropcaps_symbols),
                    E('transliterate', str(self.transliterate)),
                    E('screenWidth', str(self.screen_width)),
                    E('screenHeight', str(self.screen_height)),
                    E('defaultProfile', self.default_profile),
                    E('noMOBIoptimization', str(self.noMOBIoptimization)),
+                   E('streamParsing', str(self.stream_parsing)),
+                   E('hyphenCacheSize', str(self.hyphen_cache_size)),
+                   E('imageThreads', str(self.image_threads)),
+                   E('cacheDir', self.original_cache_dir) if self.original_cache_dir else E('cacheDir'),
+                   E('cacheMaxSize', str(self.cache_max_size)),
                    E('profiles',
                      *self._getProfiles()
                      ),
@@ -415,7 +532,10 @@ class ConverterConfig:
                      E('smtpLogin', self.send_to_kindle['smtpLogin']),
                      E('smtpPassword', self.send_to_kindle['smtpPassword']) if self.send_to_kindle['smtpPassword'] else E('smtpPassword'),
                      E('fromUserEmail', self.send_to_kindle['fromUserEmail']),
-                     E('toKindleEmail', self.send_to_kindle['toKindleEmail'])
+                     E('toKindleEmail', self.send_to_kindle['toKindleEmail']),
+                     E('maxAttachmentsSize', str(self.send_to_kindle['maxAttachmentsSize'])),
+                     E('retries', str(self.send_to_kindle['retries'])),
+                     E('retryDelay', str(self.send_to_kindle['retryDelay']))
                      ),
                    )
 
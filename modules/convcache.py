@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import hashlib
+
+import version
+
+BOOK_NAME = 'book'
+APNX_NAME = 'book.apnx'
+
+
+def hash_file(sha, filename):
+    if filename and os.path.isfile(filename):
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+    else:
+        sha.update(b'\0')
+
+
+def link_or_copy(src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def get_settings_hash(config):
+    '''Hash of all settings and files affecting conversion result'''
+    sha = hashlib.sha1()
+
+    profile = dict(config.current_profile)
+    if config.output_format.lower() == 'epub':
+        # Для epub всегда разбиваем по главам
+        profile['chapterOnNewPage'] = True
+
+    settings = {'version': version.VERSION,
+                'profile': profile,
+                'output_format': config.output_format.lower(),
+                'screen_width': config.screen_width,
+                'screen_height': config.screen_height,
+                'kindle_compression_level': config.kindle_compression_level,
+                'epub_compression_level': config.epub_compression_level,
+                'epub_stored_media': config.epub_stored_media,
+                'no_dropcaps_symbols': config.no_dropcaps_symbols,
+                'transliterate_author_and_title': config.transliterate_author_and_title,
+                'characters_per_page': config.characters_per_page,
+                'noMOBIoptimization': config.noMOBIoptimization,
+                'apnx': config.apnx}
+    sha.update(json.dumps(settings, sort_keys=True, default=str).encode('utf-8'))
+
+    hash_file(sha, profile['css'])
+    hash_file(sha, profile.get('xslt'))
+    for level in sorted(profile['vignettes']):
+        for name in sorted(profile['vignettes'][level]):
+            hash_file(sha, profile['vignettes'][level][name])
+
+    return sha.hexdigest()
+
+
+class ConversionCache:
+    '''Content addressed cache of converted books.
+
+    Every entry is a directory named by the key, which contains resulting book and page index (if any).
+    Entries are evicted in order of last use when total size exceeds max_size (in megabytes).
+    Size is checked by evict() once at the end of run, not after every stored book.
+    '''
+
+    def __init__(self, cache_dir, max_size, log):
+        self.cache_dir = cache_dir
+        self.max_size = max_size * 1024 * 1024
+        self.log = log
+
+    def get_key(self, config, infile):
+        sha = hashlib.sha1()
+        hash_file(sha, infile)
+        sha.update(get_settings_hash(config).encode('ascii'))
+        return sha.hexdigest()
+
+    def get_entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def restore(self, key, outfile, apnxfile):
+        entry_dir = self.get_entry_dir(key)
+        book = os.path.join(entry_dir, BOOK_NAME)
+        if not os.path.isfile(book):
+            return False
+
+        apnx = os.path.join(entry_dir, APNX_NAME)
+        try:
+            link_or_copy(book, outfile)
+            if apnxfile and os.path.isfile(apnx):
+                apnx_dir = os.path.dirname(apnxfile)
+                if apnx_dir and not os.path.exists(apnx_dir):
+                    os.makedirs(apnx_dir)
+                link_or_copy(apnx, apnxfile)
+            # Время последнего использования для вытеснения
+            os.utime(entry_dir)
+        except OSError:
+            self.log.warning('Unable to restore book from conversion cache')
+            self.log.debug('Getting details', exc_info=True)
+            return False
+
+        return True
+
+    def store(self, key, outfile, apnxfile):
+        entry_dir = self.get_entry_dir(key)
+        temp_dir = entry_dir + '.tmp{0}'.format(os.getpid())
+        try:
+            if os.path.exists(temp_dir):
+                shutil.rmtree(temp_dir)
+            os.makedirs(temp_dir)
+            # Copies, not links - output files could be rewritten in place later
+            shutil.copyfile(outfile, os.path.join(temp_dir, BOOK_NAME))
+            if apnxfile and os.path.isfile(apnxfile):
+                shutil.copyfile(apnxfile, os.path.join(temp_dir, APNX_NAME))
+
+            # Entry appears at once, so parallel conversions never see it half written
+            if os.path.exists(entry_dir):
+                shutil.rmtree(entry_dir)
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            self.log.warning('Unable to store book in conversion cache')
+            self.log.debug('Getting details', exc_info=True)
+            return
+
+    def evict(self):
+        if not os.path.isdir(self.cache_dir):
+            return
+
+        entries = []
+        total_size = 0
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                if '.tmp' in key:
+                    continue
+                entry_dir = os.path.join(prefix_dir, key)
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+                    entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+                except OSError:
+                    continue
+                total_size += size
+
+        entries.sort()
+        for mtime, size, entry_dir in entries:
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+            self.log.debug('Removed "{0}" from conversion cache'.format(os.path.basename(entry_dir)))
@@ -2,11 +2,13 @@
 
 import os
 import html
+import time
 import uuid
 
 from lxml import etree
 from modules.utils import transliterate, indent
 from modules.myhyphen import MyHyphen
+from modules.stages import Stages
 
 
 def save_html(string):
@@ -19,6 +21,7 @@ def save_html(string):
 class EpubProc:
     def __init__(self, opffile, config):
         self.buff = []
+        self.stages = Stages()  # Время и счетчики этапов обработки
 
         self.book_title = ''  # Название книги
         self.book_author = ''  # Автор
@@ -39,13 +42,20 @@ class EpubProc:
 
         self.book_uuid = uuid.uuid4()
 
-        self.tree = etree.parse(opffile, parser=etree.XMLParser(recover=True))
+        with self.stages.timer('load'):
+            self.tree = etree.parse(opffile, parser=etree.XMLParser(recover=True))
         self.root = self.tree.getroot()
 
     def insert_hyphenation(self, s):
         if not s:
             return ''
-        return html.unescape(s) if not self.hyphenator or not self.hyphenate else self.hyphenator.hyphenate_text(html.unescape(s), self.replaceNBSP)
+        if not self.hyphenator or not self.hyphenate:
+            return html.unescape(s)
+
+        start = time.perf_counter()
+        result = self.hyphenator.hyphenate_text(html.unescape(s), self.replaceNBSP)
+        self.stages.add_time('xhtml.hyphenate', time.perf_counter() - start)
+        return result
 
     def process(self):
 
@@ -90,6 +100,10 @@ class EpubProc:
         indent(self.root)
         self.tree.write(self.opffile, encoding='utf-8', method='xml', xml_declaration=True)
 
+        with self.stages.timer('xhtml'):
+            self.process_items()
+
+    def process_items(self):
         # See if we have items to correct and process
         for node in self.root.iter('{*}item'):
             attributes = node.attrib
@@ -97,6 +111,7 @@ class EpubProc:
                 if attributes['media-type'] == 'application/xhtml+xml':
                     filename = os.path.join(self.path, attributes['href'])
                     self.log.debug('Processing {}'.format(filename))
+                    self.stages.count('xhtml_files')
                     # Proper XML encoding needed by kndlegen
                     xhtml = etree.parse(filename, parser=etree.XMLParser(recover=True))
                     if self.hyphenate:
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+# Быстрое чтение метаданных fb2: документ разбирается только до первого <body>,
+# текст книги и картинки не читаются.
+
+import re
+import base64
+import zipfile
+
+from lxml import etree
+
+READ_CHUNK = 256 * 1024
+
+BINARY_TAG = re.compile(rb'<(?:[\w.-]+:)?binary\b[^>]*>')
+BINARY_ID = re.compile(rb'''\sid\s*=\s*["']([^"']*)["']''')
+
+
+class Author():
+    def __init__(self):
+        self.first_name = ''
+        self.middle_name = ''
+        self.last_name = ''
+
+
+class Sequence():
+    def __init__(self):
+        self.name = ''
+        self.number = None
+
+
+class Fb2Description():
+    def __init__(self):
+        self.title = ''
+        self.authors = []
+        self.lang = ''
+        self.genres = []
+        self.sequences = []
+        self.cover = ''  # id of <binary> with cover
+        self.book_id = ''
+        self.cover_data = None  # Read only on request
+        self.element = None  # <description>, its parent is root of the document
+
+
+def localname(tag):
+    if tag is etree.Comment or tag is etree.PI:
+        return ''
+    return tag.split('}', 1)[1] if tag[0] == '{' else tag
+
+
+def get_zip_member(zfile):
+    # Книга - первый fb2 файл архива, если такого нет - первый файл
+    names = [n for n in zfile.namelist() if not n.endswith('/')]
+    if not names:
+        raise ValueError('Archive "{0}" is empty'.format(zfile.filename))
+    return next((n for n in names if n.lower().endswith('.fb2')), names[0])
+
+
+def parse_title_info(desc, elem):
+    for e in elem:
+        tag = localname(e.tag)
+        if tag == 'book-title':
+            desc.title = e.text or ''
+        elif tag == 'author':
+            author = Author()
+            for a in e:
+                if localname(a.tag) == 'first-name':
+                    author.first_name = a.text
+                elif localname(a.tag) == 'middle-name':
+                    author.middle_name = a.text
+                elif localname(a.tag) == 'last-name':
+                    author.last_name = a.text
+            desc.authors.append(author)
+        elif tag == 'genre':
+            desc.genres.append(e.text)
+        elif tag == 'lang':
+            desc.lang = (e.text or '').strip()
+        elif tag == 'sequence':
+            seq = Sequence()
+            seq.name = e.attrib.get('name', '')
+            seq.number = e.attrib.get('number')
+            desc.sequences.append(seq)
+        elif tag == 'coverpage':
+            for c in e:
+                if localname(c.tag) == 'image':
+                    for a in c.attrib:
+                        if localname(a) == 'href':
+                            desc.cover = c.attrib[a][1:]
+                            break
+
+
+def parse_description(f, desc):
+    for event, elem in etree.iterparse(f, events=('start', 'end'), recover=True):
+        if event == 'start':
+            # Описание всегда идет перед текстом книги
+            if localname(elem.tag) == 'body':
+                break
+        elif localname(elem.tag) == 'description':
+            desc.element = elem
+            break
+
+    if desc.element is None:
+        return
+
+    for e in desc.element:
+        if localname(e.tag) == 'title-info':
+            parse_title_info(desc, e)
+        elif localname(e.tag) == 'document-info':
+            for i in e:
+                if localname(i.tag) == 'id':
+                    desc.book_id = (i.text or '').strip()
+                    break
+
+
+def find_binary(f, binary_id):
+    '''Finds <binary> with given id by scanning raw bytes of document, without parsing text of the book.
+    Binary ids and base64 data are ascii, so any ascii compatible encoding of document would do.
+    '''
+    binary_id = binary_id.encode('utf-8')
+    data = b''
+    start = None
+
+    for chunk in iter(lambda: f.read(READ_CHUNK), b''):
+        data += chunk
+        if start is None:
+            pos = 0
+            for m in BINARY_TAG.finditer(data):
+                pos = m.end()
+                found = BINARY_ID.search(m.group())
+                if found and found.group(1) == binary_id:
+                    start = m.end()
+                    break
+            if start is None:
+                # Unfinished tag could be at the end of chunk, it is kept for the next one
+                tail = data.rfind(b'<', pos)
+                data = data[tail:] if tail >= 0 else b''
+                continue
+            data = data[start:]
+
+        end = data.find(b'<')
+        if end >= 0:
+            return base64.b64decode(data[:end])
+
+    return None
+
+
+def read_fb2_description(path_or_zip, cover=False):
+    '''Reads metadata of fb2 book (name of fb2 or zip file, or opened zipfile.ZipFile).
+    Document is parsed only up to the first <body>, book in archive is read through archive
+    stream without unpacking. If cover is True, data of cover image is read as well:
+    document is scanned for matching <binary> without parsing.
+    '''
+    desc = Fb2Description()
+
+    zfile = None
+    if isinstance(path_or_zip, zipfile.ZipFile):
+        zfile = path_or_zip
+    elif path_or_zip.lower().endswith('.zip'):
+        zfile = zipfile.ZipFile(path_or_zip)
+
+    try:
+        if zfile is not None:
+            name = get_zip_member(zfile)
+            open_book = lambda: zfile.open(name)
+        else:
+            open_book = lambda: open(path_or_zip, 'rb')
+
+        with open_book() as f:
+            parse_description(f, desc)
+
+        if cover and desc.cover:
+            # Поток архива не поддерживает seek, книга читается заново
+            with open_book() as f:
+                desc.cover_data = find_binary(f, desc.cover)
+    finally:
+        if zfile is not None and zfile is not path_or_zip:
+            zfile.close()
+
+    return desc
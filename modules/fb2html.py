@@ -2,7 +2,6 @@
 
 import os, sys
 import re
-import shutil
 import io
 import codecs
 import uuid
@@ -10,13 +9,19 @@ import cssutils
 import base64
 import hashlib
 import html
+import time
 
 from copy import deepcopy
+from functools import partial
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from lxml import etree, objectify
 from PIL import Image
 
 from modules.utils import transliterate, indent
 from modules.myhyphen import MyHyphen
+from modules.output import DirectoryOutput, MIMETYPE
+from modules.stages import Stages
 
 HTMLHEAD = ('<html xmlns="http://www.w3.org/1999/xhtml">'
             '<head>'
@@ -29,6 +34,12 @@ HTMLHEAD = ('<html xmlns="http://www.w3.org/1999/xhtml">'
 HTMLFOOT = ('</body>'
             '</html>')
 
+# Local links in serialized xhtml: <a ... href="#id" ...>
+LINK_HREF = re.compile(rb'(<a\s[^>]*?\bhref=")#([^"]*)(")')
+IMG_SRC = re.compile(rb'(<img\s[^>]*?\bsrc="images/)([^"]*)(")')
+
+FB2_NS = '{http://www.gribuser.ru/xml/fictionbook/2.0}'
+
 
 def ns_tag(tag):
     if tag is not etree.Comment:
@@ -37,6 +48,72 @@ def ns_tag(tag):
     return tag
 
 
+# rupor - this allows for smaller xsl, quicker replacement and allows handling of tags in the paragraphs
+class MyExtElement(etree.XSLTExtension):
+    def execute(self, context, self_node, input_node, output_parent):
+        child = deepcopy(input_node)
+        found = False
+        for elem in child.getiterator():
+            if not found and elem.text is not None:
+                found = True
+                old_text = elem.text
+                elem.text = self_node.text
+                if len(old_text) > 1:
+                    i = 1
+                    for c in old_text[1:]:
+                        if c.isspace():
+                            i += 1
+                        else:
+                            break
+                    elem.text = elem.text + old_text[i:]
+            if not hasattr(elem.tag, 'find'):
+                continue
+            i = elem.tag.find('}')
+            if i >= 0:
+                elem.tag = elem.tag[i + 1:]
+        objectify.deannotate(child, cleanup_namespaces=True)
+        output_parent.append(child)
+
+
+# Compiled XSLT transformations by stylesheet path, shared by all books converted in this process
+xslt_transforms = {}
+
+
+def get_xslt_transform(filename):
+    filename = os.path.abspath(filename)
+    mtime = os.path.getmtime(filename)
+    transform = xslt_transforms.get(filename)
+    # Stylesheet is compiled again if it was changed
+    if transform is None or transform[0] != mtime:
+        transform = (mtime, etree.XSLT(etree.parse(filename), extensions={('fb2mobi_ns', 'katz_tr'): MyExtElement()}))
+        xslt_transforms[filename] = transform
+    return transform[1]
+
+
+# Paragraphs of direct speech start with one of these characters (see spaces.xsl)
+DIALOGUE_START = ('‐', '‑', '−', '–', '—', '―', '…')
+DIALOGUE_DASH = '–\u2006'  # en dash and six-per-em space
+
+
+def normalize_paragraph(p):
+    # Does the same as katz_tr from spaces.xsl: first character of the first text in paragraph
+    # and following spaces are replaced by en dash and six-per-em space
+    for text in p.itertext():
+        if text:
+            if text.startswith(DIALOGUE_START):
+                for e in p.iter():
+                    if e.text is not None:
+                        e.text = DIALOGUE_DASH + e.text[1:].lstrip()
+                        break
+            break
+
+
+def normalize_dashes(root):
+    # Paragraphs in any namespace, books without fb2 namespace are normalized too
+    for p in root.iter('{*}p'):
+        normalize_paragraph(p)
+
+
 def save_html(string):
     if string:
         return html.escape(string, quote=False)
@@ -51,30 +128,13 @@ def sanitize_id(string):
         return ''
 
 
-def write_file(buff, filename):
-    d = os.path.dirname(filename)
-    if not os.path.exists(d):
-        os.makedirs(d)
-
-    with codecs.open(filename, 'w', 'utf-8') as f:
-        f.write(buff)
-
-
-def write_file_bin(buff, filename):
-    d = os.path.dirname(filename)
-    if not os.path.exists(d):
-        os.makedirs(d)
-
-    with open(filename, 'wb') as f:
-        f.write(buff)
-
-
-def copy_file(src, dest):
-    d = os.path.dirname(dest)
-    if not os.path.exists(d):
-        os.makedirs(d)
-
-    shutil.copyfile(src, dest)
+def free_element(elem):
+    # Release memory taken by already processed element and its preceding siblings
+    elem.clear()
+    parent = elem.getparent()
+    if parent is not None:
+        while elem.getprevious() is not None:
+            del parent[0]
 
 
 def format_title(s, seq):
@@ -128,9 +188,11 @@ class TOCStack:
 
 
 class Fb2XHTML:
-    def __init__(self, fb2file, mobifile, tempdir, config):
+    def __init__(self, fb2file, mobifile, tempdir, config, output=None):
 
         self.log = config.log
+        self.stages = Stages()  # Время и счетчики этапов конвертации
+        self.child_handlers = self.get_child_handlers()
 
         self.buff = []
         self.current_header_level = 0  # Уровень текущего заголовка
@@ -184,6 +246,10 @@ class Fb2XHTML:
         self.vignette_files = []
 
         self.removepngtransparency = config.current_profile['removePngTransparency']  # Remove transparency in PNG images
+        self.optimize_images = config.current_profile['optimizeImages']  # Downscale images to screen size, convert opaque PNG to JPEG
+        self.jpeg_quality = config.current_profile['jpegQuality']
+        self.grayscale_images = config.current_profile['grayscaleImages']
+        self.normalize_dashes = config.current_profile['normalizeDashes']
 
         self.annotation_title = config.current_profile['annotationTitle']  # Заголовок для раздела аннотации
         self.toc_title = config.current_profile['tocTitle']  # Заголовок для раздела содержания
@@ -217,8 +283,22 @@ class Fb2XHTML:
         self.temp_dir = tempdir  # Временный каталог для записи промежуточных файлов
         self.temp_content_dir = os.path.join(self.temp_dir, 'OEBPS')
         self.temp_inf_dir = os.path.join(self.temp_dir, 'META-INF')
+        # Куда записываются файлы книги: каталог или zip архив (epub)
+        self.output = output if output is not None else DirectoryOutput(tempdir)
+        # Картинки до description ждут его разбора: пока обложка неизвестна, ее нельзя отличить от остальных
+        self.description_parsed = False
+        self.early_binaries = []
+
+        # Картинки декодируются и обрабатываются в пуле потоков, пока разбирается текст книги
+        self.image_threads = config.image_threads
+        self.image_pool = None
+        self.image_queue = deque()  # Futures in order of discovery, results are written by main thread only
+        self.image_renames = {}  # Images converted to JPEG: old name -> new name
+        self.images_original_size = 0
+        self.images_size = 0
 
         self.html_file_list = []  # Массив для хранения списка сгенерированных xhtml файлов
+        self.xhtml_files = {}  # Serialized xhtml files waiting for links correction
         self.image_file_list = []  # Массив для хранения списка картинок
 
         self.pages_list = {}  # Additional pages per file
@@ -230,48 +310,35 @@ class Fb2XHTML:
 
         self.mobi_file = mobifile
 
-        self.tree = etree.parse(fb2file, parser=etree.XMLParser(recover=True))
-        if 'xslt' in config.current_profile:
+        self.fb2file = fb2file
+        self.stream = config.stream_parsing
+        if self.stream and 'xslt' in config.current_profile:
+            self.log.warning('XSLT transformation requires complete document in memory, streaming mode is turned off')
+            self.stream = False
 
-            # rupor - this allows for smaller xsl, quicker replacement and allows handling of tags in the paragraphs
-            class MyExtElement(etree.XSLTExtension):
-                def execute(self, context, self_node, input_node, output_parent):
-                    child = deepcopy(input_node)
-                    found = False
-                    for elem in child.getiterator():
-                        if not found and elem.text is not None:
-                            found = True
-                            old_text = elem.text
-                            elem.text = self_node.text
-                            if len(old_text) > 1:
-                                i = 1
-                                for c in old_text[1:]:
-                                    if c.isspace():
-                                        i += 1
-                                    else:
-                                        break
-                                elem.text = elem.text + old_text[i:]
-                        if not hasattr(elem.tag, 'find'):
-                            continue
-                        i = elem.tag.find('}')
-                        if i >= 0:
-                            elem.tag = elem.tag[i + 1:]
-                    objectify.deannotate(child, cleanup_namespaces=True)
-                    output_parent.append(child)
+        if self.stream:
+            self.tree = None
+        else:
+            with self.stages.timer('load'):
+                self.tree = etree.parse(fb2file, parser=etree.XMLParser(recover=True))
+            if self.normalize_dashes:
+                with self.stages.timer('dashes'):
+                    normalize_dashes(self.tree.getroot())
 
+        if 'xslt' in config.current_profile:
             config.log.info('Applying XSLT transformations "{0}"'.format(config.current_profile['xslt']))
-            self.transform = etree.XSLT(etree.parse(config.current_profile['xslt']),
-                                        extensions={('fb2mobi_ns', 'katz_tr'): MyExtElement()})
-            self.tree = self.transform(self.tree)
+            with self.stages.timer('xslt'):
+                self.transform = get_xslt_transform(config.current_profile['xslt'])
+                self.tree = self.transform(self.tree)
             for entry in self.transform.error_log:
                 self.log.warning(entry)
 
-        self.root = self.tree.getroot()
+        self.root = self.tree.getroot() if self.tree is not None else None
 
         self.hyphenate = config.current_profile['hyphens']
         if self.hyphenate:
             self.replaceNBSP = config.current_profile['hyphensReplaceNBSP']
-            self.hyphenator = MyHyphen(self.book_lang)
+            self.hyphenator = MyHyphen(self.book_lang, config.hyphen_cache_size)
 
         self.first_body = True  # Признак первого body
         self.font_list = []
@@ -287,38 +354,141 @@ class Fb2XHTML:
         # stdout = sys.stdout
         # sys.stdout = codecs.open('stdout.txt', 'w', 'utf-8')
 
-        for child in self.root:
-            if ns_tag(child.tag) == 'description':
-                self.parse_description(child)
-            elif ns_tag(child.tag) == 'body':
-                self.parse_body(child)
-            elif ns_tag(child.tag) == 'binary':
-                self.parse_binary(child)
-
         if self.removepngtransparency:
-            self.remove_png_transparency()
-        self.correct_links()
-        if self.generate_toc_page:
-            self.generate_toc()
-        self.generate_cover()
-        self.generate_ncx()
+            self.log.info('Removing PNG transparency...')
 
-        if self.css_file:
-            self.copy_css()
+        if self.image_threads > 1:
+            self.image_pool = ThreadPoolExecutor(self.image_threads)
+        try:
+            with self.stages.timer('parse'):
+                if self.stream:
+                    self.parse_stream()
+                else:
+                    # Картинки отдаются в пул потоков до разбора текста, чтобы обрабатывались параллельно с ним
+                    # (в документе они идут после текста). Описание разбирается первым - нужна обложка
+                    for child in self.root:
+                        if ns_tag(child.tag) == 'description':
+                            self.parse_description(child)
+                    for child in self.root:
+                        if ns_tag(child.tag) == 'binary':
+                            # Весь документ и так в памяти, число картинок в очереди не ограничивается
+                            self.parse_binary(child, limit=False)
+                    for child in self.root:
+                        if ns_tag(child.tag) == 'body':
+                            self.parse_body(child)
+
+                # Книга без description
+                self.add_early_binaries()
+
+            if self.hyphenate and self.hyphenator:
+                self.log.debug('Hyphenation cache: {0} hits, {1} misses, {2} words cached.'.format(self.hyphenator.hits, self.hyphenator.misses,
+                                                                                                 len(self.hyphenator.cache.words)))
+                self.stages.count('hyphenation_cache_hits', self.hyphenator.hits)
+                self.stages.count('hyphenation_cache_misses', self.hyphenator.misses)
+
+            # All images must be in place before links to renamed images are corrected, cover is checked and opf is generated
+            with self.stages.timer('images_wait'):
+                self.write_images()
+        finally:
+            if self.image_pool:
+                self.image_pool.shutdown()
+                self.image_pool = None
+
+        if self.optimize_images:
+            self.log.info('Images optimized: {0} KB -> {1} KB, {2} converted to JPEG.'.format(self.images_original_size // 1024, self.images_size // 1024,
+                                                                                         len(self.image_renames)))
+        self.book_cover = self.image_renames.get(self.book_cover, self.book_cover)
+        self.stages.count('images', len(self.image_file_list))
+        self.stages.count('images_original_size', self.images_original_size)
+        self.stages.count('images_size', self.images_size)
+
+        with self.stages.timer('links'):
+            self.correct_links()
+        self.stages.count('xhtml_files', len(self.html_file_list))
+
+        with self.stages.timer('toc'):
+            if self.generate_toc_page:
+                self.generate_toc()
+            self.generate_cover()
+            self.generate_ncx()
+
+        with self.stages.timer('css'):
+            if self.css_file:
+                self.copy_css()
 
-        for v in self.vignette_files:
-            try:
-                copy_file(v, os.path.join(os.path.join(self.temp_content_dir, 'vignettes'), os.path.split(v)[1]))
-            except:
-                self.log.warning('File {} not found.'.format(v))
+            for v in self.vignette_files:
+                try:
+                    self.output.copy(v, 'OEBPS/vignettes/' + os.path.split(v)[1])
+                except:
+                    self.log.warning('File {} not found.'.format(v))
 
-        self.generate_pagemap()
-        self.generate_opf()
-        self.generate_container()
-        self.generate_mimetype()
+        with self.stages.timer('opf'):
+            self.generate_pagemap()
+            self.generate_opf()
+            self.generate_container()
+            self.generate_mimetype()
+        self.stages.count('pages', sum(self.pages_list.values()))
 
         # sys.stdout = stdout
 
+    def parse_stream(self):
+        # Document is parsed incrementally, every element on the top level and every top level
+        # element of the body is processed and released as soon as it is complete, so only
+        # one chapter at a time is kept in memory. Element is complete (including its tail)
+        # when next sibling starts or when parent is closed.
+        level = 0
+        body = None
+        body_content = False
+        pending = None
+
+        for event, elem in etree.iterparse(self.fb2file, events=('start', 'end'), recover=True):
+            if event == 'start':
+                level += 1
+                if level == 2:
+                    if body is not None:
+                        self.end_stream_body(body, body_content)
+                        body = None
+                    if ns_tag(elem.tag) == 'body':
+                        body = elem
+                        body_content = self.begin_body(elem)
+                        pending = None
+                elif level == 3 and body is not None:
+                    if pending is not None:
+                        if body_content:
+                            self.parse_child(pending)
+                        free_element(pending)
+                    elif body_content and body.text:
+                        self.parse_text(body.text)
+                    pending = elem
+            else:
+                if self.normalize_dashes and ns_tag(elem.tag) == 'p':
+                    normalize_paragraph(elem)
+                level -= 1
+                if level == 1:
+                    if elem is body:
+                        if pending is not None:
+                            if body_content:
+                                self.parse_child(pending)
+                            free_element(pending)
+                        elif body_content and body.text:
+                            self.parse_text(body.text)
+                        pending = None
+                    else:
+                        if ns_tag(elem.tag) == 'description':
+                            self.parse_description(elem)
+                        elif ns_tag(elem.tag) == 'binary':
+                            self.parse_binary(elem)
+                        free_element(elem)
+
+        if body is not None:
+            self.end_stream_body(body, body_content)
+
+    def end_stream_body(self, body, body_content):
+        if body_content and body.tail:
+            self.parse_tail(body.tail)
+        self.end_body()
+        free_element(body)
+
     def copy_css(self):
         base_dir = os.path.abspath(os.path.dirname(self.css_file))
         self.font_list = []
@@ -327,16 +497,15 @@ class Fb2XHTML:
             source_file = os.path.abspath(os.path.join(base_dir, url))
 
             if os.path.splitext(url)[1].lower() in ('.ttf', '.otf'):
-                dest_file = os.path.abspath(os.path.join(self.temp_content_dir, 'fonts', os.path.basename(source_file)))
+                dest_file = 'OEBPS/fonts/' + os.path.basename(source_file)
                 new_url = 'fonts/' + os.path.basename(url)
                 self.font_list.append(new_url)
             else:
-                dest_file = os.path.abspath(
-                    os.path.join(self.temp_content_dir, 'images', 'css_' + os.path.basename(source_file)))
+                dest_file = 'OEBPS/images/css_' + os.path.basename(source_file)
                 new_url = 'images/css_' + os.path.basename(url)
 
             try:
-                copy_file(source_file, dest_file)
+                self.output.copy(source_file, dest_file)
             except:
                 self.log.error('File {0}, referred by css, not found.'.format(url))
 
@@ -351,80 +520,177 @@ class Fb2XHTML:
                                          'hyphens': 'none|manual|auto'})
             stylesheet = cssutils.parseFile(self.css_file)
             cssutils.replaceUrls(stylesheet, replace_url)
-            write_file(str(stylesheet.cssText, 'utf-8'), os.path.join(self.temp_content_dir, 'stylesheet.css'))
+            self.output.write('OEBPS/stylesheet.css', stylesheet.cssText)
         else:
-            copy_file(self.css_file, os.path.join(self.temp_content_dir, 'stylesheet.css'))
+            self.output.copy(self.css_file, 'OEBPS/stylesheet.css')
+
+    def process_image(self, img_rel_path, text, is_cover):
+        # Images are processed before they are written, so they are written only once.
+        # Called from image pool threads - must not touch output or change state of converter
+        start = time.perf_counter()
+        data = base64.b64decode(text.encode('ascii'))
+        original_size = len(data)
+        if self.removepngtransparency and os.path.splitext(img_rel_path)[1] == '.png':
+            data = self.remove_png_transparency(img_rel_path, data)
+        if self.optimize_images:
+            img_rel_path, data = self.optimize_image(img_rel_path, data, is_cover)
+        if is_cover:
+            data = self.resize_cover(data, img_rel_path)
+        return img_rel_path, data, original_size, time.perf_counter() - start
+
+    def add_image(self, original_rel_path, img_rel_path, data, original_size, processing_time):
+        # Time of processing in all threads, could be more than wall time
+        self.stages.add_time('images', processing_time)
+        self.output.write('OEBPS/' + img_rel_path, data)
+        self.image_file_list.append(img_rel_path)
+        if img_rel_path != original_rel_path:
+            self.image_renames[original_rel_path] = img_rel_path
+        self.images_original_size += original_size
+        self.images_size += len(data)
+
+    def write_images(self, pending=0):
+        # Processed images are written in order of discovery, no more than pending images are left in queue
+        while len(self.image_queue) > pending or (self.image_queue and self.image_queue[0][1].done()):
+            img_rel_path, future = self.image_queue.popleft()
+            self.add_image(img_rel_path, *future.result())
+
+    def optimize_image(self, img_rel_path, data, is_cover):
+        # Images bigger than screen are downscaled, opaque PNG images are converted to JPEG (and renamed),
+        # images are converted to grayscale if requested. Result is used only when it is smaller.
+        try:
+            img = Image.open(io.BytesIO(data))
+            if img.format not in ('JPEG', 'PNG'):
+                return img_rel_path, data
 
-    def remove_png_transparency(self):
-        self.log.info('Removing PNG transparency...')
-        for img_rel_path in self.image_file_list:
-            if os.path.splitext(img_rel_path)[1] == '.png':
-                self.log.debug('Processing file "{}"'.format(img_rel_path))
+            if is_cover:
+                # Cover must take whole screen height, see resize_cover
+                scale = self.screen_height / img.height
+            else:
+                scale = min(self.screen_width / img.width, self.screen_height / img.height)
 
-                try:
-                    filename = os.path.split(img_rel_path)[1]
-                    img_full_path = os.path.join(self.temp_content_dir, 'images', filename)
-                    img = Image.open(img_full_path)
+            if img.mode in ('RGBA', 'LA'):
+                opaque = img.getchannel('A').getextrema() == (255, 255)
+            else:
+                opaque = 'transparency' not in img.info
+            grayscale = self.grayscale_images and img.mode not in ('L', 'LA', '1')
 
-                    if img.format == 'PNG' and (img.mode in ('RGBA', 'LA') or (img.mode in ('RGB', 'L', 'P') and 'transparency' in img.info)):
+            if scale >= 1 and not grayscale and not (img.format == 'PNG' and opaque):
+                return img_rel_path, data
 
-                        if img.mode == "P" and type(img.info.get("transparency")) is bytes:
-                            img = img.convert("RGBA")
+            self.log.debug('Optimizing file "{}"'.format(img_rel_path))
+            params = {'dpi': img.info['dpi']} if 'dpi' in img.info else {}
 
-                        if img.mode in ("L", "LA"):
-                            bg = Image.new("L", img.size, 255)
-                        else:
-                            bg = Image.new("RGB", img.size, (255, 255, 255))
+            if opaque:
+                img = img.convert('L' if grayscale or img.mode in ('L', 'LA', '1') else 'RGB')
+            elif grayscale or img.mode not in ('RGBA', 'LA'):
+                img = img.convert('LA' if grayscale or img.mode in ('L', '1') else 'RGBA')
 
-                        alpha = img.convert("RGBA").split()[-1]
-                        bg.paste(img, mask=alpha)
+            if scale < 1:
+                img = img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))), Image.LANCZOS)
 
-                        img_temp_path = os.path.splitext(img_full_path)[0] + "-o.png"
-                        bg.save(img_temp_path, dpi=img.info.get("dpi"))
-                        os.replace(img_temp_path, img_full_path)
+            result = io.BytesIO()
+            if opaque:
+                img.save(result, format='JPEG', quality=self.jpeg_quality, optimize=True, **params)
+                if os.path.splitext(img_rel_path)[1].lower() not in ('.jpg', '.jpeg'):
+                    img_rel_path_new = img_rel_path + '.jpg'
+                else:
+                    img_rel_path_new = img_rel_path
+            else:
+                img.save(result, format='PNG', optimize=True, **params)
+                img_rel_path_new = img_rel_path
 
-                except:
-                    self.log.warning('Error while removing transparency in file "{}"'.format(img_rel_path))
-                    self.log.debug('Getting details:', exc_info=True)
+            if result.tell() < len(data):
+                return img_rel_path_new, result.getvalue()
 
-    def correct_links(self):
-        for fl in self.html_file_list:
-            parser = etree.XMLParser(encoding='utf-8')
-            root = etree.parse(os.path.join(self.temp_content_dir, fl), parser).getroot()
+        except:
+            self.log.warning('Error while optimizing file "{}"'.format(img_rel_path))
+            self.log.debug('Getting details:', exc_info=True)
 
-            for elem in root.xpath('//xhtml:a', namespaces={'xhtml': 'http://www.w3.org/1999/xhtml'}):
-                link = elem.get('href', '')
-                if len(link) > 0 and link.startswith('#'):
-                    try:
-                        elem.set('href', self.links_location[link[1:]] + link)
-                    except:
-                        pass
+        return img_rel_path, data
 
-            self.buff = str.replace(str(etree.tostring(root, encoding='utf-8', method='xml', xml_declaration=True), 'utf-8'),' encoding=\'utf-8\'', '', 1)
+    def remove_png_transparency(self, img_rel_path, data):
+        self.log.debug('Processing file "{}"'.format(img_rel_path))
 
-            self.current_file = fl
-            self.write_buff_to_xhtml()
+        try:
+            img = Image.open(io.BytesIO(data))
 
-    def write_buff_to_xhtml(self):
-        filename = os.path.join(self.temp_content_dir, self.current_file)
+            if img.format == 'PNG' and (img.mode in ('RGBA', 'LA') or (img.mode in ('RGB', 'L', 'P') and 'transparency' in img.info)):
+
+                if img.mode == "P" and type(img.info.get("transparency")) is bytes:
+                    img = img.convert("RGBA")
+
+                if img.mode in ("L", "LA"):
+                    bg = Image.new("L", img.size, 255)
+                else:
+                    bg = Image.new("RGB", img.size, (255, 255, 255))
+
+                alpha = img.convert("RGBA").split()[-1]
+                bg.paste(img, mask=alpha)
 
-        if not os.path.exists(self.temp_content_dir):
-            os.makedirs(self.temp_content_dir)
+                result = io.BytesIO()
+                bg.save(result, format='PNG', dpi=img.info.get("dpi"))
+                data = result.getvalue()
 
+        except:
+            self.log.warning('Error while removing transparency in file "{}"'.format(img_rel_path))
+            self.log.debug('Getting details:', exc_info=True)
+
+        return data
+
+    def resize_cover(self, data, img_rel_path):
+        # make sure kindlegen does not complain on cover size and make sure that epub cover takes whole screen
+        im = Image.open(io.BytesIO(data))
+        if im.height < self.screen_height:
+            result = io.BytesIO()
+            im.resize((int(self.screen_height * im.width / im.height), self.screen_height), Image.LANCZOS).save(
+                result, format=Image.registered_extensions().get(os.path.splitext(img_rel_path)[1].lower(), im.format))
+            data = result.getvalue()
+        return data
+
+    def correct_links(self):
+        # Every stored xhtml file is written exactly once - after all link targets are known
+        for fl in self.html_file_list:
+            if fl in self.xhtml_files:
+                xhtml = LINK_HREF.sub(self.resolve_link, self.xhtml_files.pop(fl))
+                if self.image_renames:
+                    xhtml = IMG_SRC.sub(self.resolve_image, xhtml)
+                self.output.write('OEBPS/' + fl, xhtml)
+
+    def resolve_link(self, match):
+        try:
+            location = self.links_location[html.unescape(match.group(2).decode('utf-8'))]
+        except:
+            return match.group(0)
+
+        return match.group(1) + bytes(location, 'utf-8') + b'#' + match.group(2) + match.group(3)
+
+    def resolve_image(self, match):
+        # Images are only renamed by adding extension, so the rest of the name needs no escaping
+        name = 'images/' + html.unescape(match.group(2).decode('utf-8'))
+        if name in self.image_renames:
+            return match.group(1) + match.group(2) + bytes(self.image_renames[name][len(name):], 'utf-8') + match.group(3)
+        return match.group(0)
+
+    def get_buff_xhtml(self):
         parser = etree.XMLParser(encoding='utf-8', remove_blank_text=True)
         xhtml = etree.parse(io.StringIO(self.get_buff()), parser)
         indent(xhtml.getroot())
-        xhtml.write(filename, encoding='utf-8', method='xml', xml_declaration=True, pretty_print=False)
+        return xhtml
+
+    def store_buff_to_xhtml(self):
+        # Links to the other files could not be resolved yet, so resulting xhtml is kept in memory
+        # until correct_links() is called
+        self.xhtml_files[self.current_file] = etree.tostring(self.get_buff_xhtml(), encoding='UTF-8', method='xml', xml_declaration=True)
 
-    def write_buff_to_xml(self, filename):
-        d = os.path.dirname(filename)
-        if not os.path.exists(d):
-            os.makedirs(d)
+    def write_buff_to_xhtml(self):
+        self.output.write('OEBPS/' + self.current_file,
+                          etree.tostring(self.get_buff_xhtml(), encoding='UTF-8', method='xml', xml_declaration=True, pretty_print=False))
 
+    def write_buff_to_xml(self, name):
         parser = etree.XMLParser(encoding='utf-8', remove_blank_text=True)
         xml = etree.parse(io.StringIO(self.get_buff()), parser)
         indent(xml.getroot())
-        xml.write(filename, encoding='utf-8', method='xml', xml_declaration=True, pretty_print=False)
+        self.output.write(name, etree.tostring(xml, encoding='UTF-8', method='xml', xml_declaration=True, pretty_print=False))
 
     def parse_note_elem(self, elem, body_name):
         note_title = ''
@@ -451,6 +717,10 @@ class Fb2XHTML:
 
         notes_bodies = self.notes_bodies.replace(' ', '').split(',')
 
+        if self.stream:
+            self.get_stream_notes_dict(notes_bodies)
+            return
+
         for item in self.root:
             if ns_tag(item.tag) == 'body':
                 if 'name' in item.attrib:
@@ -458,6 +728,27 @@ class Fb2XHTML:
                         for section in item:
                             self.parse_note_elem(section, item.attrib['name'])
 
+    def get_stream_notes_dict(self, notes_bodies):
+        # Quick first pass over the document - only notes are collected, everything else is thrown away
+        level = 0
+        body_name = None
+
+        for event, elem in etree.iterparse(self.fb2file, events=('start', 'end'), recover=True):
+            if event == 'start':
+                level += 1
+                if level == 2:
+                    body_name = elem.attrib['name'] if ns_tag(elem.tag) == 'body' and 'name' in elem.attrib else None
+            else:
+                if self.normalize_dashes and body_name in notes_bodies and ns_tag(elem.tag) == 'p':
+                    normalize_paragraph(elem)
+                level -= 1
+                if level == 2:
+                    if body_name is not None and body_name in notes_bodies:
+                        self.parse_note_elem(elem, body_name)
+                    free_element(elem)
+                elif level == 1:
+                    free_element(elem)
+
     def get_vignette(self, level, vignette_type):
         vignette = None
         try:
@@ -568,36 +859,43 @@ class Fb2XHTML:
                             self.buff.append('</div>')
                             self.buff.append(HTMLFOOT)
 
-                            self.write_buff_to_xhtml()
+                            self.store_buff_to_xhtml()
 
                     elif ns_tag(t.tag) == 'date':
                         self.book_date = etree.tostring(t, method='text', encoding='utf-8').decode('utf-8').strip()
 
-    def parse_binary(self, elem):
-        filename = None
-        if elem.attrib['id']:
-            filename = elem.attrib['id']
-            if not os.path.splitext(filename)[1]:
-                filename = filename + '.jpg'
-            write_file_bin(base64.b64decode(elem.text.encode('ascii')),os.path.join(os.path.join(self.temp_content_dir, 'images'), filename))
-            self.image_file_list.append('images/' + filename)
-
-    def parse_span(self, span, elem):
-        self.parse_format(elem, 'span', span)
+        self.description_parsed = True
+        self.add_early_binaries()
 
-    def parse_emphasis(self, elem):
-        self.parse_span('emphasis', elem)
+    def add_early_binaries(self):
+        binaries = self.early_binaries
+        self.early_binaries = []
+        for binary_id, text, limit in binaries:
+            self.add_binary(binary_id, text, limit)
 
-    def parse_strong(self, elem):
-        self.parse_span('strong', elem)
-
-    def parse_strikethrough(self, elem):
-        self.parse_span('strike', elem)
+    def parse_binary(self, elem, limit=True):
+        if not self.description_parsed:
+            self.early_binaries.append((elem.attrib['id'], elem.text, limit))
+        else:
+            self.add_binary(elem.attrib['id'], elem.text, limit)
 
-    def parse_style(self, elem):
-        self.parse_format(elem, 'span')
+    def add_binary(self, binary_id, text, limit=True):
+        if binary_id:
+            filename = binary_id
+            if not os.path.splitext(filename)[1]:
+                filename = filename + '.jpg'
+            img_rel_path = 'images/' + filename
+            is_cover = img_rel_path == self.book_cover
+
+            if self.image_pool:
+                self.image_queue.append((img_rel_path, self.image_pool.submit(self.process_image, img_rel_path, text, is_cover)))
+                if limit:
+                    # Limit number of decoded images kept in memory
+                    self.write_images(self.image_threads * 2)
+            else:
+                self.add_image(img_rel_path, *self.process_image(img_rel_path, text, is_cover))
 
-    def parse_emptyline(self):
+    def parse_emptyline(self, elem):
         self.buff.append('<div class="emptyline" />')
 
     def parse_title(self, elem):
@@ -699,15 +997,6 @@ class Fb2XHTML:
         self.parse_format(elem, 'div', 'poem')
         self.no_paragraph = False
 
-    def parse_stanza(self, elem):
-        self.parse_format(elem, 'div', 'stanza')
-
-    def parse_v(self, elem):
-        self.parse_format(elem, 'p')
-
-    def parse_cite(self, elem):
-        self.parse_format(elem, 'div', 'cite')
-
     def parse_textauthor(self, elem):
         self.no_paragraph = True
         self.parse_format(elem, 'div', 'text-author')
@@ -731,9 +1020,6 @@ class Fb2XHTML:
         self.parse_format(elem, 'div', 'epigraph')
         self.no_paragraph = False
 
-    def parse_code(self, elem):
-        self.parse_format(elem, 'code')
-
     def parse_other(self, elem):
         self.parse_format(elem, ns_tag(elem.tag))
 
@@ -743,7 +1029,7 @@ class Fb2XHTML:
         if not self.body_name:
             if self.chaptersplit and self.current_header_level < self.chapterlevel:
                 self.buff.append(HTMLFOOT)
-                self.write_buff_to_xhtml()
+                self.store_buff_to_xhtml()
 
                 self.buff = []
                 self.current_file_index += 1
@@ -764,9 +1050,6 @@ class Fb2XHTML:
 
         self.current_header_level = max(0, self.current_header_level - 1)
 
-    def parse_date(self, elem):
-        self.parse_format(elem, 'time')
-
     def parse_format(self, elem, tag=None, css=None, href=None):
         dodropcaps = 0
 
@@ -823,92 +1106,10 @@ class Fb2XHTML:
                 self.inline_image_mode = True
 
         if elem.text:
-            if self.current_file in self.pages_list and self.page_length + len(elem.text) >= self.characters_per_page:
-                page = self.pages_list[self.current_file]
-                text = ''
-                for w in elem.text.split(' '):
-                    text = ' '.join([text, w])
-                    if self.page_length + len(text) >= self.characters_per_page:
-                        hs = self.insert_hyphenation(text)
-                        if dodropcaps > 0:
-                            self.buff.append('<span class="dropcaps">{}</span>{}'.format(hs[0:dodropcaps], save_html(hs[dodropcaps:])))
-                            dodropcaps = 0
-                        else:
-                            self.buff.append(save_html(hs))
-                        self.buff.append('<a class="pagemarker" id="page_{0:d}"/>'.format(page))
-                        page += 1
-                        text = ''
-                        self.page_length = 0
-
-                self.page_length = len(text)
-                if len(text) > 0:
-                    hs = self.insert_hyphenation(text)
-                    if dodropcaps > 0:
-                        self.buff.append('<span class="dropcaps">{}</span>{}'.format(hs[0:dodropcaps], save_html(hs[dodropcaps:])))
-                    else:
-                        self.buff.append(save_html(hs))
-                self.pages_list[self.current_file] = page
-            else:
-                self.page_length += len(elem.text)
-                hs = self.insert_hyphenation(elem.text)
-                if dodropcaps > 0:
-                    self.buff.append('<span class="dropcaps">{}</span>{}'.format(hs[0:dodropcaps], save_html(hs[dodropcaps:])))
-                else:
-                    self.buff.append(save_html(hs))
+            self.parse_text(elem.text, dodropcaps)
 
         for e in elem:
-            if e.tag == etree.Comment:
-                continue
-            if ns_tag(e.tag) == 'title':
-                self.parse_title(e)
-            elif ns_tag(e.tag) == 'subtitle':
-                self.parse_subtitle(e)
-            elif ns_tag(e.tag) == 'epigraph':
-                self.parse_epigraph(e)
-            elif ns_tag(e.tag) == 'annotation':
-                self.parse_annotation(e)
-            elif ns_tag(e.tag) == 'section':
-                self.parse_section(e)
-            elif ns_tag(e.tag) == 'strong':
-                self.parse_strong(e)
-            elif ns_tag(e.tag) == 'emphasis':
-                self.parse_emphasis(e)
-            elif ns_tag(e.tag) == 'strikethrough':
-                self.parse_strikethrough(e)
-            elif ns_tag(e.tag) == 'style':
-                self.parse_style(e)
-            elif ns_tag(e.tag) == 'a':
-                self.parse_a(e)
-            elif ns_tag(e.tag) == 'image':
-                self.parse_image(e)
-            elif ns_tag(e.tag) == 'p':
-                self.parse_p(e)
-            elif ns_tag(e.tag) == 'poem':
-                self.parse_poem(e)
-            elif ns_tag(e.tag) == 'stanza':
-                self.parse_stanza(e)
-            elif ns_tag(e.tag) == 'v':
-                self.parse_v(e)
-            elif ns_tag(e.tag) == 'cite':
-                self.parse_cite(e)
-            elif ns_tag(e.tag) == 'empty-line':
-                self.parse_emptyline()
-            elif ns_tag(e.tag) == 'text-author':
-                self.parse_textauthor(e)
-            elif ns_tag(e.tag) == 'table':
-                self.parse_table(e)
-            elif ns_tag(e.tag) == 'code':
-                self.parse_code(e)
-            elif ns_tag(e.tag) == 'date':
-                self.parse_date(e)
-            elif ns_tag(e.tag) == 'tr':
-                self.parse_table_element(e)
-            elif ns_tag(e.tag) == 'td':
-                self.parse_table_element(e)
-            elif ns_tag(e.tag) == 'th':
-                self.parse_table_element(e)
-            else:
-                self.parse_other(e)
+            self.parse_child(e)
 
         if tag:
             if css == 'section':
@@ -932,8 +1133,111 @@ class Fb2XHTML:
                     self.current_notes = []
 
         if elem.tail:
-            self.page_length += len(elem.tail)
-            self.buff.append(save_html(self.insert_hyphenation(elem.tail)))
+            self.parse_tail(elem.tail)
+
+    def parse_text(self, text, dodropcaps=0):
+        if self.current_file in self.pages_list and self.page_length + len(text) >= self.characters_per_page:
+            page = self.pages_list[self.current_file]
+            for page_text in self.split_pages(text):
+                if page_text is None:
+                    self.buff.append('<a class="pagemarker" id="page_{0:d}"/>'.format(page))
+                    page += 1
+                    continue
+
+                if dodropcaps > 0:
+                    self.buff.append('<span class="dropcaps">{}</span>{}'.format(page_text[0:dodropcaps], save_html(page_text[dodropcaps:])))
+                    dodropcaps = 0
+                else:
+                    self.buff.append(save_html(page_text))
+            self.pages_list[self.current_file] = page
+        else:
+            self.page_length += len(text)
+            hs = self.insert_hyphenation(text)
+            if dodropcaps > 0:
+                self.buff.append('<span class="dropcaps">{}</span>{}'.format(hs[0:dodropcaps], save_html(hs[dodropcaps:])))
+            else:
+                self.buff.append(save_html(hs))
+
+    def split_pages(self, text):
+        '''Splits text on page boundaries. Returns hyphenated pieces of text with None
+        in place of every page marker. Every word is counted with the space in front of it.
+        '''
+        words = text.split(' ')
+
+        # Indexes of the first words on the new pages
+        breaks = []
+        page_length = self.page_length
+        chunk_length = 0
+        for i, w in enumerate(words):
+            chunk_length += len(w) + 1
+            if page_length + chunk_length >= self.characters_per_page:
+                breaks.append(i + 1)
+                chunk_length = 0
+                page_length = 0
+        self.page_length = chunk_length
+
+        # Hyphenation never touches spaces, so hyphenated paragraph could be split on the same words.
+        # Entities and non-breaking spaces may produce new spaces though - in this case fall back to
+        # hyphenation of every word.
+        hwords = self.insert_hyphenation(text).split(' ')
+        if len(hwords) != len(words):
+            hwords = [self.insert_hyphenation(w) for w in words]
+
+        result = []
+        start = 0
+        for b in breaks:
+            result.append(' ' + ' '.join(hwords[start:b]))
+            result.append(None)
+            start = b
+        if start < len(hwords):
+            result.append(' ' + ' '.join(hwords[start:]))
+
+        return result
+
+    def get_child_handlers(self):
+        ''' Handlers of fb2 elements by tag, element is the only argument '''
+        handlers = {
+            'title': self.parse_title,
+            'subtitle': self.parse_subtitle,
+            'epigraph': self.parse_epigraph,
+            'annotation': self.parse_annotation,
+            'section': self.parse_section,
+            'strong': partial(self.parse_format, tag='span', css='strong'),
+            'emphasis': partial(self.parse_format, tag='span', css='emphasis'),
+            'strikethrough': partial(self.parse_format, tag='span', css='strike'),
+            'style': partial(self.parse_format, tag='span'),
+            'a': self.parse_a,
+            'image': self.parse_image,
+            'p': self.parse_p,
+            'poem': self.parse_poem,
+            'stanza': partial(self.parse_format, tag='div', css='stanza'),
+            'v': partial(self.parse_format, tag='p'),
+            'cite': partial(self.parse_format, tag='div', css='cite'),
+            'empty-line': self.parse_emptyline,
+            'text-author': self.parse_textauthor,
+            'table': self.parse_table,
+            'code': partial(self.parse_format, tag='code'),
+            'date': partial(self.parse_format, tag='time'),
+            'tr': self.parse_table_element,
+            'td': self.parse_table_element,
+            'th': self.parse_table_element,
+        }
+        # Tags of fb2 namespace are found without removing namespace
+        handlers.update({FB2_NS + tag: handler for tag, handler in handlers.items()})
+        handlers[etree.Comment] = lambda e: None
+        return handlers
+
+    def parse_child(self, e):
+        handler = self.child_handlers.get(e.tag)
+        if handler is None:
+            # Other namespace or unknown element - handler is found once for every new tag
+            handler = self.child_handlers.get(ns_tag(e.tag), self.parse_other)
+            self.child_handlers[e.tag] = handler
+        handler(e)
+
+    def parse_tail(self, tail):
+        self.page_length += len(tail)
+        self.buff.append(save_html(self.insert_hyphenation(tail)))
 
     def parse_table_element(self, elem):
         self.buff.append('<{0}'.format(ns_tag(elem.tag)))
@@ -948,9 +1252,21 @@ class Fb2XHTML:
     def insert_hyphenation(self, s):
         if not s:
             return ''
-        return html.unescape(s) if not self.hyphenate or not self.hyphenator or self.header or self.subheader else self.hyphenator.hyphenate_text(html.unescape(s), self.replaceNBSP)
+        if not self.hyphenate or not self.hyphenator or self.header or self.subheader:
+            return html.unescape(s)
+
+        start = time.perf_counter()
+        result = self.hyphenator.hyphenate_text(html.unescape(s), self.replaceNBSP)
+        self.stages.add_time('parse.hyphenate', time.perf_counter() - start)
+        return result
 
     def parse_body(self, elem):
+        if self.begin_body(elem):
+            self.parse_format(elem)
+        self.end_body()
+
+    def begin_body(self, elem):
+        ''' Starts new body, returns True if body content has to be parsed '''
         self.body_name = elem.attrib['name'] if 'name' in elem.attrib else ''
         self.current_header_level = 0
         self.first_header_in_body = True
@@ -976,7 +1292,7 @@ class Fb2XHTML:
         if self.notes_mode in ('inline', 'block', 'float'):
             notes_bodies = self.notes_bodies.replace(' ', '').split(',')
             if self.body_name not in notes_bodies:
-                self.parse_format(elem)
+                return True
             elif self.notes_mode == 'float':
                 if len(self.notes_order) > 0:
                     toc_title = self.body_name[0].upper() + self.body_name[1:]
@@ -1015,10 +1331,13 @@ class Fb2XHTML:
                     else:
                         continue
         else:
-            self.parse_format(elem)
+            return True
+
+        return False
 
+    def end_body(self):
         self.buff.append(HTMLFOOT)
-        self.write_buff_to_xhtml()
+        self.store_buff_to_xhtml()
 
     def generate_toc(self):
         self.buff = []
@@ -1129,11 +1448,10 @@ class Fb2XHTML:
             self.ncx_navp_end()
 
         self.buff.append('</navMap></ncx>')
-        self.write_buff_to_xml(os.path.join(self.temp_content_dir, 'toc.ncx'))
+        self.write_buff_to_xml('OEBPS/toc.ncx')
 
     def generate_mimetype(self):
-        mimetype = 'application/epub+zip'
-        write_file(mimetype, os.path.join(self.temp_dir, 'mimetype'))
+        self.output.write('mimetype', MIMETYPE)
 
     def generate_container(self):
         self.buff = []
@@ -1143,16 +1461,10 @@ class Fb2XHTML:
                          '<rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
                          '</rootfiles>'
                          '</container>')
-        self.write_buff_to_xml(os.path.join(self.temp_inf_dir, 'container.xml'))
+        self.write_buff_to_xml('META-INF/container.xml')
 
     def generate_cover(self):
         if self.book_cover:
-
-            # make sure kindlegen does not complain on cover size and make sure that epub cover takes whole screen
-            im = Image.open(os.path.join(self.temp_content_dir, self.book_cover))
-            if im.height < self.screen_height:
-                im.resize((int(self.screen_height * im.width / im.height), self.screen_height), Image.LANCZOS).save(os.path.join(self.temp_content_dir, self.book_cover))
-
             self.buff = []
             self.buff.append(HTMLHEAD)
             self.buff.append('<svg version="1.1" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" width="100%" height="100%" viewBox="0 0 {0} {1}" preserveAspectRatio="xMidYMid meet">'.format(self.screen_width, self.screen_height))
@@ -1190,7 +1502,7 @@ class Fb2XHTML:
             page += 1
 
         self.buff.append('</page-map>')
-        self.write_buff_to_xml(os.path.join(self.temp_content_dir, 'page-map.xml'))
+        self.write_buff_to_xml('OEBPS/page-map.xml')
 
     def generate_opf(self):
         self.buff = []
@@ -1314,7 +1626,7 @@ class Fb2XHTML:
 
         self.buff.append('</package>')
 
-        self.write_buff_to_xml(os.path.join(self.temp_content_dir, 'content.opf'))
+        self.write_buff_to_xml('OEBPS/content.opf')
 
     def get_buff(self):
         return ''.join(self.buff)
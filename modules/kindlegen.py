@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import tempfile
+import threading
+import subprocess
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Calculated on import: worker processes replace tempfile.tempdir with their own directories later,
+# but slots must be shared by all processes
+LOCK_DIR = os.path.join(tempfile.gettempdir(), 'fb2mobi-kindlegen')
+
+# Как часто проверять освободившиеся слоты (сек)
+POLL_INTERVAL = 0.1
+
+
+def get_kindlegen_cmd(application_path):
+    name = 'kindlegen.exe' if sys.platform == 'win32' else 'kindlegen'
+    if os.path.exists(os.path.join(application_path, name)):
+        return os.path.join(application_path, name)
+    return name
+
+
+def get_children_cpu_time():
+    if resource:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+    return None
+
+
+class KindlegenSlot:
+    '''One of limited number of kindlegen slots, shared by all processes on the machine.
+
+    Slot is a locked file in LOCK_DIR, lock is released by OS even if process dies.
+    '''
+
+    def __init__(self, limit, log):
+        self.limit = limit
+        self.log = log
+        self.file = None
+
+    def try_lock(self, filename):
+        f = open(filename, 'a+b')
+        try:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            return None
+        return f
+
+    def __enter__(self):
+        if self.limit <= 0:
+            return self
+
+        try:
+            if not os.path.exists(LOCK_DIR):
+                os.makedirs(LOCK_DIR, exist_ok=True)
+            while self.file is None:
+                for i in range(self.limit):
+                    self.file = self.try_lock(os.path.join(LOCK_DIR, 'slot{0}.lock'.format(i)))
+                    if self.file:
+                        break
+                else:
+                    time.sleep(POLL_INTERVAL)
+        except OSError:
+            self.log.warning('Unable to limit number of kindlegen processes')
+            self.log.debug('Getting details', exc_info=True)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.file:
+            if not fcntl:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+            self.file.close()
+            self.file = None
+
+
+class KindlegenRun:
+    '''Result of kindlegen run'''
+
+    def __init__(self):
+        self.returncode = None
+        self.timed_out = False
+        self.wait_time = 0
+        self.wall_time = 0
+        self.cpu_time = None
+
+
+def run_kindlegen(kindlegen_cmd, args, log, timeout=0, max_processes=0):
+    '''Runs kindlegen, output is sent to log line by line.
+
+    Process is killed after timeout seconds (0 - no limit). No more than max_processes
+    kindlegen processes are running at once (0 - no limit), counting all fb2mobi processes.
+    Raises OSError if kindlegen could not be started.
+    '''
+    run = KindlegenRun()
+
+    startupinfo = None
+    if os.name == 'nt':
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+
+    start_time = time.perf_counter()
+    with KindlegenSlot(max_processes, log):
+        run.wait_time = time.perf_counter() - start_time
+        if run.wait_time >= POLL_INTERVAL:
+            log.debug('Waited {0:.2f} sec for kindlegen slot'.format(run.wait_time))
+
+        start_time = time.perf_counter()
+        cpu_time = get_children_cpu_time()
+
+        with subprocess.Popen([kindlegen_cmd] + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              startupinfo=startupinfo) as process:
+            timer = None
+            if timeout > 0:
+                def kill():
+                    run.timed_out = True
+                    process.kill()
+
+                timer = threading.Timer(timeout, kill)
+                timer.start()
+
+            try:
+                for line in process.stdout:
+                    line = str(line, 'utf-8', errors='replace').rstrip()
+                    if line.startswith('Error('):
+                        log.error(line)
+                    elif line:
+                        log.debug(line)
+                run.returncode = process.wait()
+            finally:
+                if timer:
+                    timer.cancel()
+
+        run.wall_time = time.perf_counter() - start_time
+        # Время дочерних процессов учитывается только после их завершения
+        if cpu_time is not None:
+            run.cpu_time = get_children_cpu_time() - cpu_time
+
+    if run.timed_out:
+        log.error('kindlegen was stopped after {0} sec timeout, limit could be raised with --kindlegen-timeout key or <kindlegenTimeout> config tag (0 - no limit)'.format(timeout))
+
+    log.debug('kindlegen finished with code {0} in {1:.2f} sec{2}'.format(
+        run.returncode, run.wall_time, ', CPU time {0:.2f} sec'.format(run.cpu_time) if run.cpu_time is not None else ''))
+
+    return run
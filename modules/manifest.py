@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import hashlib
+
+from modules.convcache import hash_file
+
+MANIFEST_NAME = '.fb2mobi-manifest.json'
+
+# Как часто сохранять манифест во время конвертации (сек)
+SAVE_INTERVAL = 5
+
+
+def get_file_hash(filename):
+    sha = hashlib.sha1()
+    hash_file(sha, filename)
+    return sha.hexdigest()
+
+
+class ConversionManifest:
+    '''List of converted books for incremental batch conversion.
+
+    For every source file (absolute path) keeps its mtime, size and hash, hash of conversion settings
+    and list of output files. Entry is added only after successful conversion and manifest is saved
+    periodically, so interrupted conversion is continued from the last saved book.
+    '''
+
+    def __init__(self, filename, settings_hash, log):
+        self.filename = filename
+        self.settings_hash = settings_hash
+        self.log = log
+        self.entries = {}
+        self.last_save = time.perf_counter()
+
+        if os.path.isfile(filename):
+            try:
+                with open(filename, encoding='utf-8') as f:
+                    self.entries = json.load(f)['books']
+            except:
+                self.log.warning('Unable to read manifest "{0}", all books will be converted'.format(filename))
+                self.log.debug('Getting details', exc_info=True)
+
+    def save(self):
+        temp_file = self.filename + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump({'books': self.entries}, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(temp_file, self.filename)
+        self.last_save = time.perf_counter()
+
+    def is_changed(self, source):
+        entry = self.entries.get(os.path.abspath(source))
+        if not entry or entry['settings'] != self.settings_hash:
+            return True
+
+        if not all(os.path.isfile(f) for f in entry['outputs']):
+            return True
+
+        stat = os.stat(source)
+        if entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            return False
+
+        # Файл мог быть просто скопирован заново, проверим содержимое
+        if entry['size'] == stat.st_size and entry['hash'] == get_file_hash(source):
+            entry['mtime'] = stat.st_mtime
+            return False
+
+        return True
+
+    def add(self, source, outputs, source_deleted=False):
+        source = os.path.abspath(source)
+        outputs = [os.path.abspath(f) for f in outputs if os.path.isfile(f)]
+        stat = os.stat(source)
+
+        entry = self.entries.get(source)
+        if entry:
+            # Output name or format could change, remove old files
+            self.remove_outputs([f for f in entry['outputs'] if f not in outputs])
+
+        self.entries[source] = {'mtime': stat.st_mtime,
+                                'size': stat.st_size,
+                                'hash': get_file_hash(source),
+                                'settings': self.settings_hash,
+                                'outputs': outputs,
+                                'source_deleted': source_deleted}
+
+        # Before source file is deleted entry must be on disk, otherwise the book is lost for the next run
+        if source_deleted or time.perf_counter() - self.last_save > SAVE_INTERVAL:
+            self.save()
+
+    def remove_vanished(self, input_dir):
+        '''Removes outputs of books which sources are no longer in input_dir'''
+        input_dir = os.path.join(os.path.abspath(input_dir), '')
+        count = 0
+        for source in list(self.entries):
+            entry = self.entries[source]
+            if source.startswith(input_dir) and not entry['source_deleted'] and not os.path.exists(source):
+                self.log.info('Source "{0}" was removed, removing converted book'.format(source))
+                self.remove_outputs(entry['outputs'])
+                del self.entries[source]
+                count += 1
+        return count
+
+    def remove_outputs(self, outputs):
+        for f in outputs:
+            try:
+                if os.path.isfile(f):
+                    os.remove(f)
+            except:
+                self.log.error('Unable to remove file "{0}"'.format(f))
@@ -6,6 +6,7 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 import struct
 import string
 import re
+import mmap
 from PIL import Image
 from io import BytesIO
 
@@ -99,164 +100,76 @@ def readsection(datain, secno):
     return datain[secstart:secend]
 
 
-def writesection(datain, secno, secdata):  # overwrite, accounting for different length
-    # dataout = deletesectionrange(datain,secno, secno)
-    # return insertsection(dataout, secno, secdata)
-    datalst = []
-    nsec = getint(datain, number_of_pdb_records, b'H')
-    zerosecstart, zerosecend = getsecaddr(datain, 0)
-    secstart, secend = getsecaddr(datain, secno)
-    dif = len(secdata) - (secend - secstart)
-    datalst.append(datain[:unique_id_seed])
-    datalst.append(struct.pack(b'>L', 2 * nsec + 1))
-    datalst.append(datain[unique_id_seed + 4:number_of_pdb_records])
-    datalst.append(struct.pack(b'>H', nsec))
-    newstart = zerosecstart
-    for i in range(0, secno):
-        ofs, flgval = struct.unpack_from(b'>2L', datain, first_pdb_record + i * 8)
-        datalst.append(struct.pack(b'>L', ofs) + struct.pack(b'>L', flgval))
-    datalst.append(struct.pack(b'>L', secstart) + struct.pack(b'>L', (2 * secno)))
-    for i in range(secno + 1, nsec):
-        ofs, flgval = struct.unpack_from(b'>2L', datain, first_pdb_record + i * 8)
-        ofs = ofs + dif
-        datalst.append(struct.pack(b'>L', ofs) + struct.pack(b'>L', flgval))
-    lpad = newstart - (first_pdb_record + 8 * nsec)
-    if lpad > 0:
-        datalst.append(b'\0' * lpad)
-    datalst.append(datain[zerosecstart:secstart])
-    datalst.append(secdata)
-    datalst.append(datain[secend:])
-    dataout = b''.join(datalst)
-    return dataout
-
-
-def nullsection(datain, secno):  # make it zero-length without deleting it
-    datalst = []
-    nsec = getint(datain, number_of_pdb_records, b'H')
-    secstart, secend = getsecaddr(datain, secno)
-    zerosecstart, zerosecend = getsecaddr(datain, 0)
-    dif = secend - secstart
-    datalst.append(datain[:first_pdb_record])
-    for i in range(0, secno + 1):
-        ofs, flgval = struct.unpack_from(b'>2L', datain, first_pdb_record + i * 8)
-        datalst.append(struct.pack(b'>L', ofs) + struct.pack(b'>L', flgval))
-    for i in range(secno + 1, nsec):
-        ofs, flgval = struct.unpack_from(b'>2L', datain, first_pdb_record + i * 8)
-        ofs = ofs - dif
-        datalst.append(struct.pack(b'>L', ofs) + struct.pack(b'>L', flgval))
-    lpad = zerosecstart - (first_pdb_record + 8 * nsec)
-    if lpad > 0:
-        datalst.append(b'\0' * lpad)
-    datalst.append(datain[zerosecstart: secstart])
-    datalst.append(datain[secend:])
-    dataout = b''.join(datalst)
-    return dataout
-
-
-def deletesectionrange(datain, firstsec, lastsec):  # delete a range of sections
-    datalst = []
-    firstsecstart, firstsecend = getsecaddr(datain, firstsec)
-    lastsecstart, lastsecend = getsecaddr(datain, lastsec)
-    zerosecstart, zerosecend = getsecaddr(datain, 0)
-    dif = lastsecend - firstsecstart + 8 * (lastsec - firstsec + 1)
-    nsec = getint(datain, number_of_pdb_records, b'H')
-    datalst.append(datain[:unique_id_seed])
-    datalst.append(struct.pack(b'>L', 2 * (nsec - (lastsec - firstsec + 1)) + 1))
-    datalst.append(datain[unique_id_seed + 4:number_of_pdb_records])
-    datalst.append(struct.pack(b'>H', nsec - (lastsec - firstsec + 1)))
-    newstart = zerosecstart - 8 * (lastsec - firstsec + 1)
-    for i in range(0, firstsec):
-        ofs, flgval = struct.unpack_from(b'>2L', datain, first_pdb_record + i * 8)
-        ofs = ofs - 8 * (lastsec - firstsec + 1)
-        datalst.append(struct.pack(b'>L', ofs) + struct.pack(b'>L', flgval))
-    for i in range(lastsec + 1, nsec):
-        ofs, flgval = struct.unpack_from(b'>2L', datain, first_pdb_record + i * 8)
-        ofs = ofs - dif
-        flgval = 2 * (i - (lastsec - firstsec + 1))
-        datalst.append(struct.pack(b'>L', ofs) + struct.pack(b'>L', flgval))
-    lpad = newstart - (first_pdb_record + 8 * (nsec - (lastsec - firstsec + 1)))
-    if lpad > 0:
-        datalst.append(b'\0' * lpad)
-    datalst.append(datain[zerosecstart:firstsecstart])
-    datalst.append(datain[lastsecend:])
-    dataout = b''.join(datalst)
-    return dataout
-
-
-def insertsection(datain, secno, secdata):  # insert a new section
-    datalst = []
-    nsec = getint(datain, number_of_pdb_records, b'H')
-    # print("inserting secno" , secno,  "into" ,nsec, "sections")
-    secstart, secend = getsecaddr(datain, secno)
-    zerosecstart, zerosecend = getsecaddr(datain, 0)
-    dif = len(secdata)
-    datalst.append(datain[:unique_id_seed])
-    datalst.append(struct.pack(b'>L', 2 * (nsec + 1) + 1))
-    datalst.append(datain[unique_id_seed + 4:number_of_pdb_records])
-    datalst.append(struct.pack(b'>H', nsec + 1))
-    newstart = zerosecstart + 8
-    for i in range(0, secno):
-        ofs, flgval = struct.unpack_from(b'>2L', datain, first_pdb_record + i * 8)
-        ofs += 8
-        datalst.append(struct.pack(b'>L', ofs) + struct.pack(b'>L', flgval))
-    datalst.append(struct.pack(b'>L', secstart + 8) + struct.pack(b'>L', (2 * secno)))
-    for i in range(secno, nsec):
-        ofs, flgval = struct.unpack_from(b'>2L', datain, first_pdb_record + i * 8)
-        ofs = ofs + dif + 8
-        flgval = 2 * (i + 1)
-        datalst.append(struct.pack(b'>L', ofs) + struct.pack(b'>L', flgval))
-    lpad = newstart - (first_pdb_record + 8 * (nsec + 1))
-    if lpad > 0:
-        datalst.append(b'\0' * lpad)
-    datalst.append(datain[zerosecstart:secstart])
-    datalst.append(secdata)
-    datalst.append(datain[secstart:])
-    dataout = b''.join(datalst)
-    return dataout
-
-
-def insertsectionrange(sectionsource, firstsec, lastsec, sectiontarget, targetsec):  # insert a range of sections
-    datalst = []
-    nsec = getint(sectiontarget, number_of_pdb_records, b'H')
-    zerosecstart, zerosecend = getsecaddr(sectiontarget, 0)
-    insstart, nul = getsecaddr(sectiontarget, targetsec)
-    nins = lastsec - firstsec + 1
-    srcstart, nul = getsecaddr(sectionsource, firstsec)
-    nul, srcend = getsecaddr(sectionsource, lastsec)
-    newstart = zerosecstart + 8 * nins
-
-    datalst.append(sectiontarget[:unique_id_seed])
-    datalst.append(struct.pack(b'>L', 2 * (nsec + nins) + 1))
-    datalst.append(sectiontarget[unique_id_seed + 4:number_of_pdb_records])
-    datalst.append(struct.pack(b'>H', nsec + nins))
-    for i in range(0, targetsec):
-        ofs, flgval = struct.unpack_from(b'>2L', sectiontarget, first_pdb_record + i * 8)
-        ofsnew = ofs + 8 * nins
-        flgvalnew = flgval
-        datalst.append(struct.pack(b'>L', ofsnew) + struct.pack(b'>L', flgvalnew))
-        # print(ofsnew, flgvalnew, ofs, flgval)
-    srcstart0, nul = getsecaddr(sectionsource, firstsec)
-    for i in range(nins):
-        isrcstart, nul = getsecaddr(sectionsource, firstsec + i)
-        ofsnew = insstart + (isrcstart - srcstart0) + 8 * nins
-        flgvalnew = 2 * (targetsec + i)
-        datalst.append(struct.pack(b'>L', ofsnew) + struct.pack(b'>L', flgvalnew))
-        # print(ofsnew, flgvalnew)
-    dif = srcend - srcstart
-    for i in range(targetsec, nsec):
-        ofs, flgval = struct.unpack_from(b'>2L', sectiontarget, first_pdb_record + i * 8)
-        ofsnew = ofs + dif + 8 * nins
-        flgvalnew = 2 * (i + nins)
-        datalst.append(struct.pack(b'>L', ofsnew) + struct.pack(b'>L', flgvalnew))
-        # print(ofsnew, flgvalnew, ofs, flgval)
-    lpad = newstart - (first_pdb_record + 8 * (nsec + nins))
-    if lpad > 0:
-        datalst.append(b'\0' * lpad)
-    datalst.append(sectiontarget[zerosecstart:insstart])
-    datalst.append(sectionsource[srcstart:srcend])
-    datalst.append(sectiontarget[insstart:])
-    dataout = b''.join(datalst)
-    return dataout
+class PdbFile:
+    '''PDB file as a list of sections. Sections are slices of the source data until they are replaced,
+    all edits are done in memory and the file is serialized once by getdata().
+    Record table and unique id seed are updated exactly as KindleUnpack does it, so result is the same.
+    '''
+
+    def __init__(self, datain):
+        self.data = memoryview(datain)
+        nsec = getint(datain, number_of_pdb_records, b'H')
+        self.header = bytearray(datain[:number_of_pdb_records])
+        self.offsets = []
+        self.flags = []
+        for i in range(nsec):
+            ofs, flgval = struct.unpack_from(b'>2L', datain, first_pdb_record + i * 8)
+            self.offsets.append(ofs)
+            self.flags.append(flgval)
+        # Padding between record table and the first section (filled by zeros on write)
+        self.lpad = self.offsets[0] - (first_pdb_record + 8 * nsec)
+        self.sections = [self.data[self.offsets[i]:self.offsets[i + 1] if i < nsec - 1 else len(datain)] for i in range(nsec)]
+
+    def numsections(self):
+        return len(self.sections)
+
+    def readsection(self, secno):
+        return self.sections[secno]
+
+    def setuid(self):
+        self.header[unique_id_seed:unique_id_seed + 4] = struct.pack(b'>L', 2 * len(self.sections) + 1)
+
+    def renumber(self, start):
+        for i in range(start, len(self.flags)):
+            self.flags[i] = 2 * i
+
+    def writesection(self, secno, secdata):  # overwrite, accounting for different length
+        self.sections[secno] = secdata
+        self.flags[secno] = 2 * secno
+        self.setuid()
+
+    def nullsection(self, secno):  # make it zero-length without deleting it
+        self.sections[secno] = b''
+
+    def deletesectionrange(self, firstsec, lastsec):  # delete a range of sections
+        del self.sections[firstsec:lastsec + 1]
+        del self.flags[firstsec:lastsec + 1]
+        self.renumber(firstsec)
+        self.setuid()
+
+    def insertsection(self, secno, secdata):  # insert a new section
+        self.sections.insert(secno, secdata)
+        self.flags.insert(secno, 2 * secno)
+        self.renumber(secno)
+        self.setuid()
+
+    def insertsectionrange(self, sectionsource, firstsec, lastsec, targetsec):  # insert a range of sections from other file
+        self.sections[targetsec:targetsec] = sectionsource.sections[firstsec:lastsec + 1]
+        self.flags[targetsec:targetsec] = [0] * (lastsec - firstsec + 1)
+        self.renumber(targetsec)
+        self.setuid()
+
+    def getdata(self):
+        nsec = len(self.sections)
+        datalst = [bytes(self.header[:number_of_pdb_records]), struct.pack(b'>H', nsec)]
+        ofs = first_pdb_record + 8 * nsec + self.lpad
+        for i in range(nsec):
+            datalst.append(struct.pack(b'>2L', ofs, self.flags[i]))
+            ofs += len(self.sections[i])
+        if self.lpad > 0:
+            datalst.append(b'\0' * self.lpad)
+        datalst.extend(self.sections)
+        return b''.join(datalst)
 
 
 def get_exth_params(rec0):
@@ -351,14 +264,14 @@ class mobi_split:
                     return
             datain_kfrec0 = readsection(datain, datain_kf8)
 
-            self.result_file = bytearray(datain)
+            result = PdbFile(datain)
 
             # check if there are SRCS records and reduce them
             srcs = getint(datain_rec0, srcs_index)
             num_srcs = getint(datain_rec0, srcs_count)
             if srcs != 0xffffffff and num_srcs > 0:
                 for i in range(srcs, srcs + num_srcs):
-                    self.result_file = nullsection(self.result_file, i)
+                    result.nullsection(i)
                 datain_rec0 = writeint(datain_rec0, srcs_index, 0xffffffff)
                 datain_rec0 = writeint(datain_rec0, srcs_count, 0)
 
@@ -371,7 +284,7 @@ class mobi_split:
                 # if len(exth) == 0:
                 #     datain_rec0 = add_exth(datain_rec0, exth_cdecontentkey, bytes(to_base(document_id.int, base=32, min_num_digits=10), 'ascii'))
 
-            self.result_file = writesection(self.result_file, 0, datain_rec0)
+            result.writesection(0, datain_rec0)
 
             firstimage = getint(datain_rec0, first_resc_record)
 
@@ -405,7 +318,7 @@ class mobi_split:
                     im = Image.open(BytesIO(cover_image))
                     im.thumbnail((330, 470), Image.ANTIALIAS)
                     im.save(thumb, format=im.format)
-                    self.result_file = writesection(self.result_file, thumb_index, thumb.getvalue())
+                    result.writesection(thumb_index, thumb.getvalue())
                 else:
                     # if nothing works - fall back to the old trick, set thumbnail to the cover image
                     datain_kfrec0 = add_exth(datain_kfrec0, exth_thumb_offset, exth_cover[0])
@@ -425,7 +338,8 @@ class mobi_split:
                 if len(exth) == 0:
                     datain_kfrec0 = add_exth(datain_kfrec0, exth_cdecontentkey, bytes(to_base(document_id.int, base=32, min_num_digits=10), 'ascii'))
 
-            self.result_file = writesection(self.result_file, datain_kf8, datain_kfrec0)
+            result.writesection(datain_kf8, datain_kfrec0)
+            self.result_file = result.getdata()
 
         elif format == 'azw3':
             datain = b''
@@ -450,15 +364,18 @@ class mobi_split:
 
             datain_kfrec0 = readsection(datain, datain_kf8)
 
+            source = PdbFile(datain)
+
             # create the standalone mobi7
-            num_sec = getint(datain, number_of_pdb_records, b'H')
+            result7 = PdbFile(datain)
+            num_sec = result7.numsections()
             # remove BOUNDARY up to but not including ELF record
-            self.result_file7 = deletesectionrange(datain, datain_kf8 - 1, num_sec - 2)
+            result7.deletesectionrange(datain_kf8 - 1, num_sec - 2)
             # check if there are SRCS records and delete them
             srcs = getint(datain_rec0, srcs_index)
             num_srcs = getint(datain_rec0, srcs_count)
             if srcs != 0xffffffff and num_srcs > 0:
-                self.result_file7 = deletesectionrange(self.result_file7, srcs, srcs + num_srcs - 1)
+                result7.deletesectionrange(srcs, srcs + num_srcs - 1)
                 datain_rec0 = writeint(datain_rec0, srcs_index, 0xffffffff)
                 datain_rec0 = writeint(datain_rec0, srcs_count, 0)
             # reset the EXTH 121 KF8 Boundary meta data to 0xffffffff
@@ -483,7 +400,7 @@ class mobi_split:
             fval = fval & 0x07FF
             datain_rec0 = datain_rec0[:0x80] + struct.pack(b'>L', fval) + datain_rec0[0x84:]
 
-            self.result_file7 = writesection(self.result_file7, 0, datain_rec0)
+            result7.writesection(0, datain_rec0)
 
             firstimage = getint(datain_rec0, first_resc_record)
             lastimage = getint(datain_rec0, last_content_index, b'H')
@@ -500,17 +417,20 @@ class mobi_split:
 
             # Try to null out FONT and RES, but leave the (empty) PDB record so image refs remain valid
             for i in range(firstimage, lastimage):
-                imgsec = readsection(self.result_file7, i)
+                imgsec = result7.readsection(i)
                 if imgsec[0:4] in [b'RESC', b'FONT']:
-                    self.result_file7 = nullsection(self.result_file7, i)
+                    result7.nullsection(i)
+
+            self.result_file7 = result7.getdata()
 
             # mobi7 finished
 
             # create standalone mobi8
-            self.result_file8 = deletesectionrange(datain, 0, datain_kf8 - 1)
+            result8 = PdbFile(datain)
+            result8.deletesectionrange(0, datain_kf8 - 1)
             target = getint(datain_kfrec0, first_resc_record)
-            self.result_file8 = insertsectionrange(datain, firstimage, lastimage, self.result_file8, target)
-            datain_kfrec0 = readsection(self.result_file8, 0)
+            result8.insertsectionrange(source, firstimage, lastimage, target)
+            datain_kfrec0 = bytes(result8.readsection(0))
 
             # Only keep the correct EXTH 116 StartOffset, KG 2.5 carries over the one from the mobi7 part, which then points at garbage in the mobi8 part, and confuses FW 3.4
             kf8starts = read_exth(datain_kfrec0, 116)
@@ -561,12 +481,12 @@ class mobi_split:
             if cover_index != 0xffffffff:
                 if thumb_index != 0xffffffff:
                     # make sure embedded thumbnail has the right size
-                    cover_image = readsection(self.result_file8, cover_index)
+                    cover_image = result8.readsection(cover_index)
                     thumb = BytesIO()
                     im = Image.open(BytesIO(cover_image))
                     im.thumbnail((330, 470), Image.ANTIALIAS)
                     im.save(thumb, format=im.format)
-                    self.result_file8 = writesection(self.result_file8, thumb_index, thumb.getvalue())
+                    result8.writesection(thumb_index, thumb.getvalue())
                 else:
                     # if nothing works - fall back to the old trick, set thumbnail to the cover image
                     datain_kfrec0 = add_exth(datain_kfrec0, exth_thumb_offset, exth_cover[0])
@@ -588,7 +508,8 @@ class mobi_split:
             if len(exth) == 0:
                 datain_kfrec0 = add_exth(datain_kfrec0, exth_cdecontentkey, bytes(to_base(document_id.int, base=32, min_num_digits=10), 'ascii'))
 
-            self.result_file8 = writesection(self.result_file8, 0, datain_kfrec0)
+            result8.writesection(0, datain_kfrec0)
+            self.result_file8 = result8.getdata()
 
             # mobi8 finished
 
@@ -603,6 +524,11 @@ class mobi_split:
 
 
 class mobi_read:
+    '''Reads metadata, page map and cover of mobi (azw3) file.
+    File is memory mapped and only needed sections are read, page map and thumbnail are read on first request.
+    Reader should be closed (or used in with statement) to release the file.
+    '''
+
     def __init__(self, infile, width=330, height=470, stretch=False):
 
         self.asin = ''
@@ -610,15 +536,38 @@ class mobi_read:
         self.cdecontentkey = ''
         self.acr = ''
         self.thumbnail = None
-        self.pagedata = b''
+        self.thumbnail_read = False
+        self.pagedata = None
+
+        self.width = width
+        self.height = height
+        self.stretch = stretch
 
-        datain = b''
         with open(pathof(infile), 'rb') as f:
             self.acr = re.sub('[^-A-Za-z0-9 ]+', '_', f.read(32).replace(b'\x00', b'').decode('latin-1'))
-            f.seek(0)
-            datain = f.read()
+            self.datain = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
+        try:
+            self.read_metadata()
+        except:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.datain is not None:
+            self.datain.close()
+            self.datain = None
+
+    def read_metadata(self):
+        datain = self.datain
         datain_rec0 = readsection(datain, 0)
+        self.datain_rec0 = datain_rec0
 
         exth121 = read_exth(datain_rec0, 121)
         self.combo = True
@@ -631,15 +580,6 @@ class mobi_read:
             if datain_kf8 == 0xffffffff:
                 self.combo = False
 
-        # Look for PageMap
-        srcs = getint(datain_rec0, first_non_text)
-        num_srcs = getint(datain, number_of_pdb_records, b'H')
-        if srcs != 0xffffffff and num_srcs > 0:
-            for i in range(srcs, srcs + num_srcs):
-                data = readsection(datain, i)
-                if data[0:4] == b"PAGE":
-                    self.pagedata = data
-
         exth = read_exth(datain_rec0, exth_asin)
         if len(exth) > 0:
             self.asin = exth[0].decode("ascii")
@@ -650,6 +590,39 @@ class mobi_read:
         if len(exth) > 0:
             self.cdecontentkey = exth[0].decode("ascii")
 
+        if self.combo:
+            # always try to use information from KF8 part
+            datain_kfrec0 = readsection(datain, datain_kf8)
+            exth = read_exth(datain_kfrec0, exth_asin)
+            if len(exth) > 0:
+                self.asin = exth[0].decode("ascii")
+            exth = read_exth(datain_kfrec0, exth_cdetype)
+            if len(exth) > 0:
+                self.cdetype = exth[0].decode("ascii")
+            exth = read_exth(datain_kfrec0, exth_cdecontentkey)
+            if len(exth) > 0:
+                self.cdecontentkey = exth[0].decode("ascii")
+
+    def read_pagedata(self):
+        datain = self.datain
+        self.pagedata = b''
+
+        # Look for PageMap
+        srcs = getint(self.datain_rec0, first_non_text)
+        num_sec = getint(datain, number_of_pdb_records, b'H')
+        if srcs != 0xffffffff:
+            for i in range(srcs, num_sec):
+                secstart, secend = getsecaddr(datain, i)
+                if datain[secstart:secstart + 4] == b"PAGE":
+                    self.pagedata = datain[secstart:secend]
+                    break
+
+    def read_thumbnail(self):
+        self.thumbnail_read = True
+        datain = self.datain
+        datain_rec0 = self.datain_rec0
+        width, height = self.width, self.height
+
         firstimage = getint(datain_rec0, first_resc_record)
 
         exth_cover = read_exth(datain_rec0, exth_cover_offset)
@@ -672,27 +645,14 @@ class mobi_read:
                 image = readsection(datain, thumb_index)
                 self.thumbnail = Image.open(BytesIO(image))
                 w, h = self.thumbnail.size
-            if (w < width and h < height) or stretch:
+            if (w < width and h < height) or self.stretch:
                 image = readsection(datain, cover_index)
                 self.thumbnail = Image.open(BytesIO(image))
-                if stretch:
+                if self.stretch:
                     self.thumbnail = self.thumbnail.resize((width, height), Image.LANCZOS)
                 else:
                     self.thumbnail.thumbnail((width, height), Image.LANCZOS)
 
-        if self.combo:
-            # always try to use information from KF8 part
-            datain_kfrec0 = readsection(datain, datain_kf8)
-            exth = read_exth(datain_kfrec0, exth_asin)
-            if len(exth) > 0:
-                self.asin = exth[0].decode("ascii")
-            exth = read_exth(datain_kfrec0, exth_cdetype)
-            if len(exth) > 0:
-                self.cdetype = exth[0].decode("ascii")
-            exth = read_exth(datain_kfrec0, exth_cdecontentkey)
-            if len(exth) > 0:
-                self.cdecontentkey = exth[0].decode("ascii")
-
     def getACR(self):
         return self.acr
 
@@ -706,7 +666,11 @@ class mobi_read:
         return self.cdecontentkey
 
     def getPageData(self):
+        if self.pagedata is None:
+            self.read_pagedata()
         return self.pagedata
 
     def getThumbnail(self):
+        if not self.thumbnail_read:
+            self.read_thumbnail()
         return self.thumbnail
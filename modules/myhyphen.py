@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
 import os, sys
+import re
 import hyphen
 
+from collections import OrderedDict
+
 DICTIONARIES_DIR = os.path.join(os.path.abspath(os.path.dirname(sys.executable)) if getattr(sys, 'frozen', False) else os.path.dirname(__file__), 'dictionaries')
 
 SOFT_HYPHEN = '\u00AD'
@@ -17,27 +20,80 @@ HORIZONTAL_BAR = '\u2015'
 
 WORD_SEPARATORS = [' ', '“', '”', '"', '-', '.', ',', ';', ':', '!', '?', NON_BREAKING_SPACE, HYPHEN, NON_BREAKING_HYPHEN, MINUS_SIGN, EN_DASH, EM_DASH, HORIZONTAL_BAR]
 
+# Words are runs of characters between separators
+WORD = re.compile('[^{0}]+'.format(re.escape(''.join(WORD_SEPARATORS))))
+WORD_OR_NBSP = re.compile('[^{0}]+|{1}'.format(re.escape(''.join(WORD_SEPARATORS)), NON_BREAKING_SPACE))
 
-class MyHyphen:
-    def __init__(self, language):
+HYPHEN_CACHE_SIZE = 50000
+
+# Hyphenation caches by language, shared by all books converted in this process
+hyphen_caches = {}
+
+
+class HyphenCache:
+    '''Hyphenator for one language with LRU cache of hyphenated words'''
+    def __init__(self, language, size):
         self.hyphenator = hyphen.Hyphenator(language=language, directory=DICTIONARIES_DIR)
+        self.words = OrderedDict()
+        self.size = size
+
+    def resize(self, size):
+        self.size = size
+        while len(self.words) > max(size, 0):
+            self.words.popitem(last=False)
+
+    def lookup(self, word):
+        hyphenated = self.words.get(word)
+        if hyphenated is not None:
+            self.words.move_to_end(word)
+        return hyphenated
+
+    def hyphenate(self, word):
+        syl = self.hyphenator.syllables(word)
+        hyphenated = word if not syl else SOFT_HYPHEN.join(syl)
+        if self.size > 0:
+            self.words[word] = hyphenated
+            if len(self.words) > self.size:
+                self.words.popitem(last=False)
+        return hyphenated
 
-    def process_text(self, text, replace_nbsp, separators):
-        if not separators:
-            if len(text) >= 100:
-                return text
-            syl = self.hyphenator.syllables(text)
-            return text if not syl else SOFT_HYPHEN.join(syl)
+
+def get_hyphen_cache(language, size):
+    cache = hyphen_caches.get(language)
+    if cache is None:
+        cache = HyphenCache(language, size)
+        hyphen_caches[language] = cache
+    elif cache.size != size:
+        cache.resize(size)
+    return cache
+
+
+class MyHyphen:
+    def __init__(self, language, cache_size=HYPHEN_CACHE_SIZE):
+        self.cache_size = cache_size
+        self.cache = get_hyphen_cache(language, cache_size)
+        self.hits = 0
+        self.misses = 0
+
+    def hyphenate_word(self, word):
+        hyphenated = self.cache.lookup(word)
+        if hyphenated is None:
+            self.misses += 1
+            hyphenated = self.cache.hyphenate(word)
         else:
-            res = []
-            head, *tail = separators
-            for part in str.split(text, head):
-                res.append(self.process_text(part, replace_nbsp, tail))
-            head = head if not replace_nbsp or not head == NON_BREAKING_SPACE else ' '
-            return head.join(res)
+            self.hits += 1
+        return hyphenated
+
+    def process_token(self, match):
+        token = match.group(0)
+        if token == NON_BREAKING_SPACE:
+            return ' '
+        if len(token) >= 100:
+            return token
+        return self.hyphenate_word(token)
 
     def set_language(self, language):
-        self.hyphenator = hyphen.Hyphenator(language=language, directory=DICTIONARIES_DIR)
+        self.cache = get_hyphen_cache(language, self.cache_size)
 
     def hyphenate_text(self, text, replace_nbsp=False):
-        return self.process_text(text, replace_nbsp, WORD_SEPARATORS)
+        return (WORD_OR_NBSP if replace_nbsp else WORD).sub(self.process_token, text)
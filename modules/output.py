@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import zipfile
+
+MIMETYPE = b'application/epub+zip'
+
+# Already compressed files are stored as is
+STORED_MEDIA = ('.jpg', '.jpeg', '.png', '.gif', '.ttf', '.otf')
+
+
+def get_compress_type(name, stored_media=STORED_MEDIA, compression_level=None):
+    if name == 'mimetype' or compression_level == 0 or os.path.splitext(name)[1].lower() in stored_media:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def open_zip(file, compression_level=None):
+    if compression_level is not None:
+        try:
+            return zipfile.ZipFile(file, 'w', compresslevel=compression_level)
+        except TypeError:
+            # Python before 3.7 always uses default compression level
+            pass
+    return zipfile.ZipFile(file, 'w')
+
+
+class DirectoryOutput:
+    '''Book files are written into directory (kindlegen needs them on disk)'''
+
+    def __init__(self, root):
+        self.root = root
+
+    def get_path(self, name):
+        return os.path.join(self.root, *name.split('/'))
+
+    def write(self, name, data):
+        filename = self.get_path(name)
+        d = os.path.dirname(filename)
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+    def copy(self, src, name):
+        dest = self.get_path(name)
+        d = os.path.dirname(dest)
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+        shutil.copyfile(src, dest)
+
+    def close(self):
+        pass
+
+
+class ZipOutput:
+    '''Book files are written straight into epub archive (file name or writable file object).
+    Uncompressed mimetype goes first, files with extensions from stored_media are stored,
+    everything else is deflated with given compression level (0-9, 0 - store everything).
+    '''
+
+    def __init__(self, file, stored_media=STORED_MEDIA, compression_level=None):
+        self.stored_media = stored_media
+        self.compression_level = compression_level
+        self.zip = open_zip(file, compression_level)
+        self.zip.writestr('mimetype', MIMETYPE, zipfile.ZIP_STORED)
+
+    def write(self, name, data):
+        if name != 'mimetype':
+            self.zip.writestr(name, data, get_compress_type(name, self.stored_media, self.compression_level))
+
+    def copy(self, src, name):
+        self.zip.write(src, name, get_compress_type(name, self.stored_media, self.compression_level))
+
+    def close(self):
+        self.zip.close()
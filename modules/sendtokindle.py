@@ -1,10 +1,28 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
+import time
+import queue
+import base64
+import threading
 
 import smtplib
-from email.mime.application import MIMEApplication
+from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
+from email.policy import SMTP as SMTP_POLICY
+
+# Amazon accepts no more than 25 attachments in one message
+MAX_ATTACHMENTS = 25
+
+SMTP_TIMEOUT = 60
+
+# Files are read and encoded by parts. Part size is a multiple of 57 bytes, so every part gives
+# whole lines of 76 base64 characters.
+BASE64_CHUNK = 57 * 1024
+
+# Attachment content is put in place of this marker when message is sent
+ATTACHMENT_MARKER = 'fb2mobi-attachment-{0}'
 
 
 class SendToKindle:
@@ -18,20 +36,216 @@ class SendToKindle:
         self.convert = False
 
         self.parser = None
+        self.mail_server = None
 
-    def send_mail(self, files):
+    def connect(self):
+        self.mail_server = smtplib.SMTP(host=self.smtp_server, port=self.smtp_port, timeout=SMTP_TIMEOUT)
+        try:
+            self.mail_server.starttls()
+            self.mail_server.login(self.smtp_login, self.smtp_password)
+        except:
+            self.disconnect()
+            raise
+
+    def disconnect(self):
+        if self.mail_server:
+            try:
+                self.mail_server.quit()
+            except (smtplib.SMTPException, OSError):
+                self.mail_server.close()
+            self.mail_server = None
+
+    def get_message(self, files):
+        ''' Returns message as list of byte strings with None in place of every attachment content '''
         msg = MIMEMultipart()
         msg['From'] = self.user_email
         msg['To'] = self.kindle_email
         msg['Subject'] = 'Convert' if self.convert else 'Sent to Kindle'
         msg.preamble = 'This email has been automatically sent by fb2mobi tool'
 
-        for file_path in files:
+        for i, file_path in enumerate(files):
             fname = os.path.basename(file_path)
-            msg.attach(MIMEApplication(open(file_path, 'rb').read(), Content_Disposition='attachment; filename="%s"' % fname, Name=fname))
+            part = MIMEBase('application', 'octet-stream', Name=fname)
+            part['Content-Transfer-Encoding'] = 'base64'
+            part.add_header('Content-Disposition', 'attachment', filename=fname)
+            part.set_payload(ATTACHMENT_MARKER.format(i))
+            msg.attach(part)
+
+        result = []
+        text = msg.as_bytes(policy=SMTP_POLICY)
+        for i in range(len(files)):
+            head, text = text.split(ATTACHMENT_MARKER.format(i).encode('ascii'), 1)
+            result.extend([head, None])
+        result.append(text)
+        return result
+
+    def write_attachment(self, file_path):
+        with open(file_path, 'rb') as f:
+            while True:
+                data = f.read(BASE64_CHUNK)
+                if not data:
+                    break
+                self.mail_server.send(base64.encodebytes(data).replace(b'\n', b'\r\n'))
+
+    def send_mail(self, files):
+        ''' Sends files in one message. Connection is kept open for the next messages until disconnect().
+
+        Attachments are encoded by parts and written directly to connection, so memory used
+        does not depend on size of files.
+        '''
+        message = self.get_message(files)
+
+        if self.mail_server is None:
+            self.connect()
+        server = self.mail_server
+
+        code, resp = server.mail(self.user_email)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, resp, self.user_email)
+        code, resp = server.rcpt(self.kindle_email)
+        if code not in (250, 251):
+            raise smtplib.SMTPRecipientsRefused({self.kindle_email: (code, resp)})
+
+        # То же, что делает smtplib.SMTP.data(), но по частям
+        server.putcmd('data')
+        code, resp = server.getreply()
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+
+        files = iter(files)
+        for text in message:
+            if text is None:
+                self.write_attachment(next(files))
+            else:
+                # Lines starting with dot are escaped, base64 never starts with dot
+                server.send(re.sub(rb'(?m)^\.', b'..', text))
+        server.send(b'.\r\n' if message[-1].endswith(b'\r\n') else b'\r\n.\r\n')
+
+        code, resp = server.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+
+
+def is_permanent_error(e):
+    # 5xx replies and refused recipients will not change on retry
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(e, smtplib.SMTPResponseException) and 500 <= e.smtp_code < 600
+
+
+class DeliveryQueue:
+    '''Sends books in background thread while conversion goes on.
+
+    One SMTP session is used for all messages. Books waiting in queue are packed into one message
+    while total size of attachments is below max_size. Failed messages are sent again after
+    retry_delay, 2 * retry_delay, 4 * retry_delay... seconds.
+    '''
+
+    def __init__(self, sender, log, max_size, retries=3, retry_delay=10, delete_sent=False):
+        self.sender = sender
+        self.log = log
+        self.max_size = max_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.delete_sent = delete_sent
+
+        self.sent = 0
+        self.failed = 0
+        self.pending = None  # Book which did not fit into previous message
+
+        self.queue = queue.Queue()
+        # Thread must not keep process alive on user interrupt
+        self.thread = threading.Thread(target=self.run, name='send-to-kindle', daemon=True)
+        self.thread.start()
+
+    def put(self, file_path):
+        self.queue.put(file_path)
+
+    def finish(self):
+        ''' Waits until all queued books are sent, returns number of books which were not sent '''
+        self.queue.put(None)
+        self.thread.join()
+        return self.failed
+
+    def get_batch(self):
+        # First book is waited for, others are taken only if they are already in queue
+        if self.pending:
+            file_path = self.pending
+            self.pending = None
+        else:
+            file_path = self.queue.get()
+        if file_path is None:
+            return None
+        batch = [file_path]
+        size = self.get_size(file_path)
+
+        while len(batch) < MAX_ATTACHMENTS:
+            try:
+                file_path = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if file_path is None:
+                # Конец очереди - отправим накопленное и завершимся
+                self.queue.put(None)
+                break
+            file_size = self.get_size(file_path)
+            if size + file_size > self.max_size:
+                self.pending = file_path
+                break
+            batch.append(file_path)
+            size += file_size
+
+        if size > self.max_size:
+            self.log.warning('Size of "{0}" exceeds limit of {1:.1f} MB, it could be rejected by mail server'.format(
+                os.path.basename(batch[0]), self.max_size / 1024 / 1024))
+        return batch
+
+    def get_size(self, file_path):
+        try:
+            return os.path.getsize(file_path)
+        except OSError:
+            return 0
+
+    def run(self):
+        try:
+            while True:
+                batch = self.get_batch()
+                if batch is None:
+                    break
+                self.send(batch)
+        finally:
+            self.sender.disconnect()
+
+    def send(self, batch):
+        names = ', '.join('"{0}"'.format(os.path.basename(f)) for f in batch)
+        attempt = 0
+        while True:
+            reused = self.sender.mail_server is not None
+            try:
+                start = time.perf_counter()
+                self.sender.send_mail(batch)
+                self.log.info('Sent {0} to "{1}" in {2:.1f} sec'.format(names, self.sender.kindle_email, time.perf_counter() - start))
+                self.sent += len(batch)
+                break
+            except Exception as e:
+                # Connection is opened again for the next attempt
+                self.sender.disconnect()
+                if reused and isinstance(e, smtplib.SMTPServerDisconnected):
+                    # Server closed idle connection, it is not an error
+                    continue
+                if is_permanent_error(e) or attempt >= self.retries:
+                    self.log.error('Error sending {0}: {1}'.format(names, e))
+                    self.log.debug('Getting details', exc_info=True)
+                    self.failed += len(batch)
+                    return
+                delay = self.retry_delay * 2 ** attempt
+                attempt += 1
+                self.log.warning('Error sending {0}: {1}. Next attempt in {2} sec'.format(names, e, delay))
+                time.sleep(delay)
 
-        mail_server = smtplib.SMTP(host=self.smtp_server, port=self.smtp_port)
-        mail_server.starttls()
-        mail_server.login(self.smtp_login, self.smtp_password)
-        mail_server.sendmail(self.user_email, self.kindle_email, msg.as_string())
-        mail_server.quit()
+        if self.delete_sent:
+            for file_path in batch:
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    self.log.error('Unable to remove file "{0}".'.format(file_path))
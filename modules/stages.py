@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import time
+import json
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Stages:
+    '''Time and counters of conversion stages.
+
+    Stage names are dotted: "fb2html.parse" is a part of "fb2html", time of a stage includes
+    time of its parts. Stages of several books could be merged to get totals for batch conversion.
+    '''
+
+    def __init__(self, books=1):
+        self.times = OrderedDict()
+        self.counters = OrderedDict()
+        self.books = books
+
+    @contextmanager
+    def timer(self, name):
+        # Stage is added when it is started, so it goes before its parts in report
+        self.times.setdefault(name, 0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        self.times[name] = self.times.get(name, 0) + seconds
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other, prefix=''):
+        for name, seconds in other.times.items():
+            self.add_time(prefix + name, seconds)
+        for name, value in other.counters.items():
+            self.count(prefix + name, value)
+
+    def add_book(self, other):
+        self.merge(other)
+        self.books += other.books
+
+    def to_json(self, book=None):
+        return json.dumps(OrderedDict([('book', book), ('books', self.books),
+                                       ('times', OrderedDict((k, round(v, 4)) for k, v in self.times.items())),
+                                       ('counters', self.counters)]), ensure_ascii=False)
+
+    def format_table(self):
+        total = self.times.get('total')
+        # Parts of stage are indented
+        names = ['  ' * name.count('.') + name for name in self.times]
+        width = max([len(name) for name in names + list(self.counters)] + [7])
+
+        lines = ['{0:<{1}} {2:>10} {3:>6}'.format('Stage', width, 'Time, sec', '%')]
+        for name, seconds in zip(names, self.times.values()):
+            lines.append('{0:<{1}} {2:>10.3f} {3:>6}'.format(name, width, seconds, '{0:.1f}'.format(100 * seconds / total) if total else ''))
+        if self.counters:
+            lines.append('{0:<{1}} {2:>10}'.format('Counter', width, 'Value'))
+            for name, value in self.counters.items():
+                lines.append('{0:<{1}} {2:>10}'.format(name, width, value))
+
+        return lines
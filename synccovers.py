@@ -1,52 +1,89 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os, sys, traceback
+import os, sys, traceback, time
 
 import argparse
 import version
 
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
 from modules.mobi_split import mobi_read
 
 count_files = 0
 count_located = 0
 count_processed = 0
+count_skipped = 0
 
+# Время по фазам обработки (сумма по всем потокам)
+timings = {'scan': 0.0, 'read': 0.0, 'resize': 0.0, 'write': 0.0}
 
-def process_file(infile, kindle_dir, width, height, stretch, verbose):
 
-    global count_files, count_located, count_processed
+def process_file(infile, kindle_dir, width, height, stretch, verbose, force=False):
+    '''Writes thumbnail for one book. Runs in worker thread, so instead of printing returns
+    (status, messages, timings) where status is None (not found), 'processed', 'skipped' or 'failed'.
+    '''
+    messages = []
+    times = {'read': 0.0, 'resize': 0.0, 'write': 0.0}
+    status = 'failed'
 
-    count_files += 1
     if not os.path.exists(infile):
-        if verbose: print('WARNING: File {0} not found'.format(infile))
-        return
+        if verbose: messages.append('WARNING: File {0} not found'.format(infile))
+        return None, messages, times
 
-    count_located += 1
-    if verbose: print('Processing file {}'.format(infile))
+    if verbose: messages.append('Processing file {}'.format(infile))
     try:
-        reader = mobi_read(infile, width, height, stretch)
-        asin = reader.getCdeContentKey()
-        if len(asin) == 0:
-            asin = reader.getASIN()
-        if len(asin) > 0:
-            thumb = reader.getThumbnail()
-            if thumb != None:
-                thumb.convert('RGB').save(os.path.join(kindle_dir, 'thumbnail_' + asin + '_' + reader.getCdeType() + '_portrait.jpg'), 'JPEG')
-                count_processed += 1
-                if verbose: print('Written thumbnail for {}'.format(asin))
+        start = time.perf_counter()
+        with mobi_read(infile, width, height, stretch) as reader:
+            asin = reader.getCdeContentKey()
+            if len(asin) == 0:
+                asin = reader.getASIN()
+            times['read'] += time.perf_counter() - start
+
+            if len(asin) > 0:
+                thumbfile = os.path.join(kindle_dir, 'thumbnail_' + asin + '_' + reader.getCdeType() + '_portrait.jpg')
+                if not force and os.path.exists(thumbfile) and os.path.getmtime(thumbfile) >= os.path.getmtime(infile):
+                    if verbose: messages.append('Skipping - thumbnail is up to date')
+                    return 'skipped', messages, times
+
+                start = time.perf_counter()
+                thumb = reader.getThumbnail()
+                if thumb != None:
+                    data = BytesIO()
+                    thumb.convert('RGB').save(data, 'JPEG')
+                    times['resize'] += time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    with open(thumbfile, 'wb') as f:
+                        f.write(data.getvalue())
+                    times['write'] += time.perf_counter() - start
+
+                    status = 'processed'
+                    if verbose: messages.append('Written thumbnail for {}'.format(asin))
+                else:
+                    times['resize'] += time.perf_counter() - start
+                    status = 'skipped'
+                    if verbose: messages.append("Skipping - no cover or thumbnail")
             else:
-                if verbose: print("Skipping - no cover or thumbnail")
-        else:
-            if verbose: print("Skipping - no ASIN")
+                status = 'skipped'
+                if verbose: messages.append("Skipping - no ASIN")
     except:
-        print('ERROR: processing file.')
-        traceback.print_exc()
+        messages.append('ERROR: processing file.\n' + traceback.format_exc())
+
+    return status, messages, times
 
-    return
 
+def get_book_files(inputdir):
+    for root, dirs, files in os.walk(inputdir):
+        for file in files:
+            if file.lower().endswith(('.mobi', '.azw3')):
+                yield os.path.join(root, file)
 
-def process_folder(inputdir, width, height, stretch, verbose):
+
+def process_folder(inputdir, width, height, stretch, verbose, jobs=4, force=False):
+
+    global count_files, count_located, count_processed, count_skipped
 
     if os.path.isdir(inputdir):
         # let's see if we could locate kindle directory
@@ -62,19 +99,34 @@ def process_folder(inputdir, width, height, stretch, verbose):
             print('ERROR: unable to find Kindle system directory along the path "{0}"'.format(inputdir))
             sys.exit(-1)
 
-        for root, dirs, files in os.walk(inputdir):
-            for file in files:
-                try:
-                    if file.lower().endswith(('.mobi', '.azw3')):
-                        inputfile = os.path.join(root, file)
-                        process_file(inputfile, kindle_dir, width, height, stretch, verbose)
-                except KeyboardInterrupt as e:
-                    print('User interrupt. Exiting...')
-                    sys.exit(-1)
-                except IOError as e:
-                    print('ERROR: I/O {0}: {1} - {2}'.format(e.errno, e.strerror, e.filename))
-                except:
-                    traceback.print_exc()
+        start = time.perf_counter()
+        try:
+            input_files = list(get_book_files(inputdir))
+        except IOError as e:
+            print('ERROR: I/O {0}: {1} - {2}'.format(e.errno, e.strerror, e.filename))
+            input_files = []
+        timings['scan'] += time.perf_counter() - start
+
+        # Чтение с устройства и пересжатие картинок идут параллельно
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            try:
+                results = executor.map(lambda f: process_file(f, kindle_dir, width, height, stretch, verbose, force), input_files)
+                for status, messages, times in results:
+                    count_files += 1
+                    for m in messages:
+                        print(m)
+                    for phase in times:
+                        timings[phase] += times[phase]
+                    if status:
+                        count_located += 1
+                    if status == 'processed':
+                        count_processed += 1
+                    elif status == 'skipped':
+                        count_skipped += 1
+            except KeyboardInterrupt as e:
+                print('User interrupt. Exiting...')
+                executor.shutdown(wait=False)
+                os._exit(-1)
     else:
         print('ERROR: unable to find input directory "{0}"'.format(inputdir))
         sys.exit(-1)
@@ -112,12 +164,17 @@ if __name__ == '__main__':
     argparser.add_argument('-v', '--verbose', dest='verbose', action='store_true', default=False, help='Produce verbose output')
     argparser.add_argument('-s', '--thumbsize', dest='thumbsize', type=read_thumbsize, default='330x470',  help='Size of resulting thumbnail (330x470)')
     argparser.add_argument('--stretch', dest='stretch', action='store_true', default=False, help='Do not preserve thumbnail aspect ratio')
+    argparser.add_argument('-j', '--jobs', dest='jobs', type=int, default=4, help='Number of books to process in parallel (4)')
+    argparser.add_argument('-f', '--force', dest='force', action='store_true', default=False, help='Write thumbnails even if they are up to date')
 
     args = argparser.parse_args()
 
     if args.inputdir:
-        process_folder(os.path.normpath(args.inputdir), args.thumbsize[0], args.thumbsize[1], args.stretch, args.verbose)
-        print('\nTotal files {0}, located {1}, thumbnails written for {2}'.format(count_files, count_located, count_processed))
+        start = time.perf_counter()
+        process_folder(os.path.normpath(args.inputdir), args.thumbsize[0], args.thumbsize[1], args.stretch, args.verbose, args.jobs, args.force)
+        print('\nTotal files {0}, located {1}, thumbnails written for {2}, skipped {3}'.format(count_files, count_located, count_processed, count_skipped))
+        print('Time {0:.2f} sec (scan {1:.2f}, read {2:.2f}, resize {3:.2f}, write {4:.2f} sec in all threads)'.format(
+            time.perf_counter() - start, timings['scan'], timings['read'], timings['resize'], timings['write']))
     else:
         print(argparser.description)
         argparser.print_usage()
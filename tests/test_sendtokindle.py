@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Отправка письма через локальный SMTP приемник: вложения после передачи по частям
+# должны раскодироваться в исходные байты.
+#
+# Usage: python -m unittest discover tests
+
+import os
+import sys
+import email
+import random
+import shutil
+import smtplib
+import tempfile
+import threading
+import socketserver
+import unittest
+
+from email.policy import default as DEFAULT_POLICY
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from modules.sendtokindle import SendToKindle, BASE64_CHUNK
+
+
+class SmtpSink(socketserver.StreamRequestHandler):
+    '''Minimal SMTP server, received messages are put to server.messages with dot-stuffing removed'''
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost test sink')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            cmd = line[:4].upper()
+            if cmd == b'EHLO':
+                self.reply('250-localhost')
+                self.reply('250 8BITMIME')
+            elif cmd == b'HELO' or cmd == b'MAIL' or cmd == b'RCPT' or cmd == b'RSET' or cmd == b'NOOP':
+                self.reply('250 OK')
+            elif cmd == b'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line == b'.\r\n':
+                        break
+                    data.append(line[1:] if line.startswith(b'.') else line)
+                self.server.messages.append(b''.join(data))
+                self.reply('250 OK')
+            elif cmd == b'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('502 Command not implemented')
+
+
+class TestSendMail(unittest.TestCase):
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SmtpSink)
+        self.server.daemon_threads = True
+        self.server.messages = []
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+        self.dir = tempfile.mkdtemp()
+
+        self.sender = SendToKindle()
+        self.sender.user_email = 'user@example.com'
+        self.sender.kindle_email = 'user@kindle.com'
+        # Приемник не поддерживает STARTTLS и авторизацию, соединение открывается без них
+        self.sender.mail_server = smtplib.SMTP('127.0.0.1', self.server.server_address[1], timeout=10)
+
+    def tearDown(self):
+        self.sender.disconnect()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def write_file(self, name, data):
+        file_path = os.path.join(self.dir, name)
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        return file_path
+
+    def get_attachments(self, message):
+        msg = email.message_from_bytes(message, policy=DEFAULT_POLICY)
+        return [(part.get_filename(), part.get_content()) for part in msg.iter_attachments()]
+
+    def test_dot_lines(self):
+        data = b'.\r\n..\r\n.first line\r\ntext\n.\n.second line\r\n.'
+        file_path = self.write_file('.dots.mobi', data)
+
+        self.sender.send_mail([file_path])
+
+        self.assertEqual(len(self.server.messages), 1)
+        self.assertEqual(self.get_attachments(self.server.messages[0]), [('.dots.mobi', data)])
+
+    def test_dot_text(self):
+        # Текст письма, в отличие от base64, может содержать строки с точкой в начале
+        get_message = self.sender.get_message
+
+        def get_message_epilogue(files):
+            message = get_message(files)
+            message[-1] += b'.\r\n.epilogue\r\n'
+            return message
+
+        self.sender.get_message = get_message_epilogue
+        data = b'.\r\n'
+        file_path = self.write_file('dot.mobi', data)
+
+        self.sender.send_mail([file_path])
+
+        self.assertEqual(len(self.server.messages), 1)
+        self.assertTrue(self.server.messages[0].endswith(b'--\r\n.\r\n.epilogue\r\n'))
+        self.assertEqual(self.get_attachments(self.server.messages[0]), [('dot.mobi', data)])
+
+    def test_several_files(self):
+        rnd = random.Random(0)
+        files = {
+            'big.azw3': bytes(rnd.getrandbits(8) for _ in range(3 * BASE64_CHUNK + 100)),
+            'chunk.mobi': bytes(rnd.getrandbits(8) for _ in range(BASE64_CHUNK)),
+            'empty.mobi': b'',
+            'dots.mobi': b'.\r\n' * 1000,
+        }
+        file_paths = [self.write_file(name, data) for name, data in files.items()]
+
+        # Two messages over one connection
+        self.sender.send_mail(file_paths)
+        self.sender.send_mail(file_paths[:1])
+
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(self.get_attachments(self.server.messages[0]), list(files.items()))
+        self.assertEqual(self.get_attachments(self.server.messages[1]), list(files.items())[:1])
+
+
+if __name__ == '__main__':
+    unittest.main()
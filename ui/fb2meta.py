@@ -10,6 +10,8 @@ from io import StringIO, BytesIO
 from lxml import etree
 from lxml.etree import QName
 
+from modules.fb2desc import Author, Sequence, read_fb2_description
+
 
 def indent(elem, level=0):
     '''Функция для улучшения вида xml/html.
@@ -30,22 +32,10 @@ def indent(elem, level=0):
         if level and (not elem.tail or not elem.tail.strip()):
             elem.tail = i
 
-class Author():
-    def __init__(self):
-        self.first_name = ''
-        self.middle_name = ''
-        self.last_name = ''
-
-
-class Sequence():
-    def __init__(self):
-        self.name = ''
-        self.number = None
-
-
 class Fb2Meta():
-    def __init__(self, file):
+    def __init__(self, file, description_only=False):
         self.file = file
+        self.tree = None
 
         self.genre = []
         self.author = []
@@ -71,18 +61,27 @@ class Fb2Meta():
             content = None
 
             if len(zip_file.namelist()) == 1:
-                f = zip_file.open(zip_file.namelist()[0])
-                content = f.read()
-                f.close()
-
-                self.tree = etree.parse(BytesIO(content), parser=etree.XMLParser(recover=True))
+                if description_only:
+                    # Архив читается потоком, только до конца description
+                    self.tree = self._read_description(zip_file)
+                else:
+                    content = zip_file.read(zip_file.namelist()[0])
+                    self.tree = etree.parse(BytesIO(content), parser=etree.XMLParser(recover=True))
             else:
                 # TODO: архиве несколько файлов. Ошибка
                 pass
+            zip_file.close()
+        elif description_only:
+            self.tree = self._read_description(self.file)
         else:
             self.tree = etree.parse(self.file, parser=etree.XMLParser(recover=True))
 
 
+    def _read_description(self, path_or_zip):
+        desc = read_fb2_description(path_or_zip)
+        return desc.element.getroottree() if desc.element is not None else None
+
+
     def get_autors(self):
         author_str = ''
         
@@ -101,6 +100,9 @@ class Fb2Meta():
 
 
     def get(self):
+        if self.tree is None:
+            return
+
         ns = {'fb': 'http://www.gribuser.ru/xml/fictionbook/2.0'}
         for title_info in self.tree.xpath('//fb:description/fb:title-info', namespaces=ns):
             for elem in title_info:                
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+
+
+class MetaCache():
+    '''Постоянный кэш названий и авторов книг для списка файлов.
+    Запись действительна, пока не изменились размер и время изменения файла.
+    '''
+
+    def __init__(self, db_file):
+        self.db = None
+        try:
+            self.db = sqlite3.connect(db_file)
+            self.db.execute('CREATE TABLE IF NOT EXISTS books (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, title TEXT, authors TEXT)')
+            self.db.commit()
+        except sqlite3.Error:
+            # Без кэша список работает так же, только медленнее
+            self.db = None
+
+    def get(self, file):
+        if self.db is None:
+            return None
+
+        try:
+            st = os.stat(file)
+            row = self.db.execute('SELECT mtime, size, title, authors FROM books WHERE path = ?', (file,)).fetchone()
+        except (OSError, sqlite3.Error):
+            return None
+
+        if row and row[0] == st.st_mtime and row[1] == st.st_size:
+            return row[2], row[3]
+        return None
+
+    def put(self, file, mtime, size, title, authors):
+        if self.db is not None:
+            try:
+                self.db.execute('INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?)', (file, mtime, size, title, authors))
+            except sqlite3.Error:
+                pass
+
+    def commit(self):
+        if self.db is not None:
+            try:
+                self.db.commit()
+            except sqlite3.Error:
+                pass
+
+    def close(self):
+        if self.db is not None:
+            self.commit()
+            self.db.close()
+            self.db = None